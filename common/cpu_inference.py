@@ -0,0 +1,172 @@
+import json
+import os
+import sys
+import threading
+
+import torch
+import torch.multiprocessing as mp
+
+from common.predict import build_predictor, get_args as get_predict_args, read_records
+
+
+def partition_cores(num_workers):
+    """
+    Splits the cores this process may run on into disjoint contiguous sets, one per worker
+    :param num_workers: number of workers
+    :return: list of core lists
+    """
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    num_workers = min(num_workers, len(cores))
+    size, remainder = divmod(len(cores), num_workers)
+    partitions, start = list(), 0
+    for rank in range(num_workers):
+        end = start + size + (1 if rank < remainder else 0)
+        partitions.append(cores[start:end])
+        start = end
+    return partitions
+
+
+def _worker(rank, cores, predictor, tasks, results):
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    # One intra-op thread per core of the worker, so workers do not oversubscribe the machine
+    torch.set_num_threads(len(cores))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        index, keys, texts = task
+        try:
+            results.put((index, keys, predictor.predict(texts)))
+        except Exception as e:
+            results.put((index, keys, e))
+
+
+class CPUInferenceRunner(object):
+    """
+    Scores documents with several CPU worker processes sharing a single copy of the model weights. The model is
+    moved into shared memory before the workers are forked, each worker is pinned to its own set of cores and
+    pulls batches from a shared queue. Results are returned in the order of the input.
+
+    Words outside a pruned vocabulary are not looked up in the word vectors: each worker would add them to a private
+    copy of the shared embeddings. They map to <unk> or their hash bucket, as without --word-vectors-file.
+    """
+
+    def __init__(self, predictor, num_workers=None, cores_per_worker=None):
+        """
+        :param predictor: Predictor with its model on the CPU
+        :param num_workers: number of worker processes, defaults to the number of cores over cores_per_worker
+        :param cores_per_worker: number of cores per worker, used when num_workers is not given
+        """
+        num_cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+        if num_workers is None:
+            num_workers = max(num_cores // (cores_per_worker or 4), 1)
+        self.predictor = predictor
+        if getattr(predictor.encoder, 'extender', None) is not None:
+            print('Warning: --word-vectors-file is ignored by the CPU workers, words outside the pruned vocabulary '
+                  'map to <unk> or their hash bucket', file=sys.stderr)
+            predictor.encoder.extender = None
+        self.partitions = partition_cores(num_workers)
+        self.context = mp.get_context('fork')
+        self.tasks = self.context.Queue(maxsize=4 * len(self.partitions))
+        self.results = self.context.Queue()
+        self.workers = list()
+
+    def start(self):
+        self.predictor.model.share_memory()
+        for rank, cores in enumerate(self.partitions):
+            worker = self.context.Process(target=_worker, args=(rank, cores, self.predictor, self.tasks, self.results),
+                                          daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def close(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = list()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def run(self, records, batch_size):
+        """
+        Predicts the labels of a stream of documents
+        :param records: iterable of (key, text) tuples
+        :param batch_size: number of documents per batch
+        :return: generator of (key, labels, scores) tuples in the order of the input
+        """
+        num_batches = [0]
+        done = threading.Event()
+
+        def feed():
+            keys, texts = list(), list()
+            for key, text in records:
+                keys.append(key)
+                texts.append(text)
+                if len(texts) == batch_size:
+                    self.tasks.put((num_batches[0], keys, texts))
+                    num_batches[0] += 1
+                    keys, texts = list(), list()
+            if texts:
+                self.tasks.put((num_batches[0], keys, texts))
+                num_batches[0] += 1
+            done.set()
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+
+        # Batches finish out of order, hold on to them until the earlier ones arrive
+        pending, next_index = dict(), 0
+        while True:
+            if next_index in pending:
+                keys, predictions = pending.pop(next_index)
+                next_index += 1
+                for key, (labels, scores) in zip(keys, predictions):
+                    yield key, labels, scores
+                continue
+
+            # The feeder sets done after queueing its last batch, so check it before reading the batch count
+            finished = done.is_set()
+            if next_index >= num_batches[0]:
+                if finished:
+                    break
+                done.wait(0.01)
+                continue
+
+            index, keys, predictions = self.results.get()
+            if isinstance(predictions, Exception):
+                raise predictions
+            pending[index] = (keys, predictions)
+        feeder.join()
+
+
+def get_args():
+    parser = get_predict_args()
+    parser.description = "Predict the labels of documents with several CPU worker processes"
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--cores-per-worker', type=int, default=4, help='cores pinned to each worker')
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_args().parse_args()
+    predictor = build_predictor(args, torch.device('cpu'))
+
+    input_file = sys.stdin if args.input == '-' else open(args.input, 'r', encoding='utf-8')
+    output_file = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    try:
+        with CPUInferenceRunner(predictor, num_workers=args.workers, cores_per_worker=args.cores_per_worker) as runner:
+            for key, labels, scores in runner.run(read_records(input_file, args.input_format), args.batch_size):
+                output_file.write(json.dumps({'id': key, 'labels': labels, 'scores': scores}) + '\n')
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+        if output_file is not sys.stdout:
+            output_file.close()
@@ -1,5 +1,6 @@
 from common.evaluators.classification_evaluator import ClassificationEvaluator
 from common.evaluators.relevance_transfer_evaluator import RelevanceTransferEvaluator
+from utils.compilation import shape_buckets
 
 
 class EvaluatorFactory(object):
@@ -32,3 +33,26 @@ class EvaluatorFactory(object):
         return EvaluatorFactory.evaluator_map[dataset_cls.NAME](
             dataset_cls, model, embedding, data_loader, batch_size, device, keep_results
         )
+
+
+def set_ranking_args(evaluator, args):
+    """
+    Passes the ranking options of the command line to an evaluator that reports ranking metrics
+    :param evaluator: evaluator returned by EvaluatorFactory
+    :param args: command line arguments
+    """
+    if hasattr(evaluator, 'top_k'):
+        evaluator.top_k = args.top_k
+        evaluator.threshold = args.threshold
+        evaluator.shortlist_beam = getattr(args, 'shortlist_beam', 0)
+        evaluator.shortlist_leaf_size = getattr(args, 'shortlist_leaf_size', 0)
+
+
+def set_shape_buckets(evaluator, args):
+    """
+    Pads the batches of an evaluator of a model compiled with --compile to a few shapes
+    :param evaluator: evaluator returned by EvaluatorFactory
+    :param args: command line arguments
+    """
+    if hasattr(evaluator, 'shape_buckets'):
+        evaluator.shape_buckets = shape_buckets(args, args.batch_size)
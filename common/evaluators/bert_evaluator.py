@@ -1,123 +1,174 @@
-import warnings
-
-import numpy as np
-import pandas as pd
 import torch
 import torch.nn.functional as F
-from sklearn import metrics
-from torch.utils.data import DataLoader, SequentialSampler, TensorDataset
+from torch.utils.data import DataLoader, SequentialSampler
+from torch.utils.data.dataloader import default_collate
 from tqdm import tqdm
 
+from common.metrics import ConfusionCounts, RankingMetrics
 from datasets.bert_processors.abstract_processor import convert_examples_to_features, \
-    convert_examples_to_hierarchical_features
-from utils.preprocessing import pad_input_matrix
+    convert_examples_to_hierarchical_features, convert_examples_to_windowed_features, deduplicate_examples
+from utils.activation_cache import sentence_store
+from utils.compilation import pad_inputs, shape_buckets
+from utils.predictions import prediction_sink
 from utils.tokenization import BertTokenizer
 
-# Suppress warnings from sklearn.metrics
-warnings.filterwarnings('ignore')
-
 
 class BertEvaluator(object):
     def __init__(self, model, processor, args, split='dev'):
         self.args = args
         self.model = model
         self.processor = processor
+        self.split = split
+        self.buckets = shape_buckets(args, args.batch_size, args.max_seq_length)
         self.tokenizer = BertTokenizer.from_pretrained(args.model, is_lowercase=args.is_lowercase)
         if split == 'test':
             self.eval_examples = self.processor.get_test_examples(args.data_dir)
         else:
             self.eval_examples = self.processor.get_dev_examples(args.data_dir)
 
-    def get_scores(self, silent=False):
+    def get_features(self, examples=None):
+        examples = self.eval_examples if examples is None else examples
+        if getattr(self.args, 'long_document', False):
+            return convert_examples_to_windowed_features(
+                examples, self.args.max_seq_length, self.tokenizer, self.args.window_stride,
+                max_windows=self.args.max_windows)
         if self.args.is_hierarchical:
-            eval_features = convert_examples_to_hierarchical_features(
-                self.eval_examples, self.args.max_seq_length, self.tokenizer)
+            return convert_examples_to_hierarchical_features(examples, self.args.max_seq_length, self.tokenizer)
+        return convert_examples_to_features(examples, self.args.max_seq_length, self.tokenizer)
+
+    def iter_window_logits(self, eval_features, silent):
+        # Windows of consecutive documents are packed into full batches, a document may span several batches
+        eval_data = eval_features.window_dataset()
+        eval_dataloader = DataLoader(eval_data, sampler=SequentialSampler(eval_data), batch_size=self.args.batch_size)
+        window_logits, window_scores, doc_index, window_index = list(), list(), list(), list()
+        for input_ids, input_mask, segment_ids, doc_ids, positions in tqdm(eval_dataloader, desc="Evaluating",
+                                                                            disable=silent):
+            (input_ids, input_mask, segment_ids), num_rows = pad_inputs(
+                self.buckets, [t.to(self.args.device).long() for t in (input_ids, input_mask, segment_ids)],
+                input_mask)
+            with torch.no_grad():
+                logits, scores = self.model(input_ids, segment_ids, input_mask)
+                logits, scores = logits[:num_rows], scores[:num_rows]
+            window_logits.append(logits)
+            window_scores.append(scores)
+            doc_index.append(doc_ids)
+            window_index.append(positions)
+
+        model = getattr(self.model, 'module', self.model)
+        doc_logits = model.aggregate(torch.cat(window_logits), torch.cat(window_scores),
+                                     torch.cat(doc_index).to(self.args.device),
+                                     torch.cat(window_index).to(self.args.device), len(eval_features))
+        label_ids = torch.from_numpy(eval_features.label_ids).to(self.args.device)
+        weights = None
+        if eval_features.weights is not None:
+            weights = torch.from_numpy(eval_features.weights).to(self.args.device)
+        for start in range(0, len(eval_features), self.args.batch_size):
+            end = start + self.args.batch_size
+            yield doc_logits[start:end], label_ids[start:end], weights[start:end] if weights is not None else None
+
+    def iter_logits(self, eval_features, silent):
+        store = sentence_store(self.args, self.model) if self.args.is_hierarchical else None
+        if store is not None:
+            # Sentences seen in earlier epochs or splits are read from the store instead of being encoded again
+            eval_data = store.dataset(getattr(self.model, 'module', self.model).sentence_encoder, eval_features,
+                                      self.args.max_doc_length, self.args.batch_size * self.args.max_doc_length,
+                                      self.args.device)
+            collate_fn = store.collate
         else:
-            eval_features = convert_examples_to_features(
-                self.eval_examples, self.args.max_seq_length, self.tokenizer)
-
-        unpadded_input_ids = [f.input_ids for f in eval_features]
-        unpadded_input_mask = [f.input_mask for f in eval_features]
-        unpadded_segment_ids = [f.segment_ids for f in eval_features]
-
-        if self.args.is_hierarchical:
-            pad_input_matrix(unpadded_input_ids, self.args.max_doc_length)
-            pad_input_matrix(unpadded_input_mask, self.args.max_doc_length)
-            pad_input_matrix(unpadded_segment_ids, self.args.max_doc_length)
-
-        padded_input_ids = torch.tensor(unpadded_input_ids, dtype=torch.long)
-        padded_input_mask = torch.tensor(unpadded_input_mask, dtype=torch.long)
-        padded_segment_ids = torch.tensor(unpadded_segment_ids, dtype=torch.long)
-        label_ids = torch.tensor([f.label_id for f in eval_features], dtype=torch.long)
-
-        eval_data = TensorDataset(padded_input_ids, padded_input_mask, padded_segment_ids, label_ids)
+            eval_data = eval_features.tensor_dataset(self.args.max_doc_length if self.args.is_hierarchical else None)
+            collate_fn = default_collate
         eval_sampler = SequentialSampler(eval_data)
-        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=self.args.batch_size)
+        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=self.args.batch_size,
+                                     collate_fn=collate_fn)
+
+        for batch in tqdm(eval_dataloader, desc="Evaluating", disable=silent):
+            # Batches of deduplicated examples end with the number of copies of each example
+            weights = None
+            if store is not None:
+                inputs, label_ids = batch[:2]
+                if len(batch) > 2:
+                    weights = batch[2].to(self.args.device)
+                sentence_vectors = inputs['sentence_vectors'].to(self.args.device,
+                                                                 dtype=next(self.model.parameters()).dtype)
+                (sentence_vectors,), num_rows = pad_inputs(self.buckets, [sentence_vectors])
+                with torch.no_grad():
+                    logits = self.model(sentence_vectors=sentence_vectors)[:num_rows]
+            else:
+                input_ids, input_mask, segment_ids, label_ids = batch[:4]
+                if len(batch) > 4:
+                    weights = batch[4].to(self.args.device)
+                input_ids = input_ids.to(self.args.device).long()
+                input_mask = input_mask.to(self.args.device).long()
+                segment_ids = segment_ids.to(self.args.device).long()
+                (input_ids, input_mask, segment_ids), num_rows = pad_inputs(
+                    self.buckets, [input_ids, input_mask, segment_ids], input_mask)
+
+                with torch.no_grad():
+                    logits = self.model(input_ids, segment_ids, input_mask)[:num_rows]
+            yield logits, label_ids.to(self.args.device), weights
 
+    def get_scores(self, silent=False):
+        sink = prediction_sink(self.args, self.split, len(self.eval_examples))
+        examples, weights = self.eval_examples, None
+        if getattr(self.args, 'deduplicate', False) and sink is None:
+            # Saved predictions are aligned with the examples of the split, so they are only deduplicated when
+            # no predictions are saved
+            examples, weights = deduplicate_examples(self.eval_examples)
+        eval_features = self.get_features(examples)
+        eval_features.weights = weights
         self.model.eval()
 
-        total_loss = 0
-        nb_eval_steps, nb_eval_examples = 0, 0
-        predicted_labels, target_labels = list(), list()
-
-        for input_ids, input_mask, segment_ids, label_ids in tqdm(eval_dataloader, desc="Evaluating", disable=silent):
-            input_ids = input_ids.to(self.args.device)
-            input_mask = input_mask.to(self.args.device)
-            segment_ids = segment_ids.to(self.args.device)
-            label_ids = label_ids.to(self.args.device)
+        # Losses are summed over every copy of the examples and averaged over the total number of copies
+        total_loss, total_weight = 0, 0
+        counts = ConfusionCounts()
+        ranking = None
+        if self.args.is_multilabel and getattr(self.args, 'top_k', 0):
+            ranking = RankingMetrics(self.args.top_k, getattr(self.args, 'threshold', 0.5))
 
-            with torch.no_grad():
-                logits = self.model(input_ids, segment_ids, input_mask)
+        if getattr(self.args, 'long_document', False):
+            batches = self.iter_window_logits(eval_features, silent)
+        else:
+            batches = self.iter_logits(eval_features, silent)
 
+        for logits, label_ids, weights in batches:
+            # The highest scoring label is predicted, also for multi-label datasets
+            predictions = ConfusionCounts.one_hot(torch.argmax(logits, dim=1), logits.size(1))
             if self.args.is_multilabel:
-                predicted_labels.extend(F.softmax(logits, dim=1).cpu().detach().numpy())
-                # print(F.softmax(logits).cpu().detach().numpy())
-                target_labels.extend(label_ids.cpu().detach().numpy())
-                loss = F.binary_cross_entropy_with_logits(logits, label_ids.float(), size_average=False)
+                counts.update(predictions, label_ids, weights)
+                loss = F.binary_cross_entropy_with_logits(logits, label_ids.float(), reduce=False).sum(dim=1)
             else:
-                predicted_labels.extend(torch.argmax(logits, dim=1).cpu().detach().numpy())
-                target_labels.extend(torch.argmax(label_ids, dim=1).cpu().detach().numpy())
-                loss = F.cross_entropy(logits, torch.argmax(label_ids, dim=1))
-
-            if self.args.n_gpu > 1:
-                loss = loss.mean()
-            if self.args.gradient_accumulation_steps > 1:
-                loss = loss / self.args.gradient_accumulation_steps
-            total_loss += loss.item()
-
-            nb_eval_examples += input_ids.size(0)
-            nb_eval_steps += 1
+                counts.update(predictions, ConfusionCounts.one_hot(torch.argmax(label_ids, dim=1), logits.size(1)),
+                              weights)
+                loss = F.cross_entropy(logits, torch.argmax(label_ids, dim=1), reduce=False)
+            if ranking is not None:
+                # Only the top-k labels of each example are kept
+                top_scores, top_labels = torch.topk(logits, min(ranking.k, logits.size(1)), dim=1)
+                ranking.update(top_labels, label_ids, weights, top_scores)
+            if sink is not None:
+                sink.add(logits, label_ids)
+
+            if weights is not None:
+                total_loss += (loss * weights.to(loss.dtype)).sum().detach()
+                total_weight += weights.sum()
+            else:
+                total_loss += loss.sum().detach()
+                total_weight += loss.size(0)
 
-        if self.args.is_multilabel:
+        if self.args.is_multilabel or counts.num_classes > 2:
             score_method = 'weighted'
-            pos_label = None
         else:
             score_method = 'binary'
-            pos_label = 1
-
-        # np.savetxt('predicted_untransformed.csv', predicted_labels, delimiter=',')
-        predicted_labels, target_labels = np.array(predicted_labels), np.array(target_labels)
-        predicted_labels = (predicted_labels == predicted_labels.max(axis=1, keepdims=True)).astype(int)
-
-        accuracy = metrics.accuracy_score(target_labels, predicted_labels)
-        precision = metrics.precision_score(target_labels, predicted_labels, average=score_method, pos_label=pos_label)
-        recall = metrics.recall_score(target_labels, predicted_labels, average=score_method, pos_label=pos_label)
-        f1 = metrics.f1_score(target_labels, predicted_labels, average=score_method, pos_label=pos_label)
-        avg_loss = total_loss / nb_eval_steps
-
-        predicted_labels = np.apply_along_axis(lambda x: ''.join(x), 1, predicted_labels.astype(str))
-        target_labels = np.apply_along_axis(lambda x: ''.join(x), 1, target_labels.astype(str))
-        # predictions = np.hstack([predicted_labels, target_labels])
-
-        # np.savetxt('predictions.csv', predictions, delimiter=',')
-        x = np.random.randint(1000)
-        with open('predictions_{}.txt'.format(x), 'w') as f:
-            pred = pd.DataFrame(
-                {
-                    'predicted': predicted_labels,
-                    'target': target_labels
-                }
-            )
-            pred.to_csv(f)
+
+        accuracy, precision, recall, f1 = counts.compute(score_method, pos_label=1)
+        avg_loss = float(total_loss) / float(total_weight)
+        if self.args.is_multilabel:
+            # Multi-label losses keep their usual scale, the sum of the losses of a batch of examples
+            avg_loss *= self.args.batch_size
+        avg_loss /= self.args.gradient_accumulation_steps
+
+        if ranking is not None and not silent:
+            print(ranking.report())
+        if sink is not None:
+            print('Saved predictions to', sink.close() + '.*.npy')
 
         return [accuracy, precision, recall, f1, avg_loss], ['accuracy', 'precision', 'recall', 'f1', 'avg_loss']
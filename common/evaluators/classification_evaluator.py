@@ -1,9 +1,9 @@
-import numpy as np
 import torch
 import torch.nn.functional as F
-from sklearn import metrics
 
 from common.evaluators.evaluator import Evaluator
+from common.metrics import ConfusionCounts, RankingMetrics
+from utils.compilation import pad_index
 
 
 class ClassificationEvaluator(Evaluator):
@@ -12,6 +12,13 @@ class ClassificationEvaluator(Evaluator):
         super().__init__(dataset_cls, model, embedding, data_loader, batch_size, device, keep_results)
         self.ignore_lengths = False
         self.is_multilabel = False
+        # Ranking metrics of multi-label models, with shortlist inference for models with a label tree head
+        self.top_k = 5
+        self.threshold = 0.5
+        self.shortlist_beam = 0
+        self.shortlist_leaf_size = 0
+        # Batches of compiled models are padded to a few shapes
+        self.shape_buckets = None
 
     def get_scores(self):
         self.model.eval()
@@ -23,8 +30,34 @@ class ClassificationEvaluator(Evaluator):
             old_params = self.model.get_params()
             self.model.load_ema_params()
 
-        predicted_labels, target_labels = list(), list()
+        counts = ConfusionCounts()
+        ranking = RankingMetrics(self.top_k, self.threshold) if self.is_multilabel and self.top_k else None
+        head = getattr(self.model, 'fc1', None)
+        extreme = ranking is not None and self.shortlist_beam and hasattr(self.model, 'encode') and \
+            hasattr(head, 'build_shortlist')
+        if extreme:
+            # Weights change between evaluations, so the label tree is rebuilt every time
+            head.build_shortlist(self.shortlist_leaf_size or None)
+
+        padding = pad_index(self.data_loader.dataset) if self.shape_buckets is not None else 0
         for batch_idx, batch in enumerate(self.data_loader):
+            if self.shape_buckets is not None:
+                self.shape_buckets.pad_batch(batch, padding)
+            # Examples of deduplicated shards count as many times as they occur in the split, padding rows weigh zero
+            weights = getattr(batch, 'weight', None)
+            if extreme:
+                # Only the labels of the shortlisted leaves are scored, the highest scoring one is predicted
+                hidden = self.model.encode(batch.text if self.ignore_lengths else batch.text[0])
+                top_scores, top_labels = head.topk(hidden, self.top_k, self.shortlist_beam)
+                counts.update(ConfusionCounts.one_hot(top_labels[:, 0], batch.label.size(1)), batch.label, weights)
+                ranking.update(top_labels, batch.label, weights, top_scores)
+                if head.num_sampled:
+                    loss = head.sampled_loss(hidden, batch.label)[0]
+                else:
+                    loss = F.binary_cross_entropy_with_logits(head(hidden), batch.label.float(), reduce=False).sum(dim=1)
+                total_loss += (loss * weights.float() if weights is not None else loss).sum().detach()
+                continue
+
             if hasattr(self.model, 'tar') and self.model.tar:
                 if self.ignore_lengths:
                     scores, rnn_outs = self.model(batch.text)
@@ -36,38 +69,42 @@ class ClassificationEvaluator(Evaluator):
                 else:
                     scores = self.model(batch.text[0], lengths=batch.text[1])
 
+            if ranking is not None:
+                # Only the top-k labels of each example are kept
+                top_scores, top_labels = torch.topk(scores, min(self.top_k, scores.size(1)), dim=1)
+                ranking.update(top_labels, batch.label, weights, top_scores)
             if self.is_multilabel:
-                scores_rounded = F.softmax(scores)
-                predicted_labels.extend(scores_rounded.cpu().detach().numpy())
-                target_labels.extend(batch.label.cpu().detach().numpy())
-                total_loss += F.binary_cross_entropy_with_logits(scores, batch.label.float(), size_average=False).item()
+                # The highest scoring label is predicted
+                counts.update(ConfusionCounts.one_hot(torch.argmax(scores, dim=1), scores.size(1)), batch.label,
+                              weights)
+                loss = F.binary_cross_entropy_with_logits(scores, batch.label.float(), reduce=False).sum(dim=1)
             else:
-                predicted_labels.extend(torch.argmax(scores, dim=1).cpu().detach().numpy())
-                target_labels.extend(torch.argmax(batch.label, dim=1).cpu().detach().numpy())
-                total_loss += F.cross_entropy(scores, torch.argmax(batch.label, dim=1), size_average=False).item()
+                counts.update_indices(torch.argmax(scores, dim=1), torch.argmax(batch.label, dim=1), scores.size(1),
+                                      weights)
+                loss = F.cross_entropy(scores, torch.argmax(batch.label, dim=1), reduce=False)
+            total_loss += (loss * weights.float() if weights is not None else loss).sum().detach()
 
             if hasattr(self.model, 'tar') and self.model.tar:
-                # Temporal activation regularization
-                total_loss += (rnn_outs[1:] - rnn_outs[:-1]).pow(2).mean()
+                # Temporal activation regularization, without the padding steps and rows
+                if hasattr(batch, 'unpadded_size'):
+                    rnn_outs = rnn_outs[:batch.unpadded_size[1], :batch.unpadded_size[0]]
+                total_loss += (rnn_outs[1:] - rnn_outs[:-1]).pow(2).mean().detach()
 
-        if self.is_multilabel:
+        if self.is_multilabel or counts.num_classes > 2:
             score_method = 'weighted'
-            pos_label = None
         else:
             score_method = 'binary'
-            pos_label = 1
 
-        predicted_labels = np.array(predicted_labels)
-        predicted_labels = (predicted_labels == predicted_labels.max(axis=1, keepdims=True)).astype(int)
+        accuracy, precision, recall, f1 = counts.compute(score_method, pos_label=1)
+        avg_loss = float(total_loss) / float(counts.n_total)
 
-        target_labels = np.array(target_labels)
-        accuracy = metrics.accuracy_score(target_labels, predicted_labels)
-        precision = metrics.precision_score(target_labels, predicted_labels, average=score_method, pos_label=pos_label)
-        recall = metrics.recall_score(target_labels, predicted_labels, average=score_method, pos_label=pos_label)
-        f1 = metrics.f1_score(target_labels, predicted_labels, average=score_method, pos_label=pos_label)
-        avg_loss = total_loss / len(self.data_loader.dataset.examples)
-
-        print(metrics.classification_report(target_labels, predicted_labels, digits=3))
+        if extreme:
+            # Per-label rows are not printed for extreme label sets
+            print(ranking.report())
+        else:
+            print(counts.report(digits=3))
+            if ranking is not None:
+                print(ranking.report())
 
         if hasattr(self.model, 'beta_ema') and self.model.beta_ema > 0:
             # Temporal averaging
@@ -4,12 +4,11 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 from sklearn import metrics
-from torch.utils.data import TensorDataset, SequentialSampler, DataLoader
+from torch.utils.data import SequentialSampler, DataLoader
 from tqdm import tqdm
 
 from common.evaluators.evaluator import Evaluator
 from datasets.bert_processors.robust45_processor import convert_examples_to_features
-from utils.preprocessing import pad_input_matrix
 from utils.tokenization import BertTokenizer
 
 # Suppress warnings from sklearn.metrics
@@ -52,29 +51,15 @@ class RelevanceTransferEvaluator(Evaluator):
                 self.config['is_hierarchical']
             )
 
-            unpadded_input_ids = [f.input_ids for f in eval_features]
-            unpadded_input_mask = [f.input_mask for f in eval_features]
-            unpadded_segment_ids = [f.segment_ids for f in eval_features]
-
-            if self.config['is_hierarchical']:
-                pad_input_matrix(unpadded_input_ids, self.config['max_doc_length'])
-                pad_input_matrix(unpadded_input_mask, self.config['max_doc_length'])
-                pad_input_matrix(unpadded_segment_ids, self.config['max_doc_length'])
-
-            padded_input_ids = torch.tensor(unpadded_input_ids, dtype=torch.long)
-            padded_input_mask = torch.tensor(unpadded_input_mask, dtype=torch.long)
-            padded_segment_ids = torch.tensor(unpadded_segment_ids, dtype=torch.long)
-            label_ids = torch.tensor([f.label_id for f in eval_features], dtype=torch.long)
-            document_ids = torch.tensor([f.guid for f in eval_features], dtype=torch.long)
-
-            eval_data = TensorDataset(padded_input_ids, padded_input_mask, padded_segment_ids, label_ids, document_ids)
+            eval_data = eval_features.tensor_dataset(
+                self.config['max_doc_length'] if self.config['is_hierarchical'] else None, with_guids=True)
             eval_sampler = SequentialSampler(eval_data)
             eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=self.config['batch_size'])
 
             for input_ids, input_mask, segment_ids, label_ids, document_ids in tqdm(eval_dataloader, desc="Evaluating", disable=silent):
-                input_ids = input_ids.to(self.config['device'])
-                input_mask = input_mask.to(self.config['device'])
-                segment_ids = segment_ids.to(self.config['device'])
+                input_ids = input_ids.to(self.config['device']).long()
+                input_mask = input_mask.to(self.config['device']).long()
+                segment_ids = segment_ids.to(self.config['device']).long()
                 label_ids = label_ids.to(self.config['device'])
 
                 with torch.no_grad():
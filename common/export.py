@@ -0,0 +1,254 @@
+import inspect
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from common.predict import get_args as get_predict_args, build_predictor, read_records
+
+# Names of the positional inputs of each model family, in the order of the encoder's collate
+INPUT_NAMES = {
+    'BERT': ['input_ids', 'token_type_ids', 'attention_mask'],
+    'HBERT': ['input_ids', 'segment_ids', 'input_mask'],
+    'RegLSTM': ['text', 'lengths'],
+}
+
+FORMATS = ['torchscript', 'onnx']
+
+
+def input_names(model_family, num_inputs):
+    names = INPUT_NAMES.get(model_family, ['text'])
+    return names[:num_inputs]
+
+
+def dynamic_axes(model_family, inputs):
+    """
+    Returns the axes of the inputs and the logits that vary between batches
+    :param model_family: one of common.predict.MODEL_FAMILIES
+    :param inputs: example inputs, in the order of input_names
+    :return: dict of axis names by axis index, for every input name and 'logits'
+    """
+    axes = dict()
+    for name, value in zip(input_names(model_family, len(inputs)), inputs):
+        if model_family == 'CharCNN' or value.dim() == 1:
+            # Character quantized documents are fixed size arrays
+            axes[name] = {0: 'batch'}
+        elif value.dim() == 3:
+            axes[name] = {0: 'batch', 1: 'sentences', 2: 'sequence'}
+        else:
+            axes[name] = {0: 'batch', 1: 'sequence'}
+    axes['logits'] = {0: 'batch'}
+    return axes
+
+
+class ExportedModel(nn.Module):
+    """
+    Calls a model with positional inputs only and returns its logits, dropping the RNN outputs returned by models
+    trained with temporal activation regularization and the window scores of long document models.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, *inputs):
+        logits = self.model(*inputs)
+        if isinstance(logits, tuple):
+            logits = logits[0]
+        return logits
+
+
+def export_torchscript(module, inputs, path):
+    """
+    Traces a module with example inputs and saves the TorchScript module
+    :param module: ExportedModel in evaluation mode
+    :param inputs: tuple of example inputs
+    :param path: output file
+    :return: traced module
+    """
+    if not hasattr(torch.jit, 'save'):
+        raise RuntimeError('TorchScript export requires PyTorch 1.0 or later')
+    with torch.no_grad():
+        traced = torch.jit.trace(module, inputs)
+    traced.save(path)
+    return torch.jit.load(path)
+
+
+def export_onnx(module, inputs, path, model_family, opset=None):
+    """
+    Exports a module to ONNX, with the batch and sequence axes of its inputs left dynamic
+    :param module: ExportedModel in evaluation mode
+    :param inputs: tuple of example inputs
+    :param path: output file
+    :param model_family: one of common.predict.MODEL_FAMILIES
+    :param opset: ONNX opset version, None for the default of the installed PyTorch
+    """
+    kwargs = {'opset_version': opset} if opset is not None else {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # Newer PyTorch versions default to an exporter that takes dynamic_shapes instead of dynamic_axes
+        kwargs['dynamo'] = False
+    with torch.no_grad():
+        torch.onnx.export(module, inputs, path, input_names=input_names(model_family, len(inputs)),
+                          output_names=['logits'], dynamic_axes=dynamic_axes(model_family, inputs), **kwargs)
+
+
+def onnx_session(path, num_threads=None):
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImportError('Validating and benchmarking ONNX models requires onnxruntime, install it with '
+                          '"pip install onnxruntime" or pass --formats torchscript')
+    options = onnxruntime.SessionOptions()
+    if num_threads:
+        options.intra_op_num_threads = num_threads
+    return onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+
+def onnx_runner(session, model_family, inputs):
+    """
+    Returns a function running an ONNX Runtime session on the given inputs
+    :param session: onnxruntime InferenceSession
+    :param model_family: one of common.predict.MODEL_FAMILIES
+    :param inputs: tuple of input tensors
+    :return: function returning the logits as a numpy array
+    """
+    # Constant inputs, such as the lengths of models traced without them, are folded into the graph
+    graph_inputs = {graph_input.name for graph_input in session.get_inputs()}
+    feed = {name: value.numpy() for name, value in zip(input_names(model_family, len(inputs)), inputs)
+            if name in graph_inputs}
+    return lambda: session.run(['logits'], feed)[0]
+
+
+def benchmark(run, iterations, warmup=3):
+    """
+    Times a function
+    :param run: function to time
+    :param iterations: number of timed calls
+    :param warmup: number of calls before timing
+    :return: mean latency in milliseconds
+    """
+    for _ in range(warmup):
+        run()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        run()
+    return (time.perf_counter() - start) * 1000 / iterations
+
+
+def encode_batch(predictor, texts):
+    """
+    Encodes documents into the positional inputs of the model of a predictor
+    :param predictor: Predictor
+    :param texts: list of strings
+    :return: tuple of input tensors
+    """
+    inputs, kwargs, _ = predictor.encoder.collate([predictor.encoder.encode(text) for text in texts])
+    # Keyword inputs the model takes as named arguments, such as the lengths of RegLSTM, follow the positional
+    # ones. Models that swallow them in **kwargs, such as KimCNN, are exported without them.
+    parameters = inspect.signature(predictor.model.forward).parameters
+    return tuple(inputs) + tuple(value for key, value in kwargs.items()
+                                 if key in parameters and parameters[key].kind != inspect.Parameter.VAR_KEYWORD)
+
+
+def export(predictor, texts, args):
+    """
+    Exports the model of a predictor to each of args.formats, checks that the exported models agree with the
+    eager model on a batch of a different shape than the one they were traced with, and times them on the CPU
+    :param predictor: Predictor with its model on the CPU
+    :param texts: sample documents, the first two are used for tracing and up to args.batch_size for validation
+    :param args: command line arguments, see get_args
+    :return: dict of results by format
+    """
+    if len(texts) < 2:
+        raise ValueError('At least two sample documents are needed, got {}'.format(len(texts)))
+    module = ExportedModel(predictor.model).eval()
+    example = encode_batch(predictor, texts[:2])
+    inputs = encode_batch(predictor, texts[:args.batch_size])
+    if len(texts) == 2:
+        print('Warning: with only two sample documents, the exported models are validated on the batch they '
+              'were traced with', file=sys.stderr)
+
+    with torch.no_grad():
+        expected = module(*inputs).numpy()
+        eager_ms = benchmark(lambda: module(*inputs), args.iterations)
+    results = {'eager': {'latency_ms': eager_ms, 'batch_size': int(expected.shape[0])}}
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for export_format in args.formats:
+        path = os.path.join(args.output_dir, args.name + ('.pt' if export_format == 'torchscript' else '.onnx'))
+        try:
+            if export_format == 'torchscript':
+                traced = export_torchscript(module, example, path)
+                with torch.no_grad():
+                    run = lambda: traced(*inputs)
+                    actual = run().numpy()
+                    latency_ms = benchmark(run, args.iterations)
+            else:
+                export_onnx(module, example, path, args.model_family, args.opset)
+                run = onnx_runner(onnx_session(path, args.threads), args.model_family, inputs)
+                actual = run()
+                latency_ms = benchmark(run, args.iterations)
+        except ImportError:
+            raise
+        except Exception as e:
+            # Some models use operators without an exporter, e.g. adaptive pooling over dynamic lengths
+            results[export_format] = {'path': path, 'error': '{}: {}'.format(type(e).__name__, e)}
+            continue
+
+        max_diff = float(np.abs(actual - expected).max()) if actual.shape == expected.shape else float('inf')
+        results[export_format] = {
+            'path': path,
+            'max_abs_diff': max_diff,
+            'same_top_labels': bool(actual.shape == expected.shape and
+                                    (actual.argmax(axis=1) == expected.argmax(axis=1)).all()),
+            'parity': max_diff <= args.tolerance,
+            'latency_ms': latency_ms,
+            'speedup': eager_ms / latency_ms
+        }
+    return results
+
+
+def get_args():
+    parser = get_predict_args()
+    parser.description = "Export a trained model to TorchScript and ONNX"
+    parser.set_defaults(cuda=False, batch_size=8)
+    parser.add_argument('--output-dir', type=str, default='exported')
+    parser.add_argument('--name', type=str, default=None,
+                        help='file name of the exported models, defaults to the name of the snapshot')
+    parser.add_argument('--formats', nargs='+', default=FORMATS, choices=FORMATS)
+    parser.add_argument('--opset', type=int, default=None, help='ONNX opset version')
+    parser.add_argument('--tolerance', type=float, default=1e-4,
+                        help='largest absolute difference between the eager and exported logits')
+    parser.add_argument('--iterations', type=int, default=20, help='number of timed batches of the benchmark')
+    parser.add_argument('--threads', type=int, default=None, help='number of CPU threads of the benchmark')
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_args().parse_args()
+    args.name = args.name or os.path.splitext(os.path.basename(args.snapshot))[0]
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    # Exported models are validated and benchmarked on the CPU, where ONNX Runtime runs
+    predictor = build_predictor(args, torch.device('cpu'))
+
+    input_file = sys.stdin if args.input == '-' else open(args.input, 'r', encoding='utf-8')
+    try:
+        texts = [text for _, text in read_records(input_file, args.input_format)]
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+
+    results = export(predictor, texts, args)
+    output = json.dumps(results, indent=2)
+    print(output)
+    with open(os.path.join(args.output_dir, args.name + '.json'), 'w') as f:
+        f.write(output + '\n')
+    failed = [key for key, result in results.items() if 'error' in result or not result.get('parity', True)]
+    if failed:
+        print('Export or parity check failed for: {}'.format(', '.join(failed)), file=sys.stderr)
+        sys.exit(1)
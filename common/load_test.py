@@ -0,0 +1,87 @@
+import asyncio
+import json
+import random
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+
+async def _request(reader, writer, host, method, path, payload=None):
+    body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+    writer.write('{} {} HTTP/1.1\r\nHost: {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'
+                 .format(method, path, host, len(body)).encode('latin-1') + body)
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        if key.strip().lower() == 'content-length':
+            length = int(value)
+    return status, json.loads((await reader.readexactly(length)).decode('utf-8'))
+
+
+async def _client(host, port, texts, num_requests, latencies, errors):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for _ in range(num_requests):
+            start = time.time()
+            status, _ = await _request(reader, writer, host, 'POST', '/predict', {'text': random.choice(texts)})
+            latencies.append(time.time() - start)
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def load_test(host, port, texts, num_requests=1000, concurrency=32):
+    """
+    Sends single document requests to an inference server from concurrent keep-alive connections
+    :param host: server address
+    :param port: server port
+    :param texts: documents to sample requests from
+    :param num_requests: total number of requests
+    :param concurrency: number of concurrent connections
+    :return: client side statistics and the statistics reported by the server
+    """
+    latencies, errors = list(), list()
+    start = time.time()
+    per_client = [num_requests // concurrency + (1 if i < num_requests % concurrency else 0)
+                  for i in range(concurrency)]
+    await asyncio.gather(*[_client(host, port, texts, n, latencies, errors) for n in per_client if n])
+    elapsed = time.time() - start
+
+    reader, writer = await asyncio.open_connection(host, port)
+    _, server_stats = await _request(reader, writer, host, 'GET', '/stats')
+    writer.close()
+
+    p50, p99 = np.percentile(np.array(latencies) * 1000, [50, 99])
+    client_stats = {'requests': len(latencies), 'errors': len(errors), 'requests_per_second': len(latencies) / elapsed,
+                    'latency_ms': {'p50': float(p50), 'p99': float(p99)}}
+    return client_stats, server_stats
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Load test an inference server started with common.serve")
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--input', type=str, default=None, help='file with one document per line')
+    args = parser.parse_args()
+
+    if args.input:
+        with open(args.input, 'r', encoding='utf-8') as f:
+            texts = [line.strip() for line in f if line.strip()]
+    else:
+        texts = ['the quick brown fox jumps over the lazy dog ' * random.randint(1, 20) for _ in range(100)]
+
+    loop = asyncio.get_event_loop()
+    client_stats, server_stats = loop.run_until_complete(
+        load_test(args.host, args.port, texts, num_requests=args.requests, concurrency=args.concurrency))
+    print('Client:', json.dumps(client_stats, indent=2))
+    print('Server:', json.dumps(server_stats, indent=2))
@@ -0,0 +1,336 @@
+import numpy as np
+import torch
+
+
+def weighted_mean(values, weights=None):
+    """
+    Averages per-example values, counting every example as many times as its weight
+    :param values: tensor of shape (batch_size,)
+    :param weights: multiplicity of each example, or None for a plain mean
+    :return: scalar tensor
+    """
+    if weights is None:
+        return values.mean()
+    weights = weights.to(values.dtype)
+    return (values * weights).sum() / weights.sum()
+
+
+class RunningMetrics(object):
+    """
+    Accumulates the loss and accuracy of training batches on the device the batches live on. Updates only
+    queue tensor operations, so the host waits for the device only when the metrics are read.
+    """
+
+    def __init__(self):
+        self.loss_sum = None
+        self.n_correct = None
+        self.n_total = 0
+
+    def reset(self):
+        self.loss_sum = None
+        self.n_correct = None
+        self.n_total = 0
+
+    def update(self, loss, predictions, targets, weights=None):
+        """
+        Adds a batch to the running metrics
+        :param loss: mean loss of the batch
+        :param predictions: predicted class indices of shape (batch_size,) or, for multi-label
+        classification, predicted label indicators of shape (batch_size, num_labels)
+        :param targets: target labels of the same shape as predictions
+        :param weights: multiplicity of each example of deduplicated data, the loss is then its weighted mean
+        """
+        batch_size = targets.size(0) if weights is None else weights.sum()
+        if predictions.dim() > 1:
+            # Multi-label predictions count as correct only if every label matches
+            correct = (predictions != targets).long().sum(dim=1) == 0
+        else:
+            correct = predictions == targets
+        if self.loss_sum is None:
+            self.loss_sum = torch.zeros(1, dtype=torch.float, device=targets.device)
+            self.n_correct = torch.zeros(1, dtype=torch.long, device=targets.device)
+        if weights is not None:
+            correct = correct.long() * weights.long()
+        self.loss_sum += loss.detach().float() * batch_size
+        self.n_correct += correct.long().sum()
+        self.n_total += batch_size
+
+    def read(self):
+        """
+        Copies the metrics to the host
+        :return: mean loss and accuracy in percent over the batches seen since the last reset
+        """
+        if not self.n_total:
+            return 0.0, 0.0
+        loss_sum, n_correct = torch.cat([self.loss_sum, self.n_correct.float()]).tolist()
+        n_total = float(self.n_total)
+        return loss_sum / n_total, 100. * n_correct / n_total
+
+
+class ConfusionCounts(object):
+    """
+    Accumulates per-class true positive, false positive and false negative counts on the device batch by batch.
+    Accuracy, precision, recall and F1 are computed from the counts when the evaluation is done, matching the
+    values sklearn returns for the same predictions: class indices for counts added by update_indices, and label
+    indicators for counts added by update.
+    """
+
+    def __init__(self):
+        self.single_label = False
+        self.tp = None
+        self.fp = None
+        self.fn = None
+        self.n_exact = None
+        self.n_total = 0
+
+    @property
+    def num_classes(self):
+        return 0 if self.tp is None else len(self.tp)
+
+    @staticmethod
+    def one_hot(indices, num_classes):
+        return torch.zeros(indices.size(0), num_classes, dtype=torch.uint8, device=indices.device) \
+            .scatter_(1, indices.unsqueeze(1), 1)
+
+    def update(self, predictions, targets, weights=None):
+        """
+        Adds a batch of predictions to the counts
+        :param predictions: predicted label indicators of shape (batch_size, num_classes)
+        :param targets: target label indicators of the same shape
+        :param weights: multiplicity of each example of deduplicated data
+        """
+        predictions, targets = predictions.byte(), targets.byte()
+        # Every example is counted as many times as its weight
+        w = 1 if weights is None else weights.long().unsqueeze(1)
+        if self.tp is None:
+            num_classes = targets.size(1)
+            self.tp = torch.zeros(num_classes, dtype=torch.long, device=targets.device)
+            self.fp = torch.zeros(num_classes, dtype=torch.long, device=targets.device)
+            self.fn = torch.zeros(num_classes, dtype=torch.long, device=targets.device)
+            self.n_exact = torch.zeros(1, dtype=torch.long, device=targets.device)
+        self.tp += ((predictions & targets).long() * w).sum(dim=0)
+        self.fp += ((predictions & (1 - targets)).long() * w).sum(dim=0)
+        self.fn += (((1 - predictions) & targets).long() * w).sum(dim=0)
+        exact = ((predictions != targets).long().sum(dim=1, keepdim=True) == 0).long()
+        self.n_exact += (exact * w).sum()
+        self.n_total += targets.size(0) if weights is None else weights.sum()
+
+    def update_indices(self, predictions, targets, num_classes, weights=None):
+        """
+        Adds a batch of single-label predictions to the counts
+        :param predictions: predicted class indices of shape (batch_size,)
+        :param targets: target class indices of shape (batch_size,)
+        :param num_classes: number of classes
+        :param weights: multiplicity of each example of deduplicated data
+        """
+        self.single_label = True
+        self.update(self.one_hot(predictions, num_classes), self.one_hot(targets, num_classes), weights)
+
+    def _host_counts(self):
+        # A single copy from the device for all counts
+        counts = torch.cat([self.tp, self.fp, self.fn, self.n_exact]).cpu().numpy()
+        num_classes = len(self.tp)
+        return counts[:num_classes], counts[num_classes:2 * num_classes], counts[2 * num_classes:3 * num_classes], \
+            int(counts[-1])
+
+    @staticmethod
+    def _divide(numerator, denominator):
+        # Ill-defined ratios are set to zero, as sklearn does
+        numerator, denominator = np.asarray(numerator, dtype=np.float64), np.asarray(denominator, dtype=np.float64)
+        result = np.zeros_like(numerator)
+        np.divide(numerator, denominator, out=result, where=denominator != 0)
+        return result
+
+    def per_class(self):
+        """
+        :return: precision, recall, F1 and support of every class as numpy arrays
+        """
+        tp, fp, fn, _ = self._host_counts()
+        precision = self._divide(tp, tp + fp)
+        recall = self._divide(tp, tp + fn)
+        f1 = self._divide(2 * precision * recall, precision + recall)
+        return precision, recall, f1, tp + fn
+
+    def compute(self, average='weighted', pos_label=1):
+        """
+        Computes the metrics from the accumulated counts
+        :param average: 'binary', 'micro', 'macro' or 'weighted', as in sklearn
+        :param pos_label: class reported for binary averaging
+        :return: accuracy, precision, recall and F1
+        """
+        if not self.n_total:
+            return 0.0, 0.0, 0.0, 0.0
+        tp, fp, fn, n_exact = self._host_counts()
+        accuracy = n_exact / float(self.n_total)
+
+        if average == 'micro':
+            precision = float(self._divide(tp.sum(), tp.sum() + fp.sum()))
+            recall = float(self._divide(tp.sum(), tp.sum() + fn.sum()))
+            f1 = float(self._divide(2 * precision * recall, precision + recall))
+            return accuracy, precision, recall, f1
+
+        precision, recall, f1, support = self.per_class()
+        if average == 'binary':
+            return accuracy, float(precision[pos_label]), float(recall[pos_label]), float(f1[pos_label])
+        if average == 'weighted':
+            weights = support
+        elif self.single_label:
+            # sklearn averages class indices over the classes that are predicted or targets, and label indicators
+            # over every label
+            weights = ((tp + fp + fn) > 0).astype(np.int64)
+        else:
+            weights = np.ones_like(support)
+        if not weights.sum():
+            return accuracy, 0.0, 0.0, 0.0
+        return (accuracy,) + tuple(float(np.average(x, weights=weights)) for x in (precision, recall, f1))
+
+    def report(self, digits=3):
+        """
+        Formats the per-class and averaged metrics like sklearn's classification_report
+        :param digits: number of digits for the metrics
+        :return: report string
+        """
+        precision, recall, f1, support = self.per_class()
+        row = '{:>12} ' + ' '.join(['{:>9.%df}' % digits] * 3) + ' {:>9}\n'
+        report = '{:>12} {:>9} {:>9} {:>9} {:>9}\n\n'.format('', 'precision', 'recall', 'f1-score', 'support')
+        for label in range(len(support)):
+            report += row.format(label, precision[label], recall[label], f1[label], support[label])
+        report += '\n'
+        for average in ('micro', 'macro', 'weighted'):
+            report += row.format(average + ' avg', *self.compute(average)[1:], support.sum())
+        return report
+
+
+def to_csr(indicators):
+    """
+    Converts a batch of label indicators to a CSR matrix on the same device
+    :param indicators: label indicators of shape (batch_size, num_labels)
+    :return: row pointers of shape (batch_size + 1,) and the column indices of the labels of each row
+    """
+    # nonzero returns the positions in row-major order, so the columns of each row are contiguous
+    positions = indicators.nonzero()
+    counts = torch.zeros(indicators.size(0), dtype=torch.long, device=indicators.device)
+    if positions.numel():
+        counts.index_add_(0, positions[:, 0], torch.ones_like(positions[:, 0]))
+    indptr = torch.cat([torch.zeros(1, dtype=torch.long, device=indicators.device), torch.cumsum(counts, dim=0)])
+    return indptr, positions[:, 1] if positions.numel() else positions.new_zeros(0)
+
+
+def csr_hits(top_labels, indptr, indices):
+    """
+    Checks which predicted labels are target labels of their example
+    :param top_labels: predicted label indices of shape (batch_size, k)
+    :param indptr: row pointers of the CSR target matrix
+    :param indices: column indices of the CSR target matrix
+    :return: float tensor of shape (batch_size, k), 1 where the label is a target
+    """
+    batch_size, k = top_labels.size()
+    num_labels = int(max(int(top_labels.max()) if top_labels.numel() else 0,
+                         int(indices.max()) if indices.numel() else 0)) + 1
+    rows = torch.arange(batch_size, dtype=torch.long, device=top_labels.device)
+    # Row of every stored label: the number of row starts up to its position, not counting the first row
+    starts = indptr[1:-1]
+    starts = starts[starts < indices.numel()]
+    target_rows = torch.zeros(indices.numel(), dtype=torch.long, device=indices.device)
+    if starts.numel():
+        target_rows.index_add_(0, starts, torch.ones_like(starts))
+    target_keys = torch.cumsum(target_rows, dim=0) * num_labels + indices
+    predicted_keys = (rows.unsqueeze(1) * num_labels + top_labels).view(-1)
+    # Labels are distinct within a row, so a key occurs twice exactly when a predicted label is a target
+    keys, order = torch.sort(torch.cat([target_keys, predicted_keys]))
+    hits = torch.zeros(predicted_keys.numel(), device=top_labels.device)
+    duplicate = (keys[1:] == keys[:-1]).nonzero().view(-1)
+    if duplicate.numel():
+        positions = torch.max(order[duplicate], order[duplicate + 1]) - target_keys.numel()
+        hits[positions] = 1
+    return hits.view(batch_size, k)
+
+
+class RankingMetrics(object):
+    """
+    Accumulates ranking and thresholded metrics of top-k label predictions on the device: precision@k, recall@k
+    and nDCG@k for several cutoffs up to k, and the micro-averaged precision, recall and F1 of the labels among
+    the top k whose probability reaches a threshold. Only the top-k labels of each example are needed, and targets
+    can be given as a CSR matrix, so memory grows with the number of predicted and target labels rather than with
+    the number of labels. Examples without any target label count as zero for every ranking metric, as is usual
+    for extreme multi-label benchmarks.
+    """
+
+    def __init__(self, k=5, threshold=0.5):
+        """
+        :param k: number of labels ranked per example, metrics are reported at 1, 3, 5 and k up to k
+        :param threshold: probability above which a label among the top k is predicted
+        """
+        self.k = k
+        self.threshold = threshold
+        self.cutoffs = sorted({c for c in (1, 3, 5, k) if c <= k})
+        self.sums = None
+        self.n_total = 0
+
+    def update(self, top_labels, targets, weights=None, top_scores=None):
+        """
+        Adds a batch of rankings to the metrics
+        :param top_labels: indices of the highest scoring labels in decreasing order, of shape (batch_size, k)
+        :param targets: target label indicators of shape (batch_size, num_labels), or a CSR matrix given as a
+        tuple of row pointers and column indices
+        :param weights: multiplicity of each example of deduplicated data
+        :param top_scores: logits of the top labels, needed for the thresholded metrics
+        """
+        top_labels = top_labels[:, :self.k]
+        if isinstance(targets, tuple):
+            indptr, indices = targets
+            hits = csr_hits(top_labels, indptr, indices)
+            num_targets = indptr[1:] - indptr[:-1]
+        else:
+            hits = targets.gather(1, top_labels).float()
+            num_targets = targets.long().sum(dim=1)
+        ranks = torch.arange(hits.size(1), dtype=torch.float, device=hits.device)
+        discounts = 1. / torch.log2(ranks + 2)
+        ideal = torch.cat([torch.zeros(1, device=hits.device), torch.cumsum(discounts, dim=0)])
+
+        metrics = list()
+        for cutoff in self.cutoffs:
+            num_hits = hits[:, :cutoff].sum(dim=1)
+            metrics.append(num_hits / cutoff)
+            metrics.append(num_hits / num_targets.float().clamp(min=1))
+            dcg = (hits[:, :cutoff] * discounts[:cutoff]).sum(dim=1)
+            idcg = ideal[num_targets.clamp(max=min(cutoff, hits.size(1)))]
+            metrics.append(dcg / idcg.clamp(min=1e-12))
+        if top_scores is not None:
+            # Micro-averaged counts: true positives, predicted labels and target labels
+            predicted = (torch.sigmoid(top_scores[:, :self.k].float()) >= self.threshold).float()
+            metrics.extend([(hits * predicted).sum(dim=1), predicted.sum(dim=1), num_targets.float()])
+        metrics = torch.stack(metrics, dim=1)
+        if weights is not None:
+            metrics = metrics * weights.float().unsqueeze(1)
+
+        if self.sums is None:
+            self.sums = torch.zeros(metrics.size(1), dtype=torch.float, device=metrics.device)
+        self.sums += metrics.sum(dim=0)
+        self.n_total += top_labels.size(0) if weights is None else weights.sum()
+
+    def compute(self):
+        """
+        :return: dict of the mean precision@k, recall@k and nDCG@k over the examples seen, and of the thresholded
+        micro-averaged precision, recall and F1 if scores were given
+        """
+        if not self.n_total:
+            return dict()
+        sums = self.sums.tolist()
+        names = [name % cutoff for cutoff in self.cutoffs for name in ('P@%d', 'R@%d', 'nDCG@%d')]
+        metrics = dict(zip(names, [value / float(self.n_total) for value in sums[:len(names)]]))
+        if len(sums) > len(names):
+            tp, n_predicted, n_targets = sums[len(names):]
+            precision = tp / n_predicted if n_predicted else 0.0
+            recall = tp / n_targets if n_targets else 0.0
+            f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+            for name, value in (('P', precision), ('R', recall), ('F1', f1)):
+                metrics['{}@>={:g}'.format(name, self.threshold)] = value
+        return metrics
+
+    @staticmethod
+    def format(metrics, digits=4):
+        return '  '.join(('{}: {:.%df}' % digits).format(name, value) for name, value in metrics.items())
+
+    def report(self, digits=4):
+        return self.format(self.compute(), digits)
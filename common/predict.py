@@ -0,0 +1,371 @@
+import importlib
+import json
+import os
+import queue
+import sys
+import threading
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from datasets import shards
+from utils.preprocessing import length_mask, offsets_from_lengths, pack_sequences, pad_documents
+from utils.vectors import load_vectors
+from utils.vocab import HashedStoi, LazyVocabExtender, PrunedVocab, pretrained_embeddings
+
+MODEL_FAMILIES = ['BERT', 'HBERT', 'KimCNN', 'XML-CNN', 'RegLSTM', 'HAN', 'CharCNN']
+
+# Dataset modules and class names for the models trained on torchtext datasets
+DATASETS = {
+    'Reuters': ('datasets.reuters', 'Reuters'),
+    'AAPD': ('datasets.aapd', 'AAPD'),
+    'IMDB': ('datasets.imdb', 'IMDB'),
+    'Yelp2014': ('datasets.yelp2014', 'Yelp2014'),
+    'SST-2': ('datasets.sst', 'SST'),
+    'LyricsGenre': ('datasets.lyricsGenre', 'LyricsGenre'),
+    'LyricsArtist': ('datasets.lyricsArtist', 'LyricsArtist'),
+    'Robust04': ('datasets.robust04', 'Robust04'),
+    'Robust05': ('datasets.robust05', 'Robust05'),
+    'Robust45': ('datasets.robust45', 'Robust45')
+}
+
+# Models that are called without sequence lengths, as their trainers set ignore_lengths
+IGNORE_LENGTHS = {'HAN', 'CharCNN'}
+
+
+def get_dataset_class(dataset, model_family):
+    """
+    Returns the torchtext dataset class whose TEXT_FIELD a model was trained with
+    :param dataset: dataset name
+    :param model_family: one of MODEL_FAMILIES
+    :return: dataset class
+    """
+    module_name, class_name = DATASETS[dataset]
+    suffix = {'HAN': 'Hierarchical', 'CharCNN': 'CharQuantized'}.get(model_family, '')
+    return getattr(importlib.import_module(module_name), class_name + suffix)
+
+
+def load_model(snapshot_path, device):
+    """
+    Loads a model saved with torch.save by one of the trainers
+    :param snapshot_path: path to the snapshot
+    :param device: device to move the model to
+    :return: model in evaluation mode
+    """
+    model = torch.load(snapshot_path, map_location=lambda storage, location: storage)
+    # Unwrap models saved from DataParallel or DistributedDataParallel
+    model = getattr(model, 'module', model)
+    return model.to(device).eval()
+
+
+class BertEncoder(object):
+    """
+    Turns documents into WordPiece ids for BERT, or into one row of WordPiece ids per sentence for HBERT.
+    """
+
+    def __init__(self, tokenizer, max_seq_length, is_hierarchical=False, max_doc_length=None):
+        self.tokenizer = tokenizer
+        self.max_seq_length = max_seq_length
+        self.is_hierarchical = is_hierarchical
+        self.max_doc_length = max_doc_length
+
+    def encode(self, text):
+        if self.is_hierarchical:
+            from nltk.tokenize import sent_tokenize
+            # Documents without sentences, such as whitespace, keep a single [CLS] [SEP] sentence
+            lines = [self.tokenizer.tokenize(line) for line in sent_tokenize(text)] or [[]]
+        else:
+            lines = [self.tokenizer.tokenize(text)]
+        # Account for [CLS] and [SEP]
+        tokens = [["[CLS]"] + line[:self.max_seq_length - 2] + ["[SEP]"] for line in lines]
+        return [self.tokenizer.convert_tokens_to_ids(line) for line in tokens]
+
+    @staticmethod
+    def length(encoded):
+        return sum(len(line) for line in encoded)
+
+    def collate(self, batch):
+        """
+        Pads a batch of encoded documents
+        :param batch: list of encoded documents
+        :return: positional model inputs, keyword model inputs and the order of the documents in the inputs
+        """
+        input_ids, lengths = pack_sequences([line for doc in batch for line in doc], self.max_seq_length)
+        if self.is_hierarchical:
+            num_sentences = [len(doc) for doc in batch]
+            doc_offsets = offsets_from_lengths(num_sentences)
+            max_doc_length = self.max_doc_length or max(num_sentences)
+            input_ids = pad_documents(input_ids, doc_offsets, max_doc_length)
+            lengths = pad_documents(lengths, doc_offsets, max_doc_length)
+        input_ids = torch.from_numpy(input_ids).long()
+        input_mask = torch.from_numpy(length_mask(lengths, self.max_seq_length)).long()
+        return (input_ids, torch.zeros_like(input_ids), input_mask), {}, None
+
+
+class FieldEncoder(object):
+    """
+    Turns documents into inputs for the models trained on torchtext datasets, using the TEXT_FIELD of the dataset
+    class for tokenization and the vocabulary saved by datasets.preprocess for numericalization.
+    """
+
+    def __init__(self, dataset_cls, vocab=None, ignore_lengths=False, extender=None):
+        """
+        :param dataset_cls: dataset class the model was trained on
+        :param vocab: vocabulary saved by datasets.preprocess, None for character quantized datasets
+        :param ignore_lengths: whether the model is called without sequence lengths
+        :param extender: LazyVocabExtender adding the vectors of new words to a pruned vocabulary and the model
+        """
+        self.field = dataset_cls.TEXT_FIELD
+        self.is_hierarchical = hasattr(self.field, 'nesting_field')
+        self.ignore_lengths = ignore_lengths
+        self.stoi = vocab.stoi if vocab is not None else None
+        self.pad_index = vocab.stoi['<pad>'] if vocab is not None else 0
+        self.extender = extender
+
+    def _numericalize(self, tokens):
+        if self.extender is not None:
+            self.extender.update(tokens)
+        if isinstance(self.stoi, HashedStoi):
+            # Out of vocabulary words of pruned vocabularies map to their hash bucket or <unk>
+            return [self.stoi[token] for token in tokens]
+        # Out of vocabulary words map to <unk>, like torchtext's default stoi does
+        return [self.stoi.get(token, 0) for token in tokens]
+
+    def encode(self, text):
+        preprocessed = self.field.preprocess(text)
+        if self.stoi is None:
+            # Character quantized documents are already fixed size arrays
+            return preprocessed
+        # Documents without tokens keep a single <pad> token, and a single sentence for hierarchical models, as
+        # packed sequences and the sentence encoders reject empty inputs
+        if self.is_hierarchical:
+            sentences = [self._numericalize(sentence) or [self.pad_index] for sentence in preprocessed]
+            return sentences or [[self.pad_index]]
+        return self._numericalize(preprocessed) or [self.pad_index]
+
+    def length(self, encoded):
+        if self.stoi is None:
+            return 0
+        if self.is_hierarchical:
+            return sum(len(sentence) for sentence in encoded)
+        return len(encoded)
+
+    def collate(self, batch):
+        """
+        Pads a batch of encoded documents
+        :param batch: list of encoded documents
+        :return: positional model inputs, keyword model inputs and the order of the documents in the inputs
+        """
+        if self.stoi is None:
+            return (torch.from_numpy(np.stack(batch)),), {}, None
+
+        if self.is_hierarchical:
+            sentences = [sentence for doc in batch for sentence in doc]
+            max_words = max([len(sentence) for sentence in sentences] + [1])
+            text, _ = pack_sequences(sentences, max_words, dtype=np.int64, pad_value=self.pad_index)
+            num_sentences = [len(doc) for doc in batch]
+            text = pad_documents(text, offsets_from_lengths(num_sentences), max(num_sentences + [1]),
+                                 pad_value=self.pad_index)
+            return (torch.from_numpy(text),), {}, None
+
+        # Sort by decreasing length, as packed sequences require
+        order = np.argsort([-len(doc) for doc in batch], kind='mergesort')
+        batch = [batch[i] for i in order]
+        text, lengths = pack_sequences(batch, max([len(doc) for doc in batch] + [1]), dtype=np.int64,
+                                       pad_value=self.pad_index)
+        if self.ignore_lengths:
+            return (torch.from_numpy(text),), {}, order
+        return (torch.from_numpy(text),), {'lengths': torch.from_numpy(lengths)}, order
+
+
+class Predictor(object):
+    """
+    Runs a trained model over raw documents and returns the top-k labels and scores of each document.
+    """
+
+    def __init__(self, model, encoder, device, is_multilabel=False, top_k=1):
+        self.model = model
+        self.encoder = encoder
+        self.device = device
+        self.is_multilabel = is_multilabel
+        self.top_k = top_k
+
+    def _to_device(self, value):
+        return value.to(self.device) if torch.is_tensor(value) else value
+
+    def scores(self, encoded):
+        """
+        Computes the label probabilities of a batch of encoded documents
+        :param encoded: list of documents returned by the encoder
+        :return: tensor of shape (len(encoded), num_labels) on the model device
+        """
+        inputs, kwargs, order = self.encoder.collate(encoded)
+        inputs = [self._to_device(x) for x in inputs]
+        kwargs = {key: self._to_device(value) for key, value in kwargs.items()}
+        with torch.no_grad():
+            logits = self.model(*inputs, **kwargs)
+            if isinstance(logits, tuple):
+                # Models trained with temporal activation regularization also return their RNN outputs
+                logits = logits[0]
+            scores = torch.sigmoid(logits) if self.is_multilabel else F.softmax(logits, dim=1)
+        if order is not None:
+            inverse = torch.from_numpy(np.argsort(order)).to(scores.device)
+            scores = scores[inverse]
+        return scores
+
+    def top_labels(self, scores):
+        """
+        :param scores: label probabilities of a batch
+        :return: list of (labels, scores) tuples, one per document
+        """
+        values, indices = scores.topk(min(self.top_k, scores.size(1)), dim=1)
+        return list(zip(indices.cpu().tolist(), values.cpu().tolist()))
+
+    def predict(self, texts):
+        """
+        Predicts the top-k labels of a list of documents
+        :param texts: list of strings
+        :return: list of (labels, scores) tuples
+        """
+        return self.top_labels(self.scores([self.encoder.encode(text) for text in texts]))
+
+    def stream(self, records, batch_size, pool_batches=32, prefetch=4):
+        """
+        Predicts the labels of a stream of documents. Documents are tokenized on a background thread while the
+        model runs, and grouped into batches of similar length within pools of pool_batches batches.
+        Results are yielded in the order of the input.
+        :param records: iterable of (key, text) tuples
+        :param batch_size: number of documents per forward pass
+        :param pool_batches: number of batches sorted by length together
+        :param prefetch: number of tokenized pools kept ahead of the model
+        :return: generator of (key, labels, scores) tuples
+        """
+        pools = queue.Queue(maxsize=prefetch)
+
+        def tokenize():
+            try:
+                pool = list()
+                for key, text in records:
+                    pool.append((key, self.encoder.encode(text)))
+                    if len(pool) == batch_size * pool_batches:
+                        pools.put(pool)
+                        pool = list()
+                if pool:
+                    pools.put(pool)
+                pools.put(None)
+            except Exception as e:
+                pools.put(e)
+
+        thread = threading.Thread(target=tokenize, daemon=True)
+        thread.start()
+        while True:
+            pool = pools.get()
+            if pool is None:
+                break
+            if isinstance(pool, Exception):
+                raise pool
+
+            order = np.argsort([self.encoder.length(encoded) for _, encoded in pool], kind='mergesort')
+            results = [None] * len(pool)
+            for start in range(0, len(pool), batch_size):
+                indices = order[start:start + batch_size]
+                predictions = self.top_labels(self.scores([pool[i][1] for i in indices]))
+                for i, (labels, scores) in zip(indices, predictions):
+                    results[i] = (pool[i][0], labels, scores)
+            yield from results
+        thread.join()
+
+
+def read_records(lines, input_format='jsonl'):
+    """
+    Parses input documents
+    :param lines: iterable of input lines
+    :param input_format: 'jsonl' for objects with a text and an optional id field, 'text' for one document per line
+    :return: generator of (key, text) tuples
+    """
+    for index, line in enumerate(lines):
+        line = line.rstrip('\n')
+        if not line:
+            continue
+        if input_format == 'jsonl':
+            record = json.loads(line)
+            yield record.get('id', index), record['text']
+        else:
+            yield index, line
+
+
+def build_predictor(args, device):
+    """
+    Loads the model and the tokenizer or vocabulary described by the command line arguments
+    :param args: command line arguments, see get_args
+    :param device: device to run the model on
+    :return: Predictor
+    """
+    model = load_model(args.snapshot, device)
+
+    if args.model_family in {'BERT', 'HBERT'}:
+        from utils.tokenization import BertTokenizer
+        tokenizer = BertTokenizer.from_pretrained(args.model, is_lowercase='uncased' in args.model)
+        encoder = BertEncoder(tokenizer, args.max_seq_length, is_hierarchical=args.model_family == 'HBERT',
+                              max_doc_length=args.max_doc_length)
+    else:
+        if args.dataset is None:
+            raise ValueError('--dataset is required for {}'.format(args.model_family))
+        dataset_cls = get_dataset_class(args.dataset, args.model_family)
+        vocab, extender = None, None
+        if args.model_family != 'CharCNN':
+            vocab_path = args.vocab or os.path.join(shards.shard_dir(args.data_dir, dataset_cls), shards.VOCAB_NAME)
+            vocab = torch.load(vocab_path)
+        if isinstance(vocab, PrunedVocab) and args.word_vectors_file and pretrained_embeddings(model):
+            vectors = load_vectors(args.word_vectors_file, args.word_vectors_dir)
+            extender = LazyVocabExtender(vocab, vectors, model)
+        encoder = FieldEncoder(dataset_cls, vocab, ignore_lengths=args.model_family in IGNORE_LENGTHS,
+                               extender=extender)
+
+    return Predictor(model, encoder, device, is_multilabel=args.multilabel, top_k=args.top_k)
+
+
+def get_args():
+    parser = ArgumentParser(description="Predict the labels of documents with a trained model")
+    parser.add_argument('--model-family', type=str, required=True, choices=MODEL_FAMILIES)
+    parser.add_argument('--snapshot', type=str, required=True, help='model saved by one of the trainers')
+    parser.add_argument('--dataset', type=str, default=None, choices=sorted(DATASETS),
+                        help='dataset the model was trained on, required for models other than BERT and HBERT')
+    parser.add_argument('--data-dir', default=os.path.join(os.pardir, 'hedwig-data', 'datasets'))
+    parser.add_argument('--vocab', type=str, default=None,
+                        help='vocabulary saved by datasets.preprocess, defaults to the one in the shard directory')
+    parser.add_argument('--word-vectors-dir', default=os.path.join(os.pardir, 'hedwig-data', 'embeddings', 'word2vec'))
+    parser.add_argument('--word-vectors-file', default=None,
+                        help='word vectors looked up for words outside a vocabulary pruned by datasets.preprocess')
+    parser.add_argument('--model', type=str, default='bert-base-uncased', help='BERT variant for the tokenizer')
+    parser.add_argument('--max-seq-length', type=int, default=256)
+    parser.add_argument('--max-doc-length', type=int, default=16)
+    parser.add_argument('--multilabel', action='store_true', help='score labels independently with a sigmoid')
+    parser.add_argument('--top-k', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--input', type=str, default='-', help='input file, or - for stdin')
+    parser.add_argument('--input-format', type=str, default='jsonl', choices=['jsonl', 'text'])
+    parser.add_argument('--output', type=str, default='-', help='output file, or - for stdout')
+    parser.add_argument('--no-cuda', action='store_false', dest='cuda')
+    parser.add_argument('--gpu', type=int, default=0)
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_args().parse_args()
+    device = torch.device('cuda', args.gpu) if args.cuda and torch.cuda.is_available() else torch.device('cpu')
+    predictor = build_predictor(args, device)
+
+    input_file = sys.stdin if args.input == '-' else open(args.input, 'r', encoding='utf-8')
+    output_file = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    try:
+        records = read_records(input_file, args.input_format)
+        for key, labels, scores in predictor.stream(records, args.batch_size):
+            output_file.write(json.dumps({'id': key, 'labels': labels, 'scores': scores}) + '\n')
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+        if output_file is not sys.stdout:
+            output_file.close()
@@ -0,0 +1,262 @@
+import asyncio
+import json
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from common.predict import build_predictor, get_args as get_predict_args
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+           500: 'Internal Server Error'}
+
+
+class ServingStats(object):
+    """
+    Keeps the latencies of the most recent requests and a histogram of the batch sizes the model was run with.
+    """
+
+    def __init__(self, window=10000):
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = Counter()
+        self.num_requests = 0
+        self.start = time.time()
+
+    def add_batch(self, size):
+        self.batch_sizes[size] += 1
+
+    def add_request(self, latency):
+        self.latencies.append(latency)
+        self.num_requests += 1
+
+    def summary(self):
+        latencies = np.array(self.latencies) * 1000
+        percentiles = np.percentile(latencies, [50, 90, 99]) if len(latencies) else [0.0, 0.0, 0.0]
+        num_batches = sum(self.batch_sizes.values())
+        return {
+            'requests': self.num_requests,
+            'requests_per_second': self.num_requests / max(time.time() - self.start, 1e-9),
+            'latency_ms': {'p50': percentiles[0], 'p90': percentiles[1], 'p99': percentiles[2]},
+            'batches': num_batches,
+            'mean_batch_size': sum(k * v for k, v in self.batch_sizes.items()) / max(num_batches, 1),
+            'batch_size_histogram': {str(k): v for k, v in sorted(self.batch_sizes.items())}
+        }
+
+
+class DynamicBatcher(object):
+    """
+    Coalesces concurrent requests into batches. A batch is run as soon as it holds max_batch_size documents, or
+    max_wait_ms after its first document arrived. The model runs on a single worker thread so the event loop keeps
+    accepting requests while a batch is being scored. When a batch fails, its documents are retried one at a time so
+    that only the requests with failing documents get an error.
+    """
+
+    def __init__(self, predictor, max_batch_size=32, max_wait_ms=5, stats=None, loop=None):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.stats = stats if stats is not None else ServingStats()
+        self.loop = loop or asyncio.get_event_loop()
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def predict(self, text):
+        """
+        Queues a document and waits for its prediction
+        :param text: document
+        :return: labels and scores
+        """
+        future = self.loop.create_future()
+        await self.queue.put((text, future))
+        return await future
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            deadline = self.loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            texts, futures = zip(*batch)
+            try:
+                predictions = await self._predict(list(texts))
+            except Exception as e:
+                if len(batch) == 1:
+                    self._set_exception(futures[0], e)
+                    continue
+                # A single bad document fails the whole batch, so its documents are retried one at a time and only
+                # the requests whose documents fail again get the error
+                for text, future in batch:
+                    try:
+                        prediction = (await self._predict([text]))[0]
+                    except Exception as e:
+                        self._set_exception(future, e)
+                    else:
+                        self._set_result(future, prediction)
+                continue
+            for future, prediction in zip(futures, predictions):
+                self._set_result(future, prediction)
+
+    async def _predict(self, texts):
+        self.stats.add_batch(len(texts))
+        return await self.loop.run_in_executor(self.executor, self.predictor.predict, texts)
+
+    @staticmethod
+    def _set_result(future, result):
+        if not future.done():
+            future.set_result(result)
+
+    @staticmethod
+    def _set_exception(future, exception):
+        if not future.done():
+            future.set_exception(exception)
+
+
+class InferenceServer(object):
+    """
+    Minimal HTTP/1.1 front end for a DynamicBatcher.
+
+    POST /predict with {"text": ...} or {"texts": [...]} returns the labels and scores of each document,
+    GET /stats returns latency percentiles and the batch size histogram.
+    """
+
+    def __init__(self, batcher, max_body_bytes=1 << 20):
+        """
+        :param batcher: DynamicBatcher
+        :param max_body_bytes: largest request body accepted, larger requests are rejected without being read
+        """
+        self.batcher = batcher
+        self.stats = batcher.stats
+        self.max_body_bytes = max_body_bytes
+
+    @staticmethod
+    def parse_texts(body):
+        """
+        Reads the documents of a /predict request
+        :param body: request body
+        :return: non-empty list of strings, or None if the request is malformed
+        """
+        try:
+            request = json.loads(body.decode('utf-8'))
+        except ValueError:
+            return None
+        if not isinstance(request, dict):
+            return None
+        # Documents of one request are batched with those of others, so they are checked before being queued
+        texts = request['texts'] if 'texts' in request else [request.get('text')]
+        if not isinstance(texts, list) or not texts or not all(isinstance(text, str) for text in texts):
+            return None
+        return texts
+
+    async def handle(self, method, path, body):
+        if path == '/stats':
+            return 200, self.stats.summary()
+        if path == '/health':
+            return 200, {'status': 'ok'}
+        if path != '/predict':
+            return 404, {'error': 'unknown path {}'.format(path)}
+        if method != 'POST':
+            return 405, {'error': 'use POST'}
+
+        texts = self.parse_texts(body)
+        if texts is None:
+            return 400, {'error': 'expected a JSON object with a text string or a non-empty texts list of strings'}
+
+        start = time.time()
+        predictions = await asyncio.gather(*[self.batcher.predict(text) for text in texts])
+        self.stats.add_request(time.time() - start)
+        return 200, {'predictions': [{'labels': labels, 'scores': scores} for labels, scores in predictions]}
+
+    async def serve_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                try:
+                    content_length = int(headers.get('content-length', 0))
+                except ValueError:
+                    content_length = -1
+                if not 0 <= content_length <= self.max_body_bytes:
+                    # The body is left unread, so the connection cannot be reused
+                    status = 413 if content_length > self.max_body_bytes else 400
+                    response, keep_alive = {'error': 'invalid or too large Content-Length'}, False
+                else:
+                    body = await reader.readexactly(content_length)
+                    try:
+                        status, response = await self.handle(method, path.split('?', 1)[0], body)
+                    except Exception as e:
+                        status, response = 500, {'error': str(e)}
+                payload = json.dumps(response).encode('utf-8')
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                             'Connection: {}\r\n\r\n'.format(status, REASONS[status], len(payload),
+                                                             'keep-alive' if keep_alive else 'close')
+                             .encode('latin-1') + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+def serve(predictor, host='127.0.0.1', port=8000, max_batch_size=32, max_wait_ms=5, max_body_bytes=1 << 20):
+    """
+    Serves a Predictor over HTTP until interrupted
+    :param predictor: Predictor returned by common.predict.build_predictor
+    :param host: address to listen on
+    :param port: port to listen on
+    :param max_batch_size: maximum number of documents per forward pass
+    :param max_wait_ms: maximum time the first document of a batch waits for more documents
+    :param max_body_bytes: largest request body accepted
+    """
+    loop = asyncio.get_event_loop()
+    batcher = DynamicBatcher(predictor, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms, loop=loop)
+    server = InferenceServer(batcher, max_body_bytes=max_body_bytes)
+    loop.create_task(batcher.run())
+    http_server = loop.run_until_complete(asyncio.start_server(server.serve_connection, host, port))
+    print('Serving on http://{}:{}'.format(host, port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(server.stats.summary(), indent=2))
+        http_server.close()
+        loop.run_until_complete(http_server.wait_closed())
+
+
+def get_args():
+    parser = get_predict_args()
+    parser.description = "Serve a trained model over HTTP with dynamic request batching"
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=5, help='maximum time a request waits for a batch')
+    parser.add_argument('--max-body-bytes', type=int, default=1 << 20, help='largest request body accepted')
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_args().parse_args()
+    device = torch.device('cuda', args.gpu) if args.cuda and torch.cuda.is_available() else torch.device('cpu')
+    serve(build_predictor(args, device), host=args.host, port=args.port, max_batch_size=args.max_batch_size,
+          max_wait_ms=args.max_wait_ms, max_body_bytes=args.max_body_bytes)
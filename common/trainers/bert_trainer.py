@@ -1,5 +1,6 @@
 # noinspection PyPackageRequirements
 import datetime
+import math
 import os
 
 import numpy as np
@@ -9,15 +10,21 @@ import matplotlib.pyplot as plt
 import torch
 import torch.nn.functional as F
 from torch.utils.data import DataLoader, RandomSampler, TensorDataset
+from torch.utils.data.dataloader import default_collate
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm
 from tqdm import trange
 
 from common.evaluators.bert_evaluator import BertEvaluator
+from common.metrics import RunningMetrics, weighted_mean
 from datasets.bert_processors.abstract_processor import convert_examples_to_features
 from datasets.bert_processors.abstract_processor import convert_examples_to_hierarchical_features
+from datasets.bert_processors.abstract_processor import convert_examples_to_windowed_features
+from datasets.bert_processors.abstract_processor import DocumentBatchSampler
+from datasets.bert_processors.abstract_processor import deduplicate_examples
+from utils.activation_cache import ActivationCache, features_digest, is_fresh, sentence_store
+from utils.compilation import pad_inputs, shape_buckets, warm_up
 from utils.optimization import warmup_linear
-from utils.preprocessing import pad_input_matrix
 from utils.tokenization import BertTokenizer
 
 
@@ -41,21 +48,66 @@ class BertTrainer(object):
         self.log_header = 'Epoch Iteration Progress   Dev/Acc.  Dev/Pr.  Dev/Re.   Dev/F1   Dev/Loss'
         self.log_template = ' '.join('{:>5.0f},{:>9.0f},{:>6.0f}/{:<5.0f} {:>6.4f},{:>8.4f},{:8.4f},{:8.4f},{:10.4f}'.split(','))
 
-        self.iterations, self.nb_tr_steps, self.tr_loss = 0, 0, 0
+        # Batches of compiled models are padded to a few shapes
+        self.buckets = shape_buckets(args, args.batch_size, args.max_seq_length)
+        self.cached_inputs = False
+        self.doc_label_ids = None
+        self.doc_weights = None
+        self.iterations = 0
+        self.train_metrics = RunningMetrics()
         self.best_dev_f1, self.unimproved_iters = 0, 0
         self.early_stop = False
 
     def train_epoch(self, train_dataloader):
+        self.train_metrics.reset()
         for step, batch in enumerate(tqdm(train_dataloader, desc="Training")):
             self.model.train()
-            batch = tuple(t.to(self.args.device) for t in batch)
-            input_ids, input_mask, segment_ids, label_ids = batch
-            logits = self.model(input_ids, segment_ids, input_mask)
+            # Batches of deduplicated examples end with the number of copies of each example
+            weights = None
+            if self.cached_inputs:
+                # Cached activations are stored as fp16, cast them to the precision of the model
+                inputs, label_ids = batch[:2]
+                if len(batch) > 2:
+                    weights = batch[2].to(self.args.device)
+                dtype = next(self.model.parameters()).dtype
+                inputs = {k: v.to(self.args.device, dtype=dtype if v.dtype == torch.float16 else torch.long)
+                          for k, v in inputs.items()}
+                tensors, num_rows = pad_inputs(self.buckets, list(inputs.values()), inputs.get('attention_mask'))
+                logits = self.model(**dict(zip(inputs.keys(), tensors)))[:num_rows]
+                label_ids = label_ids.to(self.args.device)
+            elif self.doc_label_ids is not None:
+                # Batches hold all windows of their documents, the window logits are combined per document
+                input_ids, input_mask, segment_ids, doc_ids, window_index = (t.to(self.args.device).long()
+                                                                             for t in batch)
+                doc_ids, doc_index = torch.unique(doc_ids, sorted=True, return_inverse=True)
+                (input_ids, input_mask, segment_ids), num_rows = pad_inputs(
+                    self.buckets, [input_ids, input_mask, segment_ids], input_mask)
+                logits, scores = self.model(input_ids, segment_ids, input_mask)
+                logits, scores = logits[:num_rows], scores[:num_rows]
+                logits = getattr(self.model, 'module', self.model).aggregate(logits, scores, doc_index, window_index,
+                                                                             len(doc_ids))
+                label_ids = self.doc_label_ids[doc_ids]
+                if self.doc_weights is not None:
+                    weights = self.doc_weights[doc_ids]
+            else:
+                # Features are stored compactly, widen them once they are on the device
+                batch = tuple(t.to(self.args.device).long() for t in batch)
+                input_ids, input_mask, segment_ids, label_ids = batch[:4]
+                if len(batch) > 4:
+                    weights = batch[4]
+                (input_ids, input_mask, segment_ids), num_rows = pad_inputs(
+                    self.buckets, [input_ids, input_mask, segment_ids], input_mask)
+                logits = self.model(input_ids, segment_ids, input_mask)[:num_rows]
 
             if self.args.is_multilabel:
-                loss = F.binary_cross_entropy_with_logits(logits, label_ids.float())
+                predictions = torch.sigmoid(logits).round().long()
+                targets = label_ids
+                loss = weighted_mean(
+                    F.binary_cross_entropy_with_logits(logits, label_ids.float(), reduce=False).mean(dim=1), weights)
             else:
-                loss = F.cross_entropy(logits, torch.argmax(label_ids, dim=1))
+                predictions = torch.argmax(logits, dim=1)
+                targets = torch.argmax(label_ids, dim=1)
+                loss = weighted_mean(F.cross_entropy(logits, targets, reduce=False), weights)
 
             if self.args.n_gpu > 1:
                 loss = loss.mean()
@@ -67,8 +119,7 @@ class BertTrainer(object):
             else:
                 loss.backward()
 
-            self.tr_loss += loss.item()
-            self.nb_tr_steps += 1
+            self.train_metrics.update(loss, predictions, targets, weights)
             if (step + 1) % self.args.gradient_accumulation_steps == 0:
                 if self.args.fp16:
                     lr_this_step = self.args.learning_rate * warmup_linear(self.iterations / self.num_train_optimization_steps, self.args.warmup_proportion)
@@ -78,46 +129,120 @@ class BertTrainer(object):
                 self.optimizer.zero_grad()
                 self.iterations += 1
 
+    def build_activation_cache(self, train_features):
+        """
+        Runs the frozen layers of the model once over the training set, or reuses the hidden states cached by an
+        earlier run with the same model and features
+        :param train_features: FeatureStore of the training set
+        :return: ActivationCache
+        """
+        model = getattr(self.model, 'module', self.model)
+        directory = os.path.join(self.args.activation_cache_dir, self.processor.NAME)
+        if self.args.local_rank != -1:
+            directory = os.path.join(directory, 'rank%d' % self.args.local_rank)
+        key = {'model': self.args.model, 'frozen_layers': model.num_frozen_layers,
+               'max_seq_length': self.args.max_seq_length, 'features': features_digest(train_features)}
+
+        if is_fresh(directory, key):
+            return ActivationCache(directory)
+        tqdm.write("Caching the output of the {} frozen layers in {}".format(model.num_frozen_layers, directory))
+        return ActivationCache.build(directory, model, train_features, key, self.args.batch_size, self.args.device)
+
+    def get_dataloader(self, train_features):
+        collate_fn = default_collate
+        store = sentence_store(self.args, self.model) if self.args.is_hierarchical else None
+        if getattr(self.args, 'freeze_layers', 0) and not self.args.is_hierarchical:
+            # The frozen layers compute the same hidden states every epoch, so only the layers above them are trained
+            activation_cache = self.build_activation_cache(train_features)
+            tensors = (torch.arange(len(train_features)), torch.from_numpy(train_features.label_ids))
+            if train_features.weights is not None:
+                tensors += (torch.from_numpy(train_features.weights),)
+            train_data = TensorDataset(*tensors)
+            collate_fn, self.cached_inputs = activation_cache.collate, True
+        elif store is not None:
+            # The frozen sentence encoder runs once per distinct sentence, the document head trains from the store
+            train_data = store.dataset(getattr(self.model, 'module', self.model).sentence_encoder, train_features,
+                                       self.args.max_doc_length, self.args.batch_size * self.args.max_doc_length,
+                                       self.args.device)
+            collate_fn, self.cached_inputs = store.collate, True
+        else:
+            train_data = train_features.tensor_dataset(self.args.max_doc_length if self.args.is_hierarchical else None)
+
+        if self.args.local_rank == -1:
+            train_sampler = RandomSampler(train_data)
+        else:
+            train_sampler = DistributedSampler(train_data)
+
+        return DataLoader(train_data, sampler=train_sampler, batch_size=self.args.batch_size, collate_fn=collate_fn)
+
+    def set_num_train_optimization_steps(self, steps_per_epoch):
+        """
+        Sizes the learning rate schedules of the optimizer and of fp16 training for a number of batches per epoch
+        :param steps_per_epoch: number of batches per epoch
+        """
+        self.num_train_optimization_steps = int(
+            steps_per_epoch / self.args.gradient_accumulation_steps) * self.args.epochs
+        if self.args.local_rank != -1:
+            self.num_train_optimization_steps //= torch.distributed.get_world_size()
+        for param_group in self.optimizer.param_groups:
+            if 't_total' in param_group:
+                param_group['t_total'] = self.num_train_optimization_steps
+
     def train(self):
-        if self.args.is_hierarchical:
+        train_examples, weights = self.train_examples, None
+        if getattr(self.args, 'deduplicate', False):
+            # Duplicates are trained on once, with their loss weighted by the number of copies
+            train_examples, weights = deduplicate_examples(self.train_examples)
+            print("Distinct examples:", len(train_examples))
+            # There are fewer batches per epoch, so the learning rate schedule is shortened to match
+            self.set_num_train_optimization_steps(math.ceil(len(train_examples) / self.args.batch_size))
+
+        if getattr(self.args, 'long_document', False):
+            train_features = convert_examples_to_windowed_features(
+                train_examples, self.args.max_seq_length, self.tokenizer, self.args.window_stride,
+                max_windows=self.args.max_windows)
+            # Batches are counted in windows, so there are more of them than documents over the batch size
+            self.set_num_train_optimization_steps(sum(1 for _ in DocumentBatchSampler(
+                train_features.doc_offsets, self.args.batch_size, shuffle=False)))
+            print("Number of windows: ", train_features.doc_offsets[-1])
+        elif self.args.is_hierarchical:
             train_features = convert_examples_to_hierarchical_features(
-                self.train_examples, self.args.max_seq_length, self.tokenizer)
+                train_examples, self.args.max_seq_length, self.tokenizer)
         else:
             train_features = convert_examples_to_features(
-                self.train_examples, self.args.max_seq_length, self.tokenizer)
-
-        unpadded_input_ids = [f.input_ids for f in train_features]
-        unpadded_input_mask = [f.input_mask for f in train_features]
-        unpadded_segment_ids = [f.segment_ids for f in train_features]
-
-        if self.args.is_hierarchical:
-            pad_input_matrix(unpadded_input_ids, self.args.max_doc_length)
-            pad_input_matrix(unpadded_input_mask, self.args.max_doc_length)
-            pad_input_matrix(unpadded_segment_ids, self.args.max_doc_length)
+                train_examples, self.args.max_seq_length, self.tokenizer)
+        train_features.weights = weights
 
         print("Number of examples: ", len(self.train_examples))
         print("Batch size:", self.args.batch_size)
         print("Num of steps:", self.num_train_optimization_steps)
 
-        padded_input_ids = torch.tensor(unpadded_input_ids, dtype=torch.long)
-        padded_input_mask = torch.tensor(unpadded_input_mask, dtype=torch.long)
-        padded_segment_ids = torch.tensor(unpadded_segment_ids, dtype=torch.long)
-        label_ids = torch.tensor([f.label_id for f in train_features], dtype=torch.long)
-
-        train_data = TensorDataset(padded_input_ids, padded_input_mask, padded_segment_ids, label_ids)
-
-        if self.args.local_rank == -1:
-            train_sampler = RandomSampler(train_data)
+        if getattr(self.args, 'long_document', False):
+            # Windows of whole documents are packed into batches of up to batch_size windows
+            self.doc_label_ids = torch.from_numpy(train_features.label_ids).to(self.args.device)
+            if weights is not None:
+                self.doc_weights = torch.from_numpy(weights).to(self.args.device)
+            train_dataloader = DataLoader(train_features.window_dataset(), batch_sampler=DocumentBatchSampler(
+                train_features.doc_offsets, self.args.batch_size))
         else:
-            train_sampler = DistributedSampler(train_data)
+            train_dataloader = self.get_dataloader(train_features)
 
-        train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=self.args.batch_size)
+        if self.buckets is not None and getattr(self.args, 'compile_warmup', False) and \
+                not self.cached_inputs and not self.args.is_hierarchical:
+            # Sequences of every bucket are compiled before the first epoch, other inputs are compiled when first seen
+            def make_inputs(num_rows, length):
+                input_ids = torch.zeros(num_rows, length, dtype=torch.long, device=self.args.device)
+                return (input_ids, torch.zeros_like(input_ids), torch.ones_like(input_ids)), {}
+            warm_up(self.model, self.buckets, make_inputs)
 
         # results for graphing learning curves
         results = []
         iterator = trange(int(self.args.epochs), desc="Epoch")
         for epoch in iterator:
             self.train_epoch(train_dataloader)
+            train_loss, train_acc = self.train_metrics.read()
+            tqdm.write("Train/Loss: {:.4f} Train/Acc.: {:.2f}%".format(train_loss, train_acc))
+
             dev_evaluator = BertEvaluator(self.model, self.processor, self.args, split='dev')
             dev_acc, dev_precision, dev_recall, dev_f1, dev_loss = dev_evaluator.get_scores()[0]
 
@@ -2,11 +2,13 @@ import datetime
 import os
 import time
 
-import numpy as np
 import torch
 import torch.nn.functional as F
 
+from common.metrics import RunningMetrics, weighted_mean
 from common.trainers.trainer import Trainer
+from datasets.shards import ShardedDataset
+from utils.compilation import pad_index, warm_up
 
 
 class ClassificationTrainer(Trainer):
@@ -19,6 +21,10 @@ class ClassificationTrainer(Trainer):
         self.iterations = 0
         self.iters_not_improved = 0
         self.start = None
+        self.train_metrics = RunningMetrics()
+        # Batches of compiled models are padded to a few shapes
+        self.shape_buckets = trainer_config.get('shape_buckets')
+        self.pad_index = pad_index(self.train_loader.dataset) if self.shape_buckets is not None else 0
         self.log_template = ' '.join(
             '{:>6.0f},{:>5.0f},{:>9.0f},{:>5.0f}/{:<5.0f} {:>7.0f}%,{:>8.6f},{:12.4f}'.split(','))
         self.dev_log_template = ' '.join(
@@ -27,43 +33,69 @@ class ClassificationTrainer(Trainer):
         timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
         self.snapshot_path = os.path.join(self.model_outfile, self.train_loader.dataset.NAME, '%s.pt' % timestamp)
 
+    def sampled_loss(self, batch, weights):
+        """
+        Extreme multi-label classification: only the labels of the batch and a sample of the other labels are
+        scored by the output layer of the model
+        :param batch: training batch
+        :param weights: multiplicity of each example of deduplicated data
+        :return: estimated mean binary cross-entropy over all labels, the predictions and the targets of the scored
+        labels
+        """
+        if 'ignore_lengths' in self.config and self.config['ignore_lengths']:
+            hidden = self.model.encode(batch.text)
+        else:
+            hidden = self.model.encode(batch.text[0])
+        losses, scores, labels = self.model.fc1.sampled_loss(hidden, batch.label)
+        loss = weighted_mean(losses / batch.label.size(1), weights)
+        # Labels that were not scored are negatives of every document, and are counted as predicted negative
+        return loss, (scores > 0).long(), batch.label[:, labels]
+
     def train_epoch(self, epoch):
         self.train_loader.init_epoch()
-        n_correct, n_total = 0, 0
+        self.train_metrics.reset()
         for batch_idx, batch in enumerate(self.train_loader):
             self.iterations += 1
             self.model.train()
             self.optimizer.zero_grad()
-            if hasattr(self.model, 'tar') and self.model.tar:
-                if 'ignore_lengths' in self.config and self.config['ignore_lengths']:
-                    scores, rnn_outs = self.model(batch.text)
-                else:
-                    scores, rnn_outs = self.model(batch.text[0], lengths=batch.text[1])
+            if self.shape_buckets is not None:
+                self.shape_buckets.pad_batch(batch, self.pad_index)
+            # Batches of deduplicated shards hold the number of copies of each example, padding rows weigh zero
+            weights = getattr(batch, 'weight', None)
+            if 'sampled_labels' in self.config and self.config['sampled_labels']:
+                loss, predictions, targets = self.sampled_loss(batch, weights)
             else:
-                if 'ignore_lengths' in self.config and self.config['ignore_lengths']:
-                    scores = self.model(batch.text)
+                if hasattr(self.model, 'tar') and self.model.tar:
+                    if 'ignore_lengths' in self.config and self.config['ignore_lengths']:
+                        scores, rnn_outs = self.model(batch.text)
+                    else:
+                        scores, rnn_outs = self.model(batch.text[0], lengths=batch.text[1])
                 else:
-                    scores = self.model(batch.text[0], lengths=batch.text[1])
-
-            if 'is_multilabel' in self.config and self.config['is_multilabel']:
-                predictions = F.sigmoid(scores).round().long()
-                for tensor1, tensor2 in zip(predictions, batch.label):
-                    if np.array_equal(tensor1, tensor2):
-                        n_correct += 1
-                loss = F.binary_cross_entropy_with_logits(scores, batch.label.float())
-            else:
-                for tensor1, tensor2 in zip(torch.argmax(scores, dim=1), torch.argmax(batch.label.data, dim=1)):
-                    if np.array_equal(tensor1, tensor2):
-                        n_correct += 1
-                loss = F.cross_entropy(scores, torch.argmax(batch.label.data, dim=1))
-
+                    if 'ignore_lengths' in self.config and self.config['ignore_lengths']:
+                        scores = self.model(batch.text)
+                    else:
+                        scores = self.model(batch.text[0], lengths=batch.text[1])
+
+                if 'is_multilabel' in self.config and self.config['is_multilabel']:
+                    predictions = F.sigmoid(scores).round().long()
+                    targets = batch.label
+                    loss = weighted_mean(F.binary_cross_entropy_with_logits(scores, batch.label.float(),
+                                                                            reduce=False).mean(dim=1), weights)
+                else:
+                    predictions = torch.argmax(scores, dim=1)
+                    targets = torch.argmax(batch.label.data, dim=1)
+                    loss = weighted_mean(F.cross_entropy(scores, targets, reduce=False), weights)
+
+            if hasattr(batch, 'unpadded_size') and ((hasattr(self.model, 'tar') and self.model.tar) or
+                                                    (hasattr(self.model, 'ar') and self.model.ar)):
+                # Padding steps and rows are left out of the activation regularization
+                rnn_outs = rnn_outs[:batch.unpadded_size[1], :batch.unpadded_size[0]]
             if hasattr(self.model, 'tar') and self.model.tar:
                 loss = loss + self.model.tar * (rnn_outs[1:] - rnn_outs[:-1]).pow(2).mean()
             if hasattr(self.model, 'ar') and self.model.ar:
                 loss = loss + self.model.ar * (rnn_outs[:]).pow(2).mean()
 
-            n_total += batch.batch_size
-            train_acc = 100. * n_correct / n_total
+            self.train_metrics.update(loss, predictions, targets, weights)
             loss.backward()
             self.optimizer.step()
 
@@ -72,13 +104,38 @@ class ClassificationTrainer(Trainer):
                 self.model.update_ema()
 
             if self.iterations % self.log_interval == 1:
-                niter = epoch * len(self.train_loader) + batch_idx
+                # Metrics are only copied from the device when they are logged
+                train_loss, train_acc = self.train_metrics.read()
                 print(self.log_template.format(time.time() - self.start, epoch, self.iterations, 1 + batch_idx,
                                                len(self.train_loader), 100.0 * (1 + batch_idx) / len(self.train_loader),
-                                               loss.item(), train_acc))
+                                               train_loss, train_acc))
+
+    def warm_up(self):
+        """
+        Compiles the sequence buckets of models over flat token sequences, up to the longest training document
+        """
+        dataset = self.train_loader.dataset
+        if hasattr(dataset.TEXT_FIELD, 'nesting_field') or getattr(dataset.TEXT_FIELD, 'vocab', None) is None:
+            # Hierarchical and character quantized inputs are compiled when first seen
+            return
+        if isinstance(dataset, ShardedDataset):
+            longest = int(dataset.lengths.max())
+        else:
+            longest = max(len(example.text) for example in dataset.examples)
+        ignore_lengths = 'ignore_lengths' in self.config and self.config['ignore_lengths']
+        device = next(self.model.parameters()).device
+
+        def make_inputs(num_rows, length):
+            text = torch.full((num_rows, length), self.pad_index, dtype=torch.long, device=device)
+            if ignore_lengths:
+                return (text,), {}
+            return (text,), {'lengths': torch.full((num_rows,), length, dtype=torch.long, device=device)}
+        warm_up(self.model, self.shape_buckets, make_inputs, longest)
 
     def train(self, epochs):
         self.start = time.time()
+        if self.shape_buckets is not None and self.config.get('compile_warmup'):
+            self.warm_up()
         header = '  Time Epoch Iteration Progress    (%Epoch)   Loss     Accuracy'
         dev_header = '  Time Epoch Iteration Progress     Dev/Acc. Dev/Pr.  Dev/Recall   Dev/F1       Dev/Loss'
         os.makedirs(self.model_outfile, exist_ok=True)
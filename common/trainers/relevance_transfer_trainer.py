@@ -3,13 +3,14 @@ import os
 
 import torch
 import torch.nn.functional as F
-from torch.utils.data import TensorDataset, RandomSampler, DataLoader
+from torch.utils.data import RandomSampler, DataLoader
 from tqdm import trange, tqdm
 
+from common.metrics import weighted_mean
 from common.trainers.trainer import Trainer
+from datasets.bert_processors.abstract_processor import deduplicate_examples
 from datasets.bert_processors.robust45_processor import convert_examples_to_features
 from tasks.relevance_transfer.resample import ImbalancedDatasetSampler
-from utils.preprocessing import pad_input_matrix
 from utils.tokenization import BertTokenizer
 
 
@@ -44,10 +45,12 @@ class RelevanceTransferTrainer(Trainer):
             self.model.train()
 
             if self.config['model'] in {'BERT-Base', 'BERT-Large', 'HBERT-Base', 'HBERT-Large'}:
-                batch = tuple(t.to(self.config['device']) for t in batch)
-                input_ids, input_mask, segment_ids, label_ids = batch
+                batch = tuple(t.to(self.config['device']).long() for t in batch)
+                input_ids, input_mask, segment_ids, label_ids = batch[:4]
+                # Batches of deduplicated examples end with the number of copies of each example
+                weights = batch[4] if len(batch) > 4 else None
                 logits = torch.sigmoid(self.model(input_ids, segment_ids, input_mask)).squeeze(dim=1)
-                loss = F.binary_cross_entropy(logits, label_ids.float())
+                loss = weighted_mean(F.binary_cross_entropy(logits, label_ids.float(), reduce=False), weights)
 
                 if self.config['n_gpu'] > 1:
                     loss = loss.mean()
@@ -62,16 +65,20 @@ class RelevanceTransferTrainer(Trainer):
                     self.iterations += 1
 
             else:
-                # Clip gradients to address exploding gradients in LSTM
-                torch.nn.utils.clip_grad_norm_(self.model.parameters(), 25.0)
+                # Clip gradients to address exploding gradients in LSTM, sparse embedding gradients are left as is
+                torch.nn.utils.clip_grad_norm_([p for p in self.model.parameters()
+                                                if p.grad is None or not p.grad.is_sparse], 25.0)
 
                 # Randomly sample equal number of positive and negative documents
                 self.train_loader.init_epoch()
+                # Batches of deduplicated shards hold the number of copies of each example
+                weights = getattr(batch, 'weight', None)
                 if 'ignore_lengths' in self.config and self.config['ignore_lengths']:
                     if 'resample' in self.config and self.config['resample']:
                         indices = ImbalancedDatasetSampler(batch.text, batch.label).get_indices()
                         batch_text = batch.text[indices]
                         batch_label = batch.label[indices]
+                        weights = weights[indices] if weights is not None else None
                     else:
                         batch_text = batch.text
                         batch_label = batch.label
@@ -81,6 +88,7 @@ class RelevanceTransferTrainer(Trainer):
                         batch_text = batch.text[0][indices]
                         batch_lengths = batch.text[1][indices]
                         batch_label = batch.label
+                        weights = None
                     else:
                         batch_text = batch.text[0]
                         batch_lengths = batch.text[1]
@@ -97,7 +105,7 @@ class RelevanceTransferTrainer(Trainer):
                     else:
                         logits = torch.sigmoid(self.model(batch_text, lengths=batch_lengths)).squeeze(dim=1)
 
-                loss = F.binary_cross_entropy(logits, batch_label.float())
+                loss = weighted_mean(F.binary_cross_entropy(logits, batch_label.float(), reduce=False), weights)
                 if hasattr(self.model, 'tar') and self.model.tar:
                     loss = loss + (rnn_outs[1:] - rnn_outs[:-1]).pow(2).mean()
 
@@ -115,28 +123,20 @@ class RelevanceTransferTrainer(Trainer):
         os.makedirs(os.path.join(self.model_outfile, self.config['dataset'].NAME), exist_ok=True)
 
         if self.config['model'] in {'BERT-Base', 'BERT-Large', 'HBERT-Base', 'HBERT-Large'}:
+            train_examples, weights = self.train_examples, None
+            if 'deduplicate' in self.config and self.config['deduplicate']:
+                # The augmented training files repeat documents, each is trained on once with a weighted loss
+                train_examples, weights = deduplicate_examples(self.train_examples)
             train_features = convert_examples_to_features(
-                self.train_examples,
+                train_examples,
                 self.config['max_seq_length'],
                 self.tokenizer,
                 self.config['is_hierarchical']
             )
+            train_features.weights = weights
 
-            unpadded_input_ids = [f.input_ids for f in train_features]
-            unpadded_input_mask = [f.input_mask for f in train_features]
-            unpadded_segment_ids = [f.segment_ids for f in train_features]
-
-            if self.config['is_hierarchical']:
-                pad_input_matrix(unpadded_input_ids, self.config['max_doc_length'])
-                pad_input_matrix(unpadded_input_mask, self.config['max_doc_length'])
-                pad_input_matrix(unpadded_segment_ids, self.config['max_doc_length'])
-
-            padded_input_ids = torch.tensor(unpadded_input_ids, dtype=torch.long)
-            padded_input_mask = torch.tensor(unpadded_input_mask, dtype=torch.long)
-            padded_segment_ids = torch.tensor(unpadded_segment_ids, dtype=torch.long)
-            label_ids = torch.tensor([f.label_id for f in train_features], dtype=torch.long)
-
-            train_data = TensorDataset(padded_input_ids, padded_input_mask, padded_segment_ids, label_ids)
+            train_data = train_features.tensor_dataset(
+                self.config['max_doc_length'] if self.config['is_hierarchical'] else None)
             train_sampler = RandomSampler(train_data)
             self.train_loader = DataLoader(train_data, sampler=train_sampler, batch_size=self.config['batch_size'])
 
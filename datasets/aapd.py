@@ -4,9 +4,10 @@ import numpy as np
 import torch
 from torchtext.data import NestedField, Field, TabularDataset
 from torchtext.data.iterator import BucketIterator
-from torchtext.vocab import Vectors
 
+from datasets import shards
 from datasets.reuters import clean_string, split_sents
+from utils.vectors import load_vectors
 
 
 def char_quantize(string, max_length=1000):
@@ -61,8 +62,12 @@ class AAPD(TabularDataset):
         :param unk_init: function used to generate vector for OOV words
         :return:
         """
+        directory = shards.shard_dir(path, cls)
+        if vectors is None and shards.is_fresh(directory, vectors_name, vectors_cache):
+            return shards.iters(cls, directory, batch_size=batch_size, shuffle=shuffle, device=device)
+
         if vectors is None:
-            vectors = Vectors(name=vectors_name, cache=vectors_cache, unk_init=unk_init)
+            vectors = load_vectors(vectors_name, vectors_cache, unk_init=unk_init)
 
         train, val, test = cls.splits(path)
         cls.TEXT_FIELD.build_vocab(train, val, test, vectors=vectors)
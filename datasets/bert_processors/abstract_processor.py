@@ -1,12 +1,17 @@
-import csv
-
-import sys
 import numpy as np
+import torch
 from nltk.tokenize import sent_tokenize
+from torch.utils.data import Sampler, TensorDataset
+
+from utils.dedup import deduplicate, normalize_text, text_digest
+from utils.io import find_compressed, read_tsv_chunks
+from utils.preprocessing import document_positions, length_mask, offsets_from_lengths, pack_sequences, \
+    pad_documents
 
 
 class InputExample(object):
     """A single training/test example for simple sequence classification."""
+    __slots__ = ('guid', 'text_a', 'text_b', 'label')
 
     def __init__(self, guid, text_a, text_b=None, label=None):
         """Constructs a InputExample.
@@ -28,6 +33,7 @@ class InputExample(object):
 
 class InputFeatures(object):
     """A single set of features of data."""
+    __slots__ = ('input_ids', 'input_mask', 'segment_ids', 'label_id')
 
     def __init__(self, input_ids, input_mask, segment_ids, label_id):
         self.input_ids = input_ids
@@ -36,6 +42,151 @@ class InputFeatures(object):
         self.label_id = label_id
 
 
+class FeatureStore(object):
+    """
+    Columnar storage for the features of a data set. Token ids live in a contiguous zero-padded numpy matrix with
+    one row per sequence, alongside the length of each row and the position where its second segment starts.
+    Input masks and segment ids are derived from these when needed rather than stored. Hierarchical features have
+    one row per sentence, and doc_offsets holds the first sentence of each document. Indexing the store returns
+    `InputFeatures` views over the rows. Features of deduplicated examples carry the number of copies of each
+    example in weights.
+    """
+
+    def __init__(self, input_ids, lengths, segment_starts, label_ids, doc_offsets=None, guids=None, weights=None):
+        self.input_ids = input_ids
+        self.lengths = lengths
+        self.segment_starts = segment_starts
+        self.label_ids = label_ids
+        self.doc_offsets = doc_offsets
+        self.guids = guids
+        self.weights = weights
+
+    @classmethod
+    def from_sequences(cls, sequences, segment_starts, max_seq_length, label_ids, doc_offsets=None, guids=None):
+        """
+        Packs token id sequences into a store
+        :param sequences: list of token id lists, one per row
+        :param segment_starts: position of the first token of the second segment in each row
+        :param max_seq_length: maximum sequence length
+        :param label_ids: label of each example
+        :param doc_offsets: first row of each document for hierarchical features
+        :param guids: integer id of each example
+        :return: FeatureStore
+        """
+        input_ids, lengths = pack_sequences(sequences, max_seq_length)
+        return cls(input_ids, lengths.astype(np.int32), np.asarray(segment_starts, dtype=np.int32),
+                   np.asarray(label_ids, dtype=np.int64), doc_offsets=doc_offsets, guids=guids)
+
+    @property
+    def is_hierarchical(self):
+        return self.doc_offsets is not None
+
+    @property
+    def input_mask(self):
+        return length_mask(self.lengths, self.input_ids.shape[1])
+
+    @property
+    def segment_ids(self):
+        return length_mask(self.lengths, self.input_ids.shape[1], start=self.segment_starts)
+
+    def __len__(self):
+        return len(self.label_ids)
+
+    def __getitem__(self, index):
+        rows = slice(self.doc_offsets[index], self.doc_offsets[index + 1]) if self.is_hierarchical else index
+        width = self.input_ids.shape[1]
+        return InputFeatures(input_ids=self.input_ids[rows],
+                             input_mask=length_mask(self.lengths[rows], width),
+                             segment_ids=length_mask(self.lengths[rows], width, start=self.segment_starts[rows]),
+                             label_id=self.label_ids[index])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def tensors(self, max_doc_length=None):
+        """
+        Returns the input ids, input mask and segment ids as tensors. Flat input ids share memory with the store.
+        Hierarchical features are zero-padded or truncated to the same number of sentences per document, which is
+        the smaller of max_doc_length and the longest document.
+        :param max_doc_length: maximum number of sentences per document for hierarchical features
+        :return: tuple of tensors
+        """
+        width = self.input_ids.shape[1]
+        if not self.is_hierarchical:
+            input_ids, lengths, segment_starts = self.input_ids, self.lengths, self.segment_starts
+        else:
+            input_ids = pad_documents(self.input_ids, self.doc_offsets, max_doc_length)
+            # Padding sentences have zero length, so their masks are empty
+            lengths = pad_documents(self.lengths, self.doc_offsets, max_doc_length)
+            segment_starts = pad_documents(self.segment_starts, self.doc_offsets, max_doc_length)
+
+        return (torch.from_numpy(input_ids),
+                torch.from_numpy(length_mask(lengths, width)),
+                torch.from_numpy(length_mask(lengths, width, start=segment_starts)))
+
+    def tensor_dataset(self, max_doc_length=None, with_guids=False):
+        """
+        Returns a TensorDataset of input ids, input mask, segment ids and label ids, followed by the guids if
+        with_guids is set and by the weights of deduplicated features
+        :param max_doc_length: maximum number of sentences per document for hierarchical features
+        :param with_guids: whether to include the guids of the examples
+        :return: TensorDataset
+        """
+        tensors = self.tensors(max_doc_length) + (torch.from_numpy(self.label_ids),)
+        if with_guids:
+            tensors += (torch.from_numpy(self.guids),)
+        if self.weights is not None:
+            tensors += (torch.from_numpy(self.weights),)
+        return TensorDataset(*tensors)
+
+    def window_dataset(self):
+        """
+        Returns a TensorDataset with one item per window of windowed features: input ids, input mask, segment ids,
+        the index of the document of the window and the position of the window within the document. The windows
+        of all documents are kept flat, so batches can be filled with windows of any number of documents.
+        :return: TensorDataset
+        """
+        doc_index, position = document_positions(self.doc_offsets)
+        return TensorDataset(torch.from_numpy(self.input_ids), torch.from_numpy(self.input_mask),
+                             torch.from_numpy(self.segment_ids), torch.from_numpy(doc_index),
+                             torch.from_numpy(position))
+
+
+class DocumentBatchSampler(Sampler):
+    """
+    Packs the windows of whole documents into batches of at most max_windows windows. A document with more
+    windows than that forms a batch of its own.
+    """
+
+    def __init__(self, doc_offsets, max_windows, shuffle=True):
+        """
+        :param doc_offsets: index of the first window of each document, followed by the number of windows
+        :param max_windows: maximum number of windows per batch
+        :param shuffle: whether to visit the documents in random order
+        """
+        self.doc_offsets = doc_offsets
+        self.max_windows = max_windows
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        num_docs = len(self.doc_offsets) - 1
+        order = np.random.permutation(num_docs) if self.shuffle else np.arange(num_docs)
+        batch = list()
+        for doc in order:
+            windows = list(range(self.doc_offsets[doc], self.doc_offsets[doc + 1]))
+            if batch and len(batch) + len(windows) > self.max_windows:
+                yield batch
+                batch = list()
+            batch.extend(windows)
+        if batch:
+            yield batch
+
+    def __len__(self):
+        # Upper bound, batches are only known once the documents are shuffled
+        return len(self.doc_offsets) - 1
+
+
 class BertProcessor(object):
     """Base class for data converters for sequence classification data sets."""
 
@@ -73,32 +224,71 @@ class BertProcessor(object):
     @classmethod
     def _read_tsv(cls, input_file, quotechar=None):
         """
-        Reads a Tab Separated Values (TSV) file
+        Reads a Tab Separated Values (TSV) file, parsing large files in parallel. A gzip or zstandard compressed copy
+        of the file is read if the file itself does not exist.
         :param input_file:
         :param quotechar:
         :return:
         """
-        with open(input_file, "r") as f:
-            reader = csv.reader(f, delimiter="\t", quotechar=quotechar)
-            lines = []
-            for line in reader:
-                if sys.version_info[0] == 2:
-                    line = list(str(cell, 'utf-8') for cell in line)
-                lines.append(line)
-            return lines
+        lines = []
+        for rows in read_tsv_chunks(find_compressed(input_file), quotechar=quotechar):
+            lines.extend(rows)
+        return lines
+
+    def _iter_examples(self, input_file, set_type, quotechar=None):
+        """
+        Lazily reads a TSV file, or its compressed copy, as batches of `InputExample`s, without holding all of its
+        lines in memory
+        :param input_file:
+        :param set_type:
+        :param quotechar:
+        :return: generator of lists of `InputExample`s
+        """
+        start = 0
+        for rows in read_tsv_chunks(find_compressed(input_file), quotechar=quotechar):
+            yield self._create_examples(rows, set_type, start=start)
+            start += len(rows)
+
+    def _read_examples(self, input_file, set_type, quotechar=None):
+        """
+        Reads the `InputExample`s of a TSV file, or of its compressed copy. Rows are turned into examples one chunk
+        at a time, so only the rows of a chunk are held in memory next to the examples.
+        :param input_file:
+        :param set_type:
+        :param quotechar:
+        :return: list of `InputExample`s
+        """
+        examples = []
+        for batch in self._iter_examples(input_file, set_type, quotechar=quotechar):
+            examples.extend(batch)
+        return examples
+
+
+def deduplicate_examples(examples, with_labels=True):
+    """
+    Keeps the first of every group of examples with the same normalized texts, and the same label if with_labels
+    is set
+    :param examples: list of `InputExample`s
+    :param with_labels: whether examples with different labels are kept apart
+    :return: list of distinct `InputExample`s and the number of copies of each as an int64 array
+    """
+    keys = (text_digest(normalize_text(example.text_a), normalize_text(example.text_b),
+                        str(example.label) if with_labels else '') for example in examples)
+    first, _, counts = deduplicate(keys)
+    return [examples[i] for i in first], counts
 
 
 def convert_examples_to_features(examples, max_seq_length, tokenizer, print_examples=False):
     """
-    Loads a data file into a list of InputBatch objects
+    Loads a data file into a FeatureStore
     :param examples:
     :param max_seq_length:
     :param tokenizer:
     :param print_examples:
-    :return: a list of InputBatch objects
+    :return: a FeatureStore with one row per example
     """
 
-    features = []
+    sequences, segment_starts = list(), list()
     for (ex_index, example) in enumerate(examples):
         tokens_a = tokenizer.tokenize(example.text_a)
 
@@ -133,55 +323,36 @@ def convert_examples_to_features(examples, max_seq_length, tokenizer, print_exam
         # used as as the "sentence vector". Note that this only makes sense because
         # the entire model is fine-tuned.
         tokens = ["[CLS]"] + tokens_a + ["[SEP]"]
-        segment_ids = [0] * len(tokens)
+        segment_starts.append(len(tokens))
 
         if tokens_b:
             tokens += tokens_b + ["[SEP]"]
-            segment_ids += [1] * (len(tokens_b) + 1)
-
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
 
-        # The mask has 1 for real tokens and 0 for padding tokens. Only real
-        # tokens are attended to.
-        input_mask = [1] * len(input_ids)
-
-        # Zero-pad up to the sequence length.
-        padding = [0] * (max_seq_length - len(input_ids))
-        input_ids += padding
-        input_mask += padding
-        segment_ids += padding
-
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
-
-        label_id = [float(x) for x in example.label]
+        # Rows are zero-padded up to the sequence length. The mask has 1 for real
+        # tokens and 0 for padding tokens. Only real tokens are attended to.
+        sequences.append(tokenizer.convert_tokens_to_ids(tokens))
 
         if print_examples and ex_index < 5:
             print("tokens: %s" % " ".join([str(x) for x in tokens]))
-            print("input_ids: %s" % " ".join([str(x) for x in input_ids]))
-            print("input_mask: %s" % " ".join([str(x) for x in input_mask]))
-            print("segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
+            print("input_ids: %s" % " ".join([str(x) for x in sequences[-1]]))
+            print("segment_start: %d" % segment_starts[-1])
             print("label: %s" % example.label)
 
-        features.append(InputFeatures(input_ids=input_ids,
-                                      input_mask=input_mask,
-                                      segment_ids=segment_ids,
-                                      label_id=label_id))
-    return features
+    return FeatureStore.from_sequences(sequences, segment_starts, max_seq_length,
+                                       [[float(x) for x in example.label] for example in examples])
 
 
 def convert_examples_to_hierarchical_features(examples, max_seq_length, tokenizer, print_examples=False):
     """
-    Loads a data file into a list of InputBatch objects
+    Loads a data file into a FeatureStore with one row per sentence
     :param examples:
     :param max_seq_length:
     :param tokenizer:
     :param print_examples:
-    :return: a list of InputBatch objects
+    :return: a hierarchical FeatureStore
     """
 
-    features = []
+    sequences, segment_starts, num_sentences = list(), list(), list()
     for (ex_index, example) in enumerate(examples):
         tokens_a = [tokenizer.tokenize(line) for line in sent_tokenize(example.text_a)]
         tokens_b = None
@@ -198,40 +369,67 @@ def convert_examples_to_hierarchical_features(examples, max_seq_length, tokenize
                     tokens_a[i0] = tokens_a[i0][:(max_seq_length - 2)]
 
         tokens = [["[CLS]"] + line + ["[SEP]"] for line in tokens_a]
-        segment_ids = [[0] * len(line) for line in tokens]
+        # Sentences of the first text have no second segment, sentences of the second text are entirely in it
+        segment_starts.extend(len(line) for line in tokens)
 
         if tokens_b:
-            tokens += tokens_b + ["[SEP]"]
-            segment_ids += [1] * (len(tokens_b) + 1)
+            tokens += [line + ["[SEP]"] for line in tokens_b]
+            segment_starts.extend(0 for _ in tokens_b)
 
-        input_ids = list()
-        for line in tokens:
-            input_ids.append(tokenizer.convert_tokens_to_ids(line))
+        sequences.extend(tokenizer.convert_tokens_to_ids(line) for line in tokens)
+        num_sentences.append(len(tokens))
 
-        # Input mask has 1 for real tokens and 0 for padding tokens
-        input_mask = [[1] * len(line_ids) for line_ids in input_ids]
+        if print_examples and ex_index < 5:
+            print("tokens: %s" % " ".join([str(x) for x in tokens]))
+            print("input_ids: %s" % " ".join([str(x) for x in sequences[-len(tokens):]]))
+            print("label: %s" % example.label)
 
-        # Zero-pad up to the sequence length.
-        padding = [[0] * (max_seq_length - len(line_ids)) for line_ids in input_ids]
-        for i0 in range(len(input_ids)):
-            input_ids[i0] += padding[i0]
-            input_mask[i0] += padding[i0]
-            segment_ids[i0] += padding[i0]
+    # Input mask has 1 for real tokens and 0 for padding tokens, rows are zero-padded up to the sequence length
+    return FeatureStore.from_sequences(sequences, segment_starts, max_seq_length,
+                                       [[float(x) for x in example.label] for example in examples],
+                                       doc_offsets=offsets_from_lengths(num_sentences))
 
-        label_id = [float(x) for x in example.label]
+
+def convert_examples_to_windowed_features(examples, max_seq_length, tokenizer, stride, max_windows=0,
+                                          print_examples=False):
+    """
+    Loads a data file into a FeatureStore with one row per window. Each document is split into overlapping windows
+    of max_seq_length - 2 wordpieces that start stride wordpieces apart, the last window ends with the document.
+    :param examples:
+    :param max_seq_length:
+    :param tokenizer:
+    :param stride: number of wordpieces between the starts of consecutive windows
+    :param max_windows: maximum number of windows per document, zero for no limit
+    :param print_examples:
+    :return: a FeatureStore with one row per window, doc_offsets holds the first window of each document
+    """
+    # Account for [CLS] and [SEP]
+    window_length = max_seq_length - 2
+    sequences, num_windows = list(), list()
+    cls_id, sep_id = tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+    for (ex_index, example) in enumerate(examples):
+        if example.text_b:
+            raise ValueError('Sequence pairs cannot be split into windows')
+        token_ids = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(example.text_a))
+
+        starts = list(range(0, max(len(token_ids) - window_length, 0) + 1, stride))
+        if starts[-1] + window_length < len(token_ids):
+            starts.append(len(token_ids) - window_length)
+        if max_windows:
+            starts = starts[:max_windows]
+
+        sequences.extend([cls_id] + token_ids[start:start + window_length] + [sep_id] for start in starts)
+        num_windows.append(len(starts))
 
         if print_examples and ex_index < 5:
-            print("tokens: %s" % " ".join([str(x) for x in tokens]))
-            print("input_ids: %s" % " ".join([str(x) for x in input_ids]))
-            print("input_mask: %s" % " ".join([str(x) for x in input_mask]))
-            print("segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
+            print("windows: %d" % len(starts))
+            print("input_ids: %s" % " ".join([str(x) for x in sequences[-len(starts)]]))
             print("label: %s" % example.label)
 
-        features.append(InputFeatures(input_ids=input_ids,
-                                      input_mask=input_mask,
-                                      segment_ids=segment_ids,
-                                      label_id=label_id))
-    return features
+    # Windows have a single segment, so the second segment starts after the last token
+    return FeatureStore.from_sequences(sequences, [len(x) for x in sequences], max_seq_length,
+                                       [[float(x) for x in example.label] for example in examples],
+                                       doc_offsets=offsets_from_lengths(num_windows))
 
 
 def _truncate_seq_pair(tokens_a, tokens_b, max_length):
@@ -1,6 +1,7 @@
 import os
 
 from datasets.bert_processors.abstract_processor import BertProcessor, InputExample
+from utils.io import find_compressed, open_text
 
 
 class ReutersProcessor(BertProcessor):
@@ -8,7 +9,7 @@ class ReutersProcessor(BertProcessor):
         self.NAME = 'Reuters'
 
     def set_num_classes_(self, data_dir):
-        with open(os.path.join(data_dir, 'Reuters', 'train.tsv'), 'r') as f:
+        with open_text(find_compressed(os.path.join(data_dir, 'Reuters', 'train.tsv'))) as f:
             l1 = f.readline().split('\t')
 
         # from one-hot class vector
@@ -16,20 +17,17 @@ class ReutersProcessor(BertProcessor):
         self.IS_MULTILABEL = self.NUM_CLASSES > 2
 
     def get_train_examples(self, data_dir):
-        return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, 'Reuters', 'train.tsv')), 'train')
+        return self._read_examples(os.path.join(data_dir, 'Reuters', 'train.tsv'), 'train')
 
     def get_dev_examples(self, data_dir):
-        return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, 'Reuters', 'dev.tsv')), 'dev')
+        return self._read_examples(os.path.join(data_dir, 'Reuters', 'dev.tsv'), 'dev')
 
     def get_test_examples(self, data_dir):
-        return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, 'Reuters', 'test.tsv')), 'test')
+        return self._read_examples(os.path.join(data_dir, 'Reuters', 'test.tsv'), 'test')
 
-    def _create_examples(self, lines, set_type):
+    def _create_examples(self, lines, set_type, start=0):
         examples = []
-        for (i, line) in enumerate(lines):
+        for (i, line) in enumerate(lines, start):
             if i == 0:
                 continue
             guid = '%s-%s' % (set_type, i)
@@ -1,18 +1,30 @@
 import os
 
+import numpy as np
 from nltk import sent_tokenize
 
-from datasets.bert_processors.abstract_processor import BertProcessor, InputExample, InputFeatures
+from datasets.bert_processors.abstract_processor import BertProcessor, FeatureStore, InputExample, InputFeatures
+from utils.preprocessing import offsets_from_lengths
 
 
 class RelevanceFeatures(InputFeatures):
     """A single set of features for relevance tasks."""
+    __slots__ = ('guid',)
 
     def __init__(self, input_ids, input_mask, segment_ids, label_id, guid):
         super().__init__(input_ids, input_mask, segment_ids, label_id)
         self.guid = guid
 
 
+class RelevanceFeatureStore(FeatureStore):
+    """Columnar storage for the features of a relevance data set, with the document id of each example."""
+
+    def __getitem__(self, index):
+        features = super().__getitem__(index)
+        return RelevanceFeatures(features.input_ids, features.input_mask, features.segment_ids, features.label_id,
+                                 guid=self.guids[index])
+
+
 class Robust45Processor(BertProcessor):
     NAME = 'Robust45'
     NUM_CLASSES = 2
@@ -22,22 +34,22 @@ class Robust45Processor(BertProcessor):
               '620', '626', '646', '677', '690']
 
     def get_train_examples(self, data_dir, **kwargs):
-        return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, 'TREC', 'robust45_aug_train_%s.tsv' % kwargs['topic'])), 'train')
+        return self._read_examples(
+            os.path.join(data_dir, 'TREC', 'robust45_aug_train_%s.tsv' % kwargs['topic']), 'train')
 
     def get_dev_examples(self, data_dir, **kwargs):
-        return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, 'TREC', 'robust45_dev_%s.tsv' % kwargs['topic'])), 'dev')
+        return self._read_examples(
+            os.path.join(data_dir, 'TREC', 'robust45_dev_%s.tsv' % kwargs['topic']), 'dev')
 
     def get_test_examples(self, data_dir, **kwargs):
-        return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, 'TREC', 'core17_10k_%s.tsv' % kwargs['topic'])), 'test')
+        return self._read_examples(
+            os.path.join(data_dir, 'TREC', 'core17_10k_%s.tsv' % kwargs['topic']), 'test')
 
     @staticmethod
-    def _create_examples(lines, split):
+    def _create_examples(lines, split, start=0):
         """Creates examples for the training and dev sets."""
         examples = []
-        for (i, line) in enumerate(lines):
+        for (i, line) in enumerate(lines, start):
             if i == 0:
                 continue
             text_a = line[2]
@@ -50,16 +62,16 @@ class Robust45Processor(BertProcessor):
 
 def convert_examples_to_features(examples, max_seq_length, tokenizer, is_hierarchical=False):
     """
-    Loads a data file into a list of InputBatch objects
+    Loads a data file into a RelevanceFeatureStore
     :param is_hierarchical:
     :param examples:
     :param max_seq_length:
     :param tokenizer:
-    :return: a list of InputBatch objects
+    :return: a RelevanceFeatureStore with one row per example, or per sentence if is_hierarchical is set
     """
 
-    features = []
-    for (ex_index, example) in enumerate(examples):
+    sequences, num_sentences = list(), list()
+    for example in examples:
         if is_hierarchical:
             tokens_a = [tokenizer.tokenize(line) for line in sent_tokenize(example.text_a)]
 
@@ -69,22 +81,6 @@ def convert_examples_to_features(examples, max_seq_length, tokenizer, is_hierarc
                     tokens_a[i0] = tokens_a[i0][:(max_seq_length - 2)]
 
             tokens = [["[CLS]"] + line + ["[SEP]"] for line in tokens_a]
-            segment_ids = [[0] * len(line) for line in tokens]
-
-            input_ids = list()
-            for line in tokens:
-                input_ids.append(tokenizer.convert_tokens_to_ids(line))
-
-            # Input mask has 1 for real tokens and 0 for padding tokens
-            input_mask = [[1] * len(line_ids) for line_ids in input_ids]
-
-            # Zero-pad up to the sequence length.
-            padding = [[0] * (max_seq_length - len(line_ids)) for line_ids in input_ids]
-            for i0 in range(len(input_ids)):
-                input_ids[i0] += padding[i0]
-                input_mask[i0] += padding[i0]
-                segment_ids[i0] += padding[i0]
-
         else:
             tokens_a = tokenizer.tokenize(example.text_a)
 
@@ -92,29 +88,23 @@ def convert_examples_to_features(examples, max_seq_length, tokenizer, is_hierarc
             if len(tokens_a) > max_seq_length - 2:
                 tokens_a = tokens_a[:(max_seq_length - 2)]
 
-            tokens = ["[CLS]"] + tokens_a + ["[SEP]"]
-            segment_ids = [0] * len(tokens)
-
-            input_ids = tokenizer.convert_tokens_to_ids(tokens)
+            tokens = [["[CLS]"] + tokens_a + ["[SEP]"]]
 
-            # The mask has 1 for real tokens and 0 for padding tokens
-            input_mask = [1] * len(input_ids)
-
-            # Zero-pad up to the sequence length
-            padding = [0] * (max_seq_length - len(input_ids))
-            input_ids += padding
-            input_mask += padding
-            segment_ids += padding
+        sequences.extend(tokenizer.convert_tokens_to_ids(line) for line in tokens)
+        num_sentences.append(len(tokens))
 
+    guids = np.zeros(len(examples), dtype=np.int64)
+    for (ex_index, example) in enumerate(examples):
         try:
-            docid = int(example.guid)
+            guids[ex_index] = int(example.guid)
         except ValueError:
             # print("Error converting docid to integer:", string)
-            docid = 0
-
-        features.append(RelevanceFeatures(input_ids=input_ids,
-                                          input_mask=input_mask,
-                                          segment_ids=segment_ids,
-                                          label_id=0 if example.label == '01' else 1,
-                                          guid=docid))
-    return features
+            pass
+
+    # There is no second segment, so every row starts it past its last token
+    segment_starts = [len(ids) for ids in sequences]
+    return RelevanceFeatureStore.from_sequences(sequences, segment_starts, max_seq_length,
+                                                [0 if example.label == '01' else 1 for example in examples],
+                                                doc_offsets=offsets_from_lengths(num_sentences)
+                                                if is_hierarchical else None,
+                                                guids=guids)
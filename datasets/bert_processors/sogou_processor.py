@@ -9,21 +9,18 @@ class SogouProcessor(BertProcessor):
     IS_MULTILABEL = False
 
     def get_train_examples(self, data_dir):
-        return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, 'Sogou', 'train.tsv')), 'train')
+        return self._read_examples(os.path.join(data_dir, 'Sogou', 'train.tsv'), 'train')
 
     def get_dev_examples(self, data_dir):
-        return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, 'Sogou', 'dev.tsv')), 'dev')
+        return self._read_examples(os.path.join(data_dir, 'Sogou', 'dev.tsv'), 'dev')
 
     def get_test_examples(self, data_dir):
-        return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, 'Sogou', 'test.tsv')), 'test')
+        return self._read_examples(os.path.join(data_dir, 'Sogou', 'test.tsv'), 'test')
 
-    def _create_examples(self, lines, set_type):
+    def _create_examples(self, lines, set_type, start=0):
         """Creates examples for the training and dev sets."""
         examples = []
-        for (i, line) in enumerate(lines):
+        for (i, line) in enumerate(lines, start):
             if i == 0:
                 continue
             guid = "%s-%s" % (set_type, i)
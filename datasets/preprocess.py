@@ -0,0 +1,111 @@
+import os
+from argparse import ArgumentParser
+
+import torch
+
+from datasets import shards
+from datasets.aapd import AAPD, AAPDHierarchical
+from datasets.imdb import IMDB, IMDBHierarchical
+from datasets.lyricsArtist import LyricsArtist, LyricsArtistHierarchical
+from datasets.lyricsGenre import LyricsGenre, LyricsGenreHierarchical
+from datasets.reuters import Reuters, ReutersHierarchical
+from datasets.robust04 import Robust04, Robust04Hierarchical
+from datasets.robust05 import Robust05, Robust05Hierarchical
+from datasets.robust45 import Robust45, Robust45Hierarchical
+from datasets.sst import SST, SSTHierarchical
+from datasets.yelp2014 import Yelp2014, Yelp2014Hierarchical
+from utils.vectors import load_vectors
+from utils.vocab import prune_vocab
+
+
+class UnknownWordVecCache(object):
+    """
+    Caches the first randomly generated word vector for a certain size to make it is reused.
+    """
+    cache = {}
+
+    @classmethod
+    def unk(cls, tensor):
+        size_tup = tuple(tensor.size())
+        if size_tup not in cls.cache:
+            cls.cache[size_tup] = torch.Tensor(tensor.size())
+            cls.cache[size_tup].uniform_(-0.25, 0.25)
+        return cls.cache[size_tup]
+
+
+def preprocess(dataset_cls, data_dir, vectors, vectors_name, vectors_cache, topic=None, deduplicate=False,
+               pruning=None):
+    if topic is None:
+        source_paths = [os.path.join(dataset_cls.NAME, '%s.tsv' % split) for split in shards.SPLITS]
+        splits = dataset_cls.splits(data_dir)
+    else:
+        source_paths = dataset_cls.split_paths(topic)
+        splits = dataset_cls.splits(data_dir, train=source_paths[0], validation=source_paths[1], test=source_paths[2])
+
+    if pruning:
+        # Only the words of the training split are kept, see utils.vocab.prune_vocab
+        prune_vocab(dataset_cls.TEXT_FIELD, splits[0], vectors, **pruning)
+    else:
+        dataset_cls.TEXT_FIELD.build_vocab(*splits, vectors=vectors)
+    directory = shards.shard_dir(data_dir, dataset_cls, topic)
+    shards.write_shards(directory, dataset_cls, splits, [os.path.join(data_dir, p) for p in source_paths], vectors_name,
+                        vectors_cache, deduplicate_splits=deduplicate)
+    print('Vocabulary size:', len(dataset_cls.TEXT_FIELD.vocab))
+    print('Saved shards to', directory)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Persist the vocabulary and numericalized splits of a dataset")
+    parser.add_argument('--dataset', type=str, required=True, choices=['Reuters', 'AAPD', 'IMDB', 'Yelp2014', 'SST-2',
+                                                                       'LyricsGenre', 'LyricsArtist', 'Robust04',
+                                                                       'Robust05', 'Robust45'])
+    parser.add_argument('--hierarchical', action='store_true', help='preprocess the dataset for HAN')
+    parser.add_argument('--topic', type=str, default=None, help='relevance transfer topic, defaults to all topics')
+    parser.add_argument('--deduplicate', action='store_true',
+                        help='store one copy of duplicate examples, weighted by their number of copies')
+    parser.add_argument('--min-freq', type=int, default=None,
+                        help='prune the vocabulary to training words seen at least this many times')
+    parser.add_argument('--max-vocab-size', type=int, default=None,
+                        help='prune the vocabulary to this many of the most frequent training words')
+    parser.add_argument('--vocab-coverage', type=float, default=None,
+                        help='prune the vocabulary to the most frequent training words covering this fraction of the '
+                             'training tokens')
+    parser.add_argument('--hash-buckets', type=int, default=0,
+                        help='map words outside a pruned vocabulary to this many shared rows by hash instead of <unk>')
+    parser.add_argument('--seed', type=int, default=3435)
+    parser.add_argument('--data-dir', default=os.path.join(os.pardir, 'hedwig-data', 'datasets'))
+    parser.add_argument('--word-vectors-dir', default=os.path.join(os.pardir, 'hedwig-data', 'embeddings', 'word2vec'))
+    parser.add_argument('--word-vectors-file', default='GoogleNews-vectors-negative300.txt')
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+
+    dataset_map = {
+        'Reuters': (Reuters, ReutersHierarchical),
+        'AAPD': (AAPD, AAPDHierarchical),
+        'IMDB': (IMDB, IMDBHierarchical),
+        'Yelp2014': (Yelp2014, Yelp2014Hierarchical),
+        'SST-2': (SST, SSTHierarchical),
+        'LyricsGenre': (LyricsGenre, LyricsGenreHierarchical),
+        'LyricsArtist': (LyricsArtist, LyricsArtistHierarchical),
+        'Robust04': (Robust04, Robust04Hierarchical),
+        'Robust05': (Robust05, Robust05Hierarchical),
+        'Robust45': (Robust45, Robust45Hierarchical)
+    }
+
+    dataset_class = dataset_map[args.dataset][1 if args.hierarchical else 0]
+    vectors = load_vectors(args.word_vectors_file, args.word_vectors_dir, unk_init=UnknownWordVecCache.unk)
+    pruning = None
+    if args.min_freq or args.max_vocab_size or args.vocab_coverage or args.hash_buckets:
+        pruning = {'min_freq': args.min_freq or 1, 'max_size': args.max_vocab_size, 'coverage': args.vocab_coverage,
+                   'num_buckets': args.hash_buckets}
+
+    if hasattr(dataset_class, 'TOPICS'):
+        topics = [args.topic] if args.topic else dataset_class.TOPICS
+        for topic in topics:
+            print('Preprocessing topic', topic)
+            preprocess(dataset_class, args.data_dir, vectors, args.word_vectors_file, args.word_vectors_dir,
+                       topic=topic, deduplicate=args.deduplicate, pruning=pruning)
+    else:
+        preprocess(dataset_class, args.data_dir, vectors, args.word_vectors_file, args.word_vectors_dir,
+                   deduplicate=args.deduplicate, pruning=pruning)
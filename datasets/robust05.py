@@ -5,9 +5,10 @@ import sys
 import torch
 from torchtext.data import NestedField, Field, TabularDataset
 from torchtext.data.iterator import BucketIterator
-from torchtext.vocab import Vectors
 
+from datasets import shards
 from datasets.robust45 import clean_string, split_sents, process_docids, process_labels
+from utils.vectors import load_vectors
 
 csv.field_size_limit(sys.maxsize)
 
@@ -26,6 +27,12 @@ class Robust05(TabularDataset):
     def sort_key(ex):
         return len(ex.text)
 
+    @staticmethod
+    def split_paths(topic):
+        return (os.path.join('TREC', 'robust05_train_%s.tsv' % topic),
+                os.path.join('TREC', 'robust05_dev_%s.tsv' % topic),
+                os.path.join('TREC', 'core17_%s.tsv' % topic))
+
     @classmethod
     def splits(cls, path, train, validation, test, **kwargs):
         return super(Robust05, cls).splits(
@@ -47,12 +54,14 @@ class Robust05(TabularDataset):
         :param unk_init: function used to generate vector for OOV words
         :return:
         """
+        directory = shards.shard_dir(path, cls, topic)
+        if vectors is None and shards.is_fresh(directory, vectors_name, vectors_cache):
+            return shards.iters(cls, directory, batch_size=batch_size, shuffle=shuffle, device=device)
+
         if vectors is None:
-            vectors = Vectors(name=vectors_name, cache=vectors_cache, unk_init=unk_init)
+            vectors = load_vectors(vectors_name, vectors_cache, unk_init=unk_init)
 
-        train_path = os.path.join('TREC', 'robust05_train_%s.tsv' % topic)
-        dev_path = os.path.join('TREC', 'robust05_dev_%s.tsv' % topic)
-        test_path = os.path.join('TREC', 'core17_%s.tsv' % topic)
+        train_path, dev_path, test_path = cls.split_paths(topic)
         train, val, test = cls.splits(path, train=train_path, validation=dev_path, test=test_path)
         cls.TEXT_FIELD.build_vocab(train, val, test, vectors=vectors)
         return BucketIterator.splits((train, val, test), batch_size=batch_size, repeat=False, shuffle=shuffle,
@@ -0,0 +1,300 @@
+import json
+import math
+import os
+import random
+import types
+
+import numpy as np
+import torch
+
+from utils.dedup import deduplicate
+from utils.vectors import vectors_files
+
+META_NAME = 'meta.json'
+VOCAB_NAME = 'vocab.pt'
+SPLITS = ('train', 'dev', 'test')
+
+
+def shard_dir(path, dataset_cls, topic=None):
+    """
+    Returns the directory holding the preprocessed shards of a dataset class
+    :param path: directory containing the datasets
+    :param dataset_cls: dataset class, e.g. Reuters or ReutersHierarchical
+    :param topic: topic for the relevance transfer datasets
+    :return: path to the shard directory
+    """
+    directory = os.path.join(path, 'shards', dataset_cls.__name__)
+    return directory if topic is None else os.path.join(directory, topic)
+
+
+def _file_stamp(file_path):
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime]
+
+
+def _vectors_stamps(vectors_name, vectors_cache):
+    return {os.path.abspath(p): _file_stamp(p) for p in vectors_files(vectors_name, vectors_cache)}
+
+
+def is_fresh(directory, vectors_name, vectors_cache):
+    """
+    Checks that the shards in a directory exist, were built with the given word vectors and that neither their
+    source files nor the word vectors files changed since they were written
+    :param directory: shard directory
+    :param vectors_name: name of word vectors file
+    :param vectors_cache: path to directory containing word vectors file
+    :return: True if the shards can be used
+    """
+    meta_path = os.path.join(directory, META_NAME)
+    if not os.path.isfile(meta_path):
+        return False
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    if meta['vectors_name'] != vectors_name:
+        return False
+    # Shards written before the vectors files were stamped have no 'vectors' entry and are rebuilt
+    if meta.get('vectors') != _vectors_stamps(vectors_name, vectors_cache):
+        return False
+    for source_path, stamp in meta['sources'].items():
+        if not os.path.isfile(source_path) or _file_stamp(source_path) != stamp:
+            return False
+    return True
+
+
+def _example_key(token_ids, sentence_lengths, label):
+    return (np.array(token_ids, dtype=np.int32).tobytes() + b'\0' +
+            np.array(sentence_lengths, dtype=np.int64).tobytes() + b'\0' + np.array(label).tobytes())
+
+
+def write_shards(directory, dataset_cls, splits, source_paths, vectors_name, vectors_cache, deduplicate_splits=False):
+    """
+    Writes the vocabulary and numericalized examples of a dataset. Token ids of each split are stored as a flat
+    int32 array with int64 offsets, so they can be memory-mapped and batched without re-tokenizing the TSV files.
+    Hierarchical datasets additionally store sentence offsets.
+    :param directory: output directory
+    :param dataset_cls: dataset class whose TEXT_FIELD vocabulary has been built
+    :param splits: train, dev and test datasets returned by dataset_cls.splits
+    :param source_paths: TSV files the splits were read from
+    :param vectors_name: name of word vectors file the vocabulary vectors were loaded from
+    :param vectors_cache: path to directory containing word vectors file
+    :param deduplicate_splits: keep one copy of examples with the same token ids and label, with the number of
+    copies stored as its weight. Only the training split of datasets with document ids is deduplicated, as the
+    other splits are ranked per document.
+    """
+    os.makedirs(directory, exist_ok=True)
+    vocab = dataset_cls.TEXT_FIELD.vocab
+    is_hierarchical = hasattr(dataset_cls.TEXT_FIELD, 'nesting_field')
+    torch.save(vocab, os.path.join(directory, VOCAB_NAME))
+
+    num_examples = list()
+    for split_name, split in zip(SPLITS, splits):
+        stoi = vocab.stoi
+        examples, weights = split.examples, None
+        if deduplicate_splits and (split_name == 'train' or not hasattr(dataset_cls, 'DOCID_FIELD')):
+            if is_hierarchical:
+                keys = (_example_key([stoi[token] for sentence in example.text for token in sentence],
+                                     [len(sentence) for sentence in example.text], example.label)
+                        for example in examples)
+            else:
+                keys = (_example_key([stoi[token] for token in example.text], [], example.label)
+                        for example in examples)
+            first, _, weights = deduplicate(keys)
+            examples = [examples[i] for i in first]
+
+        token_ids, offsets, sentence_offsets = list(), [0], [0]
+        for example in examples:
+            if is_hierarchical:
+                for sentence in example.text:
+                    token_ids.extend(stoi[token] for token in sentence)
+                    sentence_offsets.append(len(token_ids))
+                offsets.append(len(sentence_offsets) - 1)
+            else:
+                token_ids.extend(stoi[token] for token in example.text)
+                offsets.append(len(token_ids))
+
+        prefix = os.path.join(directory, split_name)
+        np.save(prefix + '.tokens.npy', np.array(token_ids, dtype=np.int32))
+        np.save(prefix + '.offsets.npy', np.array(offsets, dtype=np.int64))
+        if is_hierarchical:
+            np.save(prefix + '.sentence_offsets.npy', np.array(sentence_offsets, dtype=np.int64))
+        np.save(prefix + '.labels.npy', np.array([example.label for example in examples], dtype=np.int64))
+        if hasattr(dataset_cls, 'DOCID_FIELD'):
+            np.save(prefix + '.docids.npy', np.array([example.docid for example in examples], dtype=np.int64))
+        weights_path = prefix + '.weights.npy'
+        if weights is not None:
+            np.save(weights_path, weights)
+        elif os.path.isfile(weights_path):
+            os.remove(weights_path)
+        num_examples.append(len(examples))
+
+    meta = {
+        'dataset': dataset_cls.__name__,
+        'is_hierarchical': is_hierarchical,
+        'vectors_name': vectors_name,
+        'vectors': _vectors_stamps(vectors_name, vectors_cache),
+        'num_examples': num_examples,
+        'deduplicated': bool(deduplicate_splits),
+        'sources': {os.path.abspath(p): _file_stamp(p) for p in source_paths}
+    }
+    with open(os.path.join(directory, META_NAME), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+class ShardBatch(object):
+    """
+    A batch with the same attributes as the torchtext batches used by the trainers and evaluators. Batches of
+    deduplicated shards also hold the number of copies of each example in weight.
+    """
+
+    def __init__(self, text, label, docid=None, weight=None):
+        self.text = text
+        self.label = label
+        self.docid = docid
+        self.weight = weight
+        self.batch_size = len(label)
+
+
+class ShardedDataset(object):
+    """
+    Memory-mapped split of a preprocessed dataset. Class attributes and methods of the dataset class, such as
+    NAME, NUM_CLASSES and TEXT_FIELD, are available on instances as they are on torchtext datasets.
+    """
+
+    def __init__(self, dataset_cls, directory, split_name, is_hierarchical):
+        self.dataset_cls = dataset_cls
+        self.is_hierarchical = is_hierarchical
+        prefix = os.path.join(directory, split_name)
+        self.tokens = np.load(prefix + '.tokens.npy', mmap_mode='r')
+        self.offsets = np.load(prefix + '.offsets.npy')
+        self.labels = np.load(prefix + '.labels.npy', mmap_mode='r')
+        self.sentence_offsets = np.load(prefix + '.sentence_offsets.npy') if is_hierarchical else None
+        self.docids = np.load(prefix + '.docids.npy') if os.path.isfile(prefix + '.docids.npy') else None
+        self.weights = np.load(prefix + '.weights.npy') if os.path.isfile(prefix + '.weights.npy') else None
+        self.lengths = np.diff(self.offsets)
+
+    def __getattr__(self, name):
+        attr = getattr(self.dataset_cls, name)
+        if isinstance(attr, types.FunctionType):
+            # Bind instance methods such as set_attributes to this object
+            return attr.__get__(self)
+        return attr
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def examples(self):
+        # Only the number of examples is exposed, the token ids stay on disk
+        return range(len(self))
+
+    @staticmethod
+    def _gather(flat, starts, lengths, width, pad_value):
+        """
+        Copies variable length slices of a flat array into the rows of a padded matrix
+        """
+        padded = np.full((len(starts), width), pad_value, dtype=np.int64)
+        total = int(lengths.sum())
+        if total:
+            rows = np.repeat(np.arange(len(starts)), lengths)
+            cols = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+            padded[rows, cols] = flat[np.repeat(starts, lengths) + cols]
+        return padded
+
+    def text_batch(self, indices, pad_index):
+        if not self.is_hierarchical:
+            lengths = self.lengths[indices]
+            text = self._gather(self.tokens, self.offsets[indices], lengths, max(int(lengths.max()), 1), pad_index)
+            return torch.from_numpy(text), torch.from_numpy(lengths)
+
+        num_sentences = self.lengths[indices]
+        max_sentences = max(int(num_sentences.max()), 1)
+        sentence_ids = self._gather(np.arange(len(self.sentence_offsets) - 1), self.offsets[indices],
+                                    num_sentences, max_sentences, -1).reshape(-1)
+        is_sentence = sentence_ids >= 0
+        sentence_lengths = np.zeros(len(sentence_ids), dtype=np.int64)
+        sentence_lengths[is_sentence] = np.diff(self.sentence_offsets)[sentence_ids[is_sentence]]
+        sentence_starts = np.zeros(len(sentence_ids), dtype=np.int64)
+        sentence_starts[is_sentence] = self.sentence_offsets[sentence_ids[is_sentence]]
+        max_words = max(int(sentence_lengths.max()), 1)
+        text = self._gather(self.tokens, sentence_starts, sentence_lengths, max_words, pad_index)
+        return torch.from_numpy(text.reshape(len(indices), max_sentences, max_words))
+
+
+class ShardIterator(object):
+    """
+    Batches a ShardedDataset like torchtext's BucketIterator with sort_within_batch set: examples of similar
+    length are batched together and sorted by decreasing length within each batch.
+    """
+
+    def __init__(self, dataset, batch_size, train=True, shuffle=True, device=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.train = train
+        self.shuffle = shuffle
+        if isinstance(device, int):
+            device = torch.device('cpu') if device < 0 else torch.device('cuda', device)
+        self.device = device
+        self.pad_index = dataset.TEXT_FIELD.vocab.stoi['<pad>']
+        self.batches = None
+
+    def __len__(self):
+        return math.ceil(len(self.dataset) / self.batch_size)
+
+    def init_epoch(self):
+        lengths = self.dataset.lengths
+        if self.train and self.shuffle:
+            # Sort pools of 100 batches by length, then shuffle the batches
+            indices = np.random.permutation(len(self.dataset))
+            pool_size = 100 * self.batch_size
+            pools = [indices[i:i + pool_size] for i in range(0, len(indices), pool_size)]
+            indices = np.concatenate([pool[np.argsort(lengths[pool], kind='mergesort')] for pool in pools])
+        else:
+            indices = np.argsort(lengths, kind='mergesort')
+
+        self.batches = [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+        if self.train and self.shuffle:
+            random.shuffle(self.batches)
+
+    def __iter__(self):
+        if self.batches is None:
+            self.init_epoch()
+        for indices in self.batches:
+            indices = indices[np.argsort(-self.dataset.lengths[indices], kind='mergesort')]
+            text = self.dataset.text_batch(indices, self.pad_index)
+            label = torch.from_numpy(np.array(self.dataset.labels[indices]))
+            docid = torch.from_numpy(self.dataset.docids[indices]) if self.dataset.docids is not None else None
+            weight = torch.from_numpy(self.dataset.weights[indices]) if self.dataset.weights is not None else None
+            if isinstance(text, tuple):
+                text = tuple(self._to_device(t) for t in text)
+            else:
+                text = self._to_device(text)
+            yield ShardBatch(text, self._to_device(label), self._to_device(docid) if docid is not None else None,
+                             self._to_device(weight) if weight is not None else None)
+        self.batches = None
+
+    def _to_device(self, tensor):
+        return tensor if self.device is None else tensor.to(self.device)
+
+
+def iters(dataset_cls, directory, batch_size=64, shuffle=True, device=0):
+    """
+    Loads the vocabulary of a preprocessed dataset into its TEXT_FIELD and returns iterators over the
+    memory-mapped train, dev and test shards
+    :param dataset_cls: dataset class the shards were written for
+    :param directory: shard directory
+    :param batch_size: batch size
+    :param shuffle: shuffle the training batches every epoch
+    :param device: GPU device
+    :return: train, dev and test iterators
+    """
+    with open(os.path.join(directory, META_NAME), 'r') as f:
+        meta = json.load(f)
+
+    vocab = torch.load(os.path.join(directory, VOCAB_NAME))
+    dataset_cls.TEXT_FIELD.vocab = vocab
+    if meta['is_hierarchical']:
+        dataset_cls.TEXT_FIELD.nesting_field.vocab = vocab
+
+    return tuple(ShardIterator(ShardedDataset(dataset_cls, directory, split_name, meta['is_hierarchical']),
+                               batch_size, train=split_name == 'train', shuffle=shuffle, device=device)
+                 for split_name in SPLITS)
@@ -15,5 +15,19 @@ def get_args():
     parser.add_argument('--log-every', type=int, default=10)
     parser.add_argument('--local-rank', type=int, default=-1, help='local rank for distributed training')
     parser.add_argument('--data-dir', default=os.path.join(os.pardir, 'hedwig-data', 'datasets'))
+    parser.add_argument('--top-k', type=int, default=5,
+                        help='labels ranked per example for the metrics of multi-label datasets and topk predictions')
+    parser.add_argument('--threshold', type=float, default=0.5,
+                        help='probability above which a label among the top-k is predicted for the thresholded metrics')
+    parser.add_argument('--sparse-embeddings', action='store_true',
+                        help='train the embeddings of the rand and non-static modes with sparse gradients and SparseAdam')
+    parser.add_argument('--deduplicate', action='store_true',
+                        help='keep one copy of duplicate examples, weighted by their number of copies')
+    parser.add_argument('--compile', action='store_true',
+                        help='compile the model with torch.compile, padding batches to a few shapes')
+    parser.add_argument('--compile-warmup', action='store_true',
+                        help='compile every sequence length bucket before training')
+    parser.add_argument('--compile-cache-dir', default=os.path.join('cache', 'compile'),
+                        help='where compiled graphs are cached across runs')
 
     return parser
@@ -19,8 +19,9 @@ from datasets.bert_processors.lyricsGenre_processor import LyricsGenreProcessor
 from datasets.bert_processors.lyricsArtist_processor import LyricsArtistProcessor
 
 from models.bert.args import get_args
-from models.bert.model import BertForSequenceClassification
+from models.bert.model import BertForLongDocumentClassification, BertForSequenceClassification
 from utils.io import PYTORCH_PRETRAINED_BERT_CACHE
+from utils.compilation import compile_model
 from utils.optimization import BertAdam
 from utils.tokenization import BertTokenizer
 
@@ -83,6 +84,9 @@ if __name__ == '__main__':
     if args.dataset not in dataset_map:
         raise ValueError('Unrecognized dataset')
 
+    if args.long_document and args.local_rank != -1:
+        raise ValueError('Long document mode does not support distributed training')
+
     processor = dataset_map[args.dataset]()
     processor.set_num_classes_(args.data_dir)
 
@@ -98,6 +102,8 @@ if __name__ == '__main__':
 
     args.is_lowercase = 'uncased' in args.model
     args.is_hierarchical = False
+    if args.long_document and args.window_stride is None:
+        args.window_stride = (args.max_seq_length - 2) // 2
     tokenizer = BertTokenizer.from_pretrained(args.model, is_lowercase=args.is_lowercase)
 
     train_examples = None
@@ -110,11 +116,18 @@ if __name__ == '__main__':
             num_train_optimization_steps = num_train_optimization_steps // torch.distributed.get_world_size()
 
     cache_dir = args.cache_dir if args.cache_dir else os.path.join(str(PYTORCH_PRETRAINED_BERT_CACHE), 'distributed_{}'.format(args.local_rank))
-    model = BertForSequenceClassification.from_pretrained(args.model, cache_dir=cache_dir, num_labels=args.num_labels)
+    if args.long_document:
+        model_cls, model_kwargs = BertForLongDocumentClassification, {'aggregation': args.window_aggregation}
+    else:
+        model_cls, model_kwargs = BertForSequenceClassification, {}
+    model = model_cls.from_pretrained(args.model, cache_dir=cache_dir, num_labels=args.num_labels, **model_kwargs)
+    if args.freeze_layers:
+        model.freeze_layers(args.freeze_layers)
 
     if args.fp16:
         model.half()
     model.to(device)
+    model = compile_model(model, args)
 
     if args.local_rank != -1:
         try:
@@ -126,7 +139,7 @@ if __name__ == '__main__':
         model = torch.nn.DataParallel(model)
 
     # Prepare optimizer
-    param_optimizer = list(model.named_parameters())
+    param_optimizer = [(n, p) for n, p in model.named_parameters() if p.requires_grad]
     no_decay = ['bias', 'LayerNorm.bias', 'LayerNorm.weight']
     optimizer_grouped_parameters = [
         {'params': [p for n, p in param_optimizer if not any(nd in n for nd in no_decay)], 'weight_decay': 0.01},
@@ -160,7 +173,7 @@ if __name__ == '__main__':
         trainer.train()
         model = torch.load(trainer.snapshot_path)
     else:
-        model = BertForSequenceClassification.from_pretrained(args.model, num_labels=args.num_labels)
+        model = model_cls.from_pretrained(args.model, num_labels=args.num_labels, **model_kwargs)
         model_ = torch.load(args.trained_model, map_location=lambda storage, loc: storage)
         state={}
         for key in model_.state_dict().keys():
@@ -3,7 +3,7 @@ import os
 import models.args
 
 
-def get_args():
+def get_parser():
     parser = models.args.get_args()
 
     parser.add_argument('--model', default=None, type=str, required=True)
@@ -12,6 +12,22 @@ def get_args():
     parser.add_argument('--save-path', type=str, default=os.path.join('model_checkpoints', 'bert'))
     parser.add_argument('--cache-dir', default='cache', type=str)
     parser.add_argument('--trained-model', default=None, type=str)
+    parser.add_argument('--save-predictions', nargs='*', default=[], choices=['dev', 'test'],
+                        help='splits whose predictions are written to --predictions-dir')
+    parser.add_argument('--predictions-format', default='logits', choices=['logits', 'labels', 'topk'],
+                        help='store raw logits, predicted label ids or the --top-k labels and their scores')
+    parser.add_argument('--predictions-dir', default=os.path.join('predictions', 'bert'))
+    parser.add_argument('--freeze-layers', type=int, default=0,
+                        help='number of lower encoder layers frozen along with the embeddings')
+    parser.add_argument('--activation-cache-dir', default=os.path.join('cache', 'activations'),
+                        help='where the output of the frozen layers over the training set is cached')
+    parser.add_argument('--long-document', action='store_true',
+                        help='classify whole documents from overlapping windows instead of truncating them')
+    parser.add_argument('--window-stride', type=int, default=None,
+                        help='wordpieces between the starts of consecutive windows, defaults to half a window')
+    parser.add_argument('--max-windows', type=int, default=0, help='maximum number of windows per document')
+    parser.add_argument('--window-aggregation', default='max', choices=['max', 'mean', 'attention'],
+                        help='how the logits of the windows of a document are combined')
     parser.add_argument('--fp16', action='store_true', help='use 16-bit floating point precision')
 
     parser.add_argument('--max-seq-length',
@@ -38,5 +54,8 @@ def get_args():
                              '0 (default value): dynamic loss scaling.\n'
                              'Positive power of 2: static loss scaling value.\n')
 
-    args = parser.parse_args()
-    return args
+    return parser
+
+
+def get_args():
+    return get_parser().parse_args()
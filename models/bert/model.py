@@ -26,6 +26,7 @@ from io import open
 
 import torch
 from torch import nn
+from torch.nn import functional as F
 from torch.nn import CrossEntropyLoss
 
 from utils.io import cached_path
@@ -137,7 +138,9 @@ class BertConfig(object):
                  attention_probs_dropout_prob=0.1,
                  max_position_embeddings=512,
                  type_vocab_size=2,
-                 initializer_range=0.02):
+                 initializer_range=0.02,
+                 layer_num_attention_heads=None,
+                 layer_intermediate_sizes=None):
         """Constructs BertConfig.
 
         Args:
@@ -161,6 +164,9 @@ class BertConfig(object):
                 `BertModel`.
             initializer_range: The sttdev of the truncated_normal_initializer for
                 initializing all weight matrices.
+            layer_num_attention_heads: Optional number of attention heads of each layer of a pruned model.
+                Heads keep the size of those of an unpruned model with num_attention_heads heads.
+            layer_intermediate_sizes: Optional size of the intermediate layer of each layer of a pruned model.
         """
         if isinstance(vocab_size_or_config_json_file, str) or (sys.version_info[0] == 2
                         and isinstance(vocab_size_or_config_json_file, str)):
@@ -180,6 +186,8 @@ class BertConfig(object):
             self.max_position_embeddings = max_position_embeddings
             self.type_vocab_size = type_vocab_size
             self.initializer_range = initializer_range
+            self.layer_num_attention_heads = layer_num_attention_heads
+            self.layer_intermediate_sizes = layer_intermediate_sizes
         else:
             raise ValueError("First argument must be either a vocabulary size (int)"
                              "or the path to a pretrained model config file (str)")
@@ -212,6 +220,36 @@ class BertConfig(object):
         return json.dumps(self.to_dict(), indent=2, sort_keys=True) + "\n"
 
 
+def layer_num_attention_heads(config, layer_index):
+    sizes = getattr(config, 'layer_num_attention_heads', None)
+    return sizes[layer_index] if sizes else config.num_attention_heads
+
+
+def layer_intermediate_size(config, layer_index):
+    sizes = getattr(config, 'layer_intermediate_sizes', None)
+    return sizes[layer_index] if sizes else config.intermediate_size
+
+
+def prune_linear_layer(layer, index, dim=0):
+    """
+    Returns a linear layer keeping only some of the output or input features of another
+    :param layer: nn.Linear
+    :param index: indices of the kept features
+    :param dim: 0 to keep output features, 1 to keep input features
+    :return: nn.Linear
+    """
+    index = index.to(layer.weight.device)
+    weight = layer.weight.data.index_select(dim, index)
+    pruned = nn.Linear(weight.size(1), weight.size(0), bias=layer.bias is not None)
+    pruned = pruned.to(device=weight.device, dtype=weight.dtype)
+    pruned.weight.data.copy_(weight)
+    pruned.weight.requires_grad = layer.weight.requires_grad
+    if layer.bias is not None:
+        pruned.bias.data.copy_(layer.bias.data.index_select(0, index) if dim == 0 else layer.bias.data)
+        pruned.bias.requires_grad = layer.bias.requires_grad
+    return pruned
+
+
 try:
     from apex.normalization.fused_layer_norm import FusedLayerNorm as BertLayerNorm
 
@@ -266,13 +304,13 @@ class BertEmbeddings(nn.Module):
 
 
 class BertSelfAttention(nn.Module):
-    def __init__(self, config):
+    def __init__(self, config, layer_index=0):
         super(BertSelfAttention, self).__init__()
         if config.hidden_size % config.num_attention_heads != 0:
             raise ValueError(
                 "The hidden size (%d) is not a multiple of the number of attention "
                 "heads (%d)" % (config.hidden_size, config.num_attention_heads))
-        self.num_attention_heads = config.num_attention_heads
+        self.num_attention_heads = layer_num_attention_heads(config, layer_index)
         self.attention_head_size = int(config.hidden_size / config.num_attention_heads)
         self.all_head_size = self.num_attention_heads * self.attention_head_size
 
@@ -282,6 +320,21 @@ class BertSelfAttention(nn.Module):
 
         self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
 
+    def prune_heads(self, heads):
+        """
+        Keeps only some of the attention heads
+        :param heads: indices of the heads to keep
+        :return: indices of the features of the context layer that are kept
+        """
+        index = torch.cat([torch.arange(head * self.attention_head_size, (head + 1) * self.attention_head_size,
+                                        dtype=torch.long) for head in sorted(heads)])
+        self.query = prune_linear_layer(self.query, index)
+        self.key = prune_linear_layer(self.key, index)
+        self.value = prune_linear_layer(self.value, index)
+        self.num_attention_heads = len(heads)
+        self.all_head_size = self.num_attention_heads * self.attention_head_size
+        return index
+
     def transpose_for_scores(self, x):
         new_x_shape = x.size()[:-1] + (self.num_attention_heads, self.attention_head_size)
         x = x.view(*new_x_shape)
@@ -317,9 +370,10 @@ class BertSelfAttention(nn.Module):
 
 
 class BertSelfOutput(nn.Module):
-    def __init__(self, config):
+    def __init__(self, config, layer_index=0):
         super(BertSelfOutput, self).__init__()
-        self.dense = nn.Linear(config.hidden_size, config.hidden_size)
+        all_head_size = layer_num_attention_heads(config, layer_index) * (config.hidden_size // config.num_attention_heads)
+        self.dense = nn.Linear(all_head_size, config.hidden_size)
         self.LayerNorm = BertLayerNorm(config.hidden_size, eps=1e-12)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
@@ -331,10 +385,18 @@ class BertSelfOutput(nn.Module):
 
 
 class BertAttention(nn.Module):
-    def __init__(self, config):
+    def __init__(self, config, layer_index=0):
         super(BertAttention, self).__init__()
-        self.self = BertSelfAttention(config)
-        self.output = BertSelfOutput(config)
+        self.self = BertSelfAttention(config, layer_index)
+        self.output = BertSelfOutput(config, layer_index)
+
+    def prune_heads(self, heads):
+        """
+        Keeps only some of the attention heads, along with the input features of the output layer they feed
+        :param heads: indices of the heads to keep
+        """
+        index = self.self.prune_heads(heads)
+        self.output.dense = prune_linear_layer(self.output.dense, index, dim=1)
 
     def forward(self, input_tensor, attention_mask):
         self_output = self.self(input_tensor, attention_mask)
@@ -343,9 +405,9 @@ class BertAttention(nn.Module):
 
 
 class BertIntermediate(nn.Module):
-    def __init__(self, config):
+    def __init__(self, config, layer_index=0):
         super(BertIntermediate, self).__init__()
-        self.dense = nn.Linear(config.hidden_size, config.intermediate_size)
+        self.dense = nn.Linear(config.hidden_size, layer_intermediate_size(config, layer_index))
         if isinstance(config.hidden_act, str) or (sys.version_info[0] == 2 and isinstance(config.hidden_act, str)):
             self.intermediate_act_fn = ACT2FN[config.hidden_act]
         else:
@@ -358,9 +420,9 @@ class BertIntermediate(nn.Module):
 
 
 class BertOutput(nn.Module):
-    def __init__(self, config):
+    def __init__(self, config, layer_index=0):
         super(BertOutput, self).__init__()
-        self.dense = nn.Linear(config.intermediate_size, config.hidden_size)
+        self.dense = nn.Linear(layer_intermediate_size(config, layer_index), config.hidden_size)
         self.LayerNorm = BertLayerNorm(config.hidden_size, eps=1e-12)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
@@ -372,11 +434,20 @@ class BertOutput(nn.Module):
 
 
 class BertLayer(nn.Module):
-    def __init__(self, config):
+    def __init__(self, config, layer_index=0):
         super(BertLayer, self).__init__()
-        self.attention = BertAttention(config)
-        self.intermediate = BertIntermediate(config)
-        self.output = BertOutput(config)
+        self.attention = BertAttention(config, layer_index)
+        self.intermediate = BertIntermediate(config, layer_index)
+        self.output = BertOutput(config, layer_index)
+
+    def prune_intermediate(self, neurons):
+        """
+        Keeps only some of the neurons of the intermediate layer
+        :param neurons: indices of the neurons to keep
+        """
+        index = torch.tensor(sorted(neurons), dtype=torch.long)
+        self.intermediate.dense = prune_linear_layer(self.intermediate.dense, index)
+        self.output.dense = prune_linear_layer(self.output.dense, index, dim=1)
 
     def forward(self, hidden_states, attention_mask):
         attention_output = self.attention(hidden_states, attention_mask)
@@ -388,12 +459,16 @@ class BertLayer(nn.Module):
 class BertEncoder(nn.Module):
     def __init__(self, config):
         super(BertEncoder, self).__init__()
-        layer = BertLayer(config)
-        self.layer = nn.ModuleList([copy.deepcopy(layer) for _ in range(config.num_hidden_layers)])
+        if getattr(config, 'layer_num_attention_heads', None) or getattr(config, 'layer_intermediate_sizes', None):
+            # Layers of pruned models differ in size
+            self.layer = nn.ModuleList([BertLayer(config, i) for i in range(config.num_hidden_layers)])
+        else:
+            layer = BertLayer(config)
+            self.layer = nn.ModuleList([copy.deepcopy(layer) for _ in range(config.num_hidden_layers)])
 
-    def forward(self, hidden_states, attention_mask, output_all_encoded_layers=True):
+    def forward(self, hidden_states, attention_mask, output_all_encoded_layers=True, start_layer=0, end_layer=None):
         all_encoder_layers = []
-        for layer_module in self.layer:
+        for layer_module in self.layer[start_layer:end_layer]:
             hidden_states = layer_module(hidden_states, attention_mask)
             if output_all_encoded_layers:
                 all_encoder_layers.append(hidden_states)
@@ -688,12 +763,7 @@ class BertModel(BertPreTrainedModel):
         self.pooler = BertPooler(config)
         self.apply(self.init_bert_weights)
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None, output_all_encoded_layers=True):
-        if attention_mask is None:
-            attention_mask = torch.ones_like(input_ids)
-        if token_type_ids is None:
-            token_type_ids = torch.zeros_like(input_ids)
-
+    def extended_attention_mask(self, attention_mask):
         # We create a 3D attention mask from a 2D tensor mask.
         # Sizes are [batch_size, 1, 1, to_seq_length]
         # So we can broadcast to [batch_size, num_heads, from_seq_length, to_seq_length]
@@ -708,11 +778,66 @@ class BertModel(BertPreTrainedModel):
         # effectively the same as removing these entirely.
         extended_attention_mask = extended_attention_mask.to(dtype=next(self.parameters()).dtype) # fp16 compatibility
         extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
+        return extended_attention_mask
 
-        embedding_output = self.embeddings(input_ids, token_type_ids)
-        encoded_layers = self.encoder(embedding_output,
+    def prune(self, heads=None, neurons=None):
+        """
+        Removes attention heads and intermediate neurons from the encoder layers by slicing their weights. The
+        sizes of the pruned layers are kept in the config, so saved models load with from_pretrained.
+        :param heads: dict of the indices of the attention heads to keep by layer, other layers keep theirs
+        :param neurons: dict of the indices of the intermediate neurons to keep by layer
+        """
+        heads, neurons = heads or dict(), neurons or dict()
+        for i, layer in enumerate(self.encoder.layer):
+            if i in heads:
+                if not len(heads[i]):
+                    raise ValueError('Cannot remove every attention head of layer {}'.format(i))
+                layer.attention.prune_heads(heads[i])
+            if i in neurons:
+                if not len(neurons[i]):
+                    raise ValueError('Cannot remove every intermediate neuron of layer {}'.format(i))
+                layer.prune_intermediate(neurons[i])
+        self.config.layer_num_attention_heads = [layer.attention.self.num_attention_heads
+                                                 for layer in self.encoder.layer]
+        self.config.layer_intermediate_sizes = [layer.intermediate.dense.out_features for layer in self.encoder.layer]
+
+    def encode_prefix(self, input_ids, token_type_ids=None, attention_mask=None, num_layers=0):
+        """
+        Runs the embeddings and the first num_layers encoder layers
+        :param input_ids: token ids of shape [batch_size, sequence_length]
+        :param token_type_ids: segment ids of shape [batch_size, sequence_length]
+        :param attention_mask: input mask of shape [batch_size, sequence_length]
+        :param num_layers: number of encoder layers to run
+        :return: hidden states of shape [batch_size, sequence_length, hidden_size]
+        """
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        if token_type_ids is None:
+            token_type_ids = torch.zeros_like(input_ids)
+        hidden_states = self.embeddings(input_ids, token_type_ids)
+        if num_layers:
+            hidden_states = self.encoder(hidden_states, self.extended_attention_mask(attention_mask),
+                                         output_all_encoded_layers=False, end_layer=num_layers)[-1]
+        return hidden_states
+
+    def forward(self, input_ids=None, token_type_ids=None, attention_mask=None, output_all_encoded_layers=True,
+                hidden_states=None, start_layer=0):
+        # Inputs can also be the hidden states after the first start_layer layers, see encode_prefix
+        if hidden_states is None:
+            if attention_mask is None:
+                attention_mask = torch.ones_like(input_ids)
+            if token_type_ids is None:
+                token_type_ids = torch.zeros_like(input_ids)
+            hidden_states = self.embeddings(input_ids, token_type_ids)
+            start_layer = 0
+        elif attention_mask is None:
+            attention_mask = hidden_states.new_ones(hidden_states.shape[:2], dtype=torch.long)
+
+        extended_attention_mask = self.extended_attention_mask(attention_mask)
+        encoded_layers = self.encoder(hidden_states,
                                       extended_attention_mask,
-                                      output_all_encoded_layers=output_all_encoded_layers)
+                                      output_all_encoded_layers=output_all_encoded_layers,
+                                      start_layer=start_layer)
         sequence_output = encoded_layers[-1]
         pooled_output = self.pooler(sequence_output)
         if not output_all_encoded_layers:
@@ -811,14 +936,12 @@ class BertForSequenceClassification(BertPreTrainedModel):
             selected in [0, 1]. It's a mask to be used if the input sequence length is smaller than the max
             input sequence length in the current batch. It's the mask that we typically use for attention when
             a batch has varying length sentences.
-        `labels`: labels for the classification output: torch.LongTensor of shape [batch_size]
-            with indices selected in [0, ..., num_labels].
+        `frozen_hidden_states`: an optional torch.FloatTensor of shape [batch_size, sequence_length, hidden_size]
+            with the output of `encode_frozen`. When given, `input_ids` and `token_type_ids` are ignored and
+            only the layers above the frozen prefix are run.
 
     Outputs:
-        if `labels` is not `None`:
-            Outputs the CrossEntropy classification loss of the output with the labels.
-        if `labels` is `None`:
-            Outputs the classification logits of shape [batch_size, num_labels].
+        Outputs the classification logits of shape [batch_size, num_labels].
 
     Example usage:
     ```python
@@ -834,18 +957,124 @@ class BertForSequenceClassification(BertPreTrainedModel):
 
     model = BertForSequenceClassification(config, num_labels)
     logits = model(input_ids, token_type_ids, input_mask)
+
+    # Fine-tune only the top two layers, reusing the output of the frozen prefix
+    model.freeze_layers(10)
+    hidden_states = model.encode_frozen(input_ids, token_type_ids, input_mask)
+    logits = model(attention_mask=input_mask, frozen_hidden_states=hidden_states)
     ```
     """
     def __init__(self, config, num_labels):
         super(BertForSequenceClassification, self).__init__(config)
         self.num_labels = num_labels
+        self.num_frozen_layers = 0
         self.bert = BertModel(config)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
         self.classifier = nn.Linear(config.hidden_size, num_labels)
         self.apply(self.init_bert_weights)
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None):
-        _, pooled_output = self.bert(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=False)
+    def freeze_layers(self, num_layers):
+        """
+        Stops the gradient updates of the embeddings and the lowest num_layers encoder layers
+        :param num_layers: number of encoder layers to freeze
+        """
+        if not 0 < num_layers <= len(self.bert.encoder.layer):
+            raise ValueError('Cannot freeze {} of {} layers'.format(num_layers, len(self.bert.encoder.layer)))
+        self.num_frozen_layers = num_layers
+        for module in [self.bert.embeddings] + list(self.bert.encoder.layer[:num_layers]):
+            for param in module.parameters():
+                param.requires_grad = False
+
+    def encode_frozen(self, input_ids, token_type_ids=None, attention_mask=None):
+        """
+        Runs the frozen prefix of the model
+        :return: hidden states of shape [batch_size, sequence_length, hidden_size]
+        """
+        return self.bert.encode_prefix(input_ids, token_type_ids, attention_mask, num_layers=self.num_frozen_layers)
+
+    def forward(self, input_ids=None, token_type_ids=None, attention_mask=None, frozen_hidden_states=None):
+        # Snapshots saved before layer freezing existed have no num_frozen_layers
+        start_layer = getattr(self, 'num_frozen_layers', 0) if frozen_hidden_states is not None else 0
+        _, pooled_output = self.bert(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=False,
+                                     hidden_states=frozen_hidden_states, start_layer=start_layer)
         pooled_output = self.dropout(pooled_output)
         logits = self.classifier(pooled_output)
         return logits
+
+
+class BertForLongDocumentClassification(BertForSequenceClassification):
+    """BERT model for classifying documents longer than the maximum sequence length.
+    Documents are split into overlapping windows that are classified like sequences by
+    `BertForSequenceClassification`, and `aggregate` combines the logits of the windows of each document.
+
+    Params:
+        `config`: a BertConfig class instance with the configuration to build a new model.
+        `num_labels`: the number of classes for the classifier. Default = 2.
+        `aggregation`: how window logits are combined, one of `max`, `mean` or `attention`. Attention weights
+            the windows of a document with a softmax over scores computed from their pooled outputs.
+
+    Inputs:
+        `input_ids`, `token_type_ids` and `attention_mask` of a batch of windows, as for
+        `BertForSequenceClassification`.
+
+    Outputs: Tuple of (logits, scores)
+        `logits`: the classification logits of each window, of shape [num_windows, num_labels].
+        `scores`: the attention score of each window, of shape [num_windows, 1], zero unless the aggregation is
+            `attention`.
+
+    Example usage:
+    ```python
+    # Two windows of the first document and one of the second
+    input_ids = torch.LongTensor([[31, 51, 99], [51, 99, 15], [15, 5, 0]])
+    doc_index = torch.LongTensor([0, 0, 1])
+    window_index = torch.LongTensor([0, 1, 0])
+
+    model = BertForLongDocumentClassification(config, num_labels=2, aggregation='max')
+    logits, scores = model(input_ids)
+    doc_logits = model.aggregate(logits, scores, doc_index, window_index, num_docs=2)
+    ```
+    """
+    def __init__(self, config, num_labels, aggregation='max'):
+        super(BertForLongDocumentClassification, self).__init__(config, num_labels)
+        if aggregation not in ('max', 'mean', 'attention'):
+            raise ValueError('Unrecognized aggregation: {}'.format(aggregation))
+        self.aggregation = aggregation
+        self.window_attention = nn.Linear(config.hidden_size, 1) if aggregation == 'attention' else None
+        self.apply(self.init_bert_weights)
+
+    def forward(self, input_ids=None, token_type_ids=None, attention_mask=None, frozen_hidden_states=None):
+        start_layer = self.num_frozen_layers if frozen_hidden_states is not None else 0
+        _, pooled_output = self.bert(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=False,
+                                     hidden_states=frozen_hidden_states, start_layer=start_layer)
+        pooled_output = self.dropout(pooled_output)
+        logits = self.classifier(pooled_output)
+        if self.window_attention is not None:
+            scores = self.window_attention(pooled_output)
+        else:
+            scores = logits.new_zeros(logits.size(0), 1)
+        return logits, scores
+
+    def aggregate(self, logits, scores, doc_index, window_index, num_docs):
+        """
+        Combines the logits of the windows of each document
+        :param logits: window logits of shape [num_windows, num_labels]
+        :param scores: window attention scores of shape [num_windows, 1]
+        :param doc_index: document of each window, in [0, num_docs)
+        :param window_index: position of each window within its document
+        :param num_docs: number of documents
+        :return: document logits of shape [num_docs, num_labels]
+        """
+        # Windows are scattered into a (documents, windows, labels) grid, missing windows are masked out
+        width = int(window_index.max()) + 1
+        flat_index = doc_index * width + window_index
+        padded = logits.new_zeros(num_docs * width, logits.size(1)).index_copy(0, flat_index, logits)
+        padded = padded.view(num_docs, width, -1)
+        mask = logits.new_zeros(num_docs * width, 1).index_fill(0, flat_index, 1).view(num_docs, width, 1)
+
+        if self.aggregation == 'max':
+            return padded.masked_fill(mask == 0, -float('inf')).max(dim=1)[0]
+        if self.aggregation == 'mean':
+            return padded.sum(dim=1) / mask.sum(dim=1)
+        padded_scores = scores.new_full((num_docs * width, 1), -float('inf')).index_copy(0, flat_index, scores)
+        weights = F.softmax(padded_scores.view(num_docs, width, 1), dim=1)
+        return (weights * padded).sum(dim=1)
@@ -0,0 +1,260 @@
+import copy
+import json
+import os
+import random
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, SequentialSampler
+from tqdm import tqdm
+
+from common.evaluators.bert_evaluator import BertEvaluator
+from datasets.bert_processors.aapd_processor import AAPDProcessor
+from datasets.bert_processors.abstract_processor import deduplicate_examples
+from datasets.bert_processors.agnews_processor import AGNewsProcessor
+from datasets.bert_processors.imdb_processor import IMDBProcessor
+from datasets.bert_processors.reuters_processor import ReutersProcessor
+from datasets.bert_processors.sogou_processor import SogouProcessor
+from datasets.bert_processors.sst_processor import SST2Processor
+from datasets.bert_processors.yelp2014_processor import Yelp2014Processor
+from datasets.bert_processors.lyricsGenre_processor import LyricsGenreProcessor
+from datasets.bert_processors.lyricsArtist_processor import LyricsArtistProcessor
+
+from models.bert.args import get_parser
+from models.bert.model import BertForSequenceClassification, CONFIG_NAME, WEIGHTS_NAME
+from utils.io import PYTORCH_PRETRAINED_BERT_CACHE
+from utils.tokenization import BertTokenizer, VOCAB_NAME
+
+# String templates for logging results
+LOG_HEADER = 'Heads    FFN   GFLOPs  Params(M)  Dev/Acc.   Dev/F1  Dev/Loss  Time(s)'
+LOG_TEMPLATE = ' '.join('{:>5d},{:>6d},{:>8.2f},{:>10.1f},{:>9.4f},{:>8.4f},{:>9.4f},{:>8.1f}'.split(','))
+
+
+def importance_scores(model, features, args):
+    """
+    Scores the attention heads and intermediate neurons of a model by the first order estimate of the change of
+    the loss when each is removed (Michel et al., 2019). This is the gradient of the loss with respect to a gate
+    on the output of the head or neuron, i.e. the dot product of the output with its gradient. It is summed over
+    the tokens of each example, and its absolute value is summed over the examples.
+    :param model: BertForSequenceClassification
+    :param features: features of the examples to score on, with their weights if they were deduplicated
+    :param args: command line arguments
+    :return: lists of the importance of the heads and of the neurons of each layer
+    """
+    layers = model.bert.encoder.layer
+    head_scores = [torch.zeros(layer.attention.self.num_attention_heads, device=args.device) for layer in layers]
+    neuron_scores = [torch.zeros(layer.intermediate.dense.out_features, device=args.device) for layer in layers]
+
+    def hook(scores):
+        def forward_hook(module, inputs, output):
+            def backward_hook(grad):
+                contribution = (output.detach() * grad).view(output.size(0), output.size(1), scores.size(0), -1)
+                scores.add_(contribution.sum(dim=3).sum(dim=1).abs().sum(dim=0).float())
+            output.register_hook(backward_hook)
+        return forward_hook
+
+    handles = [layer.attention.self.register_forward_hook(hook(scores)) for layer, scores in zip(layers, head_scores)]
+    handles += [layer.intermediate.register_forward_hook(hook(scores)) for layer, scores in zip(layers, neuron_scores)]
+
+    # Dropout is disabled, gradients are only computed for the scores
+    model.eval()
+    data = features.tensor_dataset()
+    dataloader = DataLoader(data, sampler=SequentialSampler(data), batch_size=args.batch_size)
+    try:
+        for batch in tqdm(dataloader, desc="Scoring"):
+            input_ids, input_mask, segment_ids, label_ids = [t.to(args.device).long() for t in batch[:4]]
+            logits = model(input_ids, segment_ids, input_mask)
+            if args.is_multilabel:
+                loss = F.binary_cross_entropy_with_logits(logits, label_ids.float(), reduce=False).sum(dim=1)
+            else:
+                loss = F.cross_entropy(logits, torch.argmax(label_ids, dim=1), reduce=False)
+            if len(batch) > 4:
+                # Deduplicated examples count once per copy
+                loss = loss * batch[4].to(args.device).float()
+            loss.sum().backward()
+            model.zero_grad()
+    finally:
+        for handle in handles:
+            handle.remove()
+    return head_scores, neuron_scores
+
+
+def select_units(importance, sparsity):
+    """
+    Chooses the units to keep across all layers. Scores are divided by their L2 norm within each layer, so the
+    layers compete on the relative importance of their units, and the lowest scoring fraction of all units is
+    removed. The highest scoring unit of every layer is always kept.
+    :param importance: list of the importance of the units of each layer
+    :param sparsity: fraction of the units to remove
+    :return: dict of the indices of the kept units by layer
+    """
+    scores = [layer / layer.norm().clamp(min=1e-12) for layer in importance]
+    for layer in scores:
+        layer[layer.argmax()] = float('inf')
+    flat = torch.cat(scores)
+    num_removed = min(int(round(sparsity * flat.numel())), flat.numel() - len(scores))
+    keep = torch.ones_like(flat, dtype=torch.long)
+    keep[torch.sort(flat)[1][:num_removed]] = 0
+    return {i: layer.nonzero().view(-1).tolist()
+            for i, layer in enumerate(torch.split(keep, [layer.numel() for layer in scores]))}
+
+
+def count_flops(model, seq_length):
+    """
+    Counts the FLOPs of classifying a sequence, two per multiply-add of the matrix products. The embeddings,
+    softmax, activations and layer normalization are left out.
+    :param model: BertForSequenceClassification
+    :param seq_length: number of tokens of the sequence
+    :return: number of FLOPs
+    """
+    hidden_size = model.config.hidden_size
+    flops = 0
+    for layer in model.bert.encoder.layer:
+        all_head_size = layer.attention.self.all_head_size
+        # Query, key, value and output projections, attention scores and weighted values
+        flops += 2 * 4 * seq_length * hidden_size * all_head_size + 2 * 2 * seq_length * seq_length * all_head_size
+        # Intermediate and output layers
+        flops += 2 * 2 * seq_length * hidden_size * layer.intermediate.dense.out_features
+    return flops + 2 * hidden_size * (hidden_size + model.num_labels)
+
+
+def save_pretrained(model, tokenizer, path):
+    """
+    Saves a model with its config and vocabulary, so it loads with from_pretrained and can be fine-tuned further
+    by passing the directory as --model
+    :param model: BertForSequenceClassification
+    :param tokenizer: BertTokenizer of the model
+    :param path: output directory
+    """
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, CONFIG_NAME), 'w', encoding='utf-8') as f:
+        f.write(model.config.to_json_string())
+    torch.save(OrderedDict((key, value.cpu()) for key, value in model.state_dict().items()),
+               os.path.join(path, WEIGHTS_NAME))
+    with open(os.path.join(path, VOCAB_NAME), 'w', encoding='utf-8') as f:
+        for token, _ in sorted(tokenizer.vocab.items(), key=lambda item: item[1]):
+            f.write(token + '\n')
+
+
+def load_model(args):
+    cache_dir = args.cache_dir if args.cache_dir else os.path.join(str(PYTORCH_PRETRAINED_BERT_CACHE), 'distributed_-1')
+    model = BertForSequenceClassification.from_pretrained(args.model, cache_dir=cache_dir, num_labels=args.num_labels)
+    if args.trained_model:
+        model_ = torch.load(args.trained_model, map_location=lambda storage, loc: storage)
+        model.load_state_dict({key.replace("module.", ""): value for key, value in model_.state_dict().items()})
+    return model.to(args.device)
+
+
+def evaluate(model, processor, args):
+    evaluator = BertEvaluator(model, processor, args, split='dev')
+    start_time = time.time()
+    accuracy, precision, recall, f1, avg_loss = evaluator.get_scores(silent=True)[0]
+    return {
+        'heads': sum(layer.attention.self.num_attention_heads for layer in model.bert.encoder.layer),
+        'neurons': sum(layer.intermediate.dense.out_features for layer in model.bert.encoder.layer),
+        'gflops': count_flops(model, args.max_seq_length) / 1e9,
+        'parameters': sum(param.numel() for param in model.parameters()),
+        'accuracy': accuracy,
+        'precision': precision,
+        'recall': recall,
+        'f1': f1,
+        'loss': avg_loss,
+        'time': time.time() - start_time
+    }
+
+
+def get_args():
+    parser = get_parser()
+    parser.description = "Prune the attention heads and intermediate neurons of a fine-tuned BERT model"
+    parser.add_argument('--head-sparsity', nargs='+', type=float, default=[0.25, 0.5],
+                        help='fractions of the attention heads to remove, one pruned model is saved for each')
+    parser.add_argument('--ffn-sparsity', nargs='+', type=float, default=None,
+                        help='fractions of the intermediate neurons to remove, defaults to --head-sparsity')
+    parser.add_argument('--pruned-dir', default=None,
+                        help='where the pruned models are saved, defaults to <save-path>/<dataset>/pruned')
+    args = parser.parse_args()
+
+    args.ffn_sparsity = args.ffn_sparsity or args.head_sparsity
+    if len(args.head_sparsity) == 1:
+        args.head_sparsity = args.head_sparsity * len(args.ffn_sparsity)
+    if len(args.ffn_sparsity) == 1:
+        args.ffn_sparsity = args.ffn_sparsity * len(args.head_sparsity)
+    if len(args.head_sparsity) != len(args.ffn_sparsity):
+        parser.error('--head-sparsity and --ffn-sparsity must have the same number of values')
+    if any(not 0 <= sparsity < 1 for sparsity in args.head_sparsity + args.ffn_sparsity):
+        parser.error('Sparsities must be in [0, 1)')
+    return args
+
+
+if __name__ == '__main__':
+    args = get_args()
+    device = torch.device("cuda" if torch.cuda.is_available() and args.cuda else "cpu")
+    print('Device:', str(device).upper())
+
+    # Set random seed for reproducibility
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    dataset_map = {
+        'SST-2': SST2Processor,
+        'Reuters': ReutersProcessor,
+        'IMDB': IMDBProcessor,
+        'AAPD': AAPDProcessor,
+        'AGNews': AGNewsProcessor,
+        'Yelp2014': Yelp2014Processor,
+        'Sogou': SogouProcessor,
+        'LyricsGenre': LyricsGenreProcessor,
+        'LyricsArtist': LyricsArtistProcessor,
+    }
+
+    if args.dataset not in dataset_map:
+        raise ValueError('Unrecognized dataset')
+
+    if args.long_document:
+        raise ValueError('Pruning does not support long document models')
+
+    processor = dataset_map[args.dataset]()
+    processor.set_num_classes_(args.data_dir)
+
+    args.device = device
+    args.n_gpu = 1
+    args.num_labels = processor.NUM_CLASSES
+    args.is_multilabel = processor.IS_MULTILABEL
+    args.is_lowercase = 'uncased' in args.model
+    args.is_hierarchical = False
+    tokenizer = BertTokenizer.from_pretrained(args.model, is_lowercase=args.is_lowercase)
+    model = load_model(args)
+
+    # Units are scored once on the dev split, every pruned model is cut from the full model
+    evaluator = BertEvaluator(model, processor, args, split='dev')
+    examples, weights = evaluator.eval_examples, None
+    if args.deduplicate:
+        examples, weights = deduplicate_examples(examples)
+    features = evaluator.get_features(examples)
+    features.weights = weights
+    head_importance, neuron_importance = importance_scores(model, features, args)
+
+    pruned_dir = args.pruned_dir or os.path.join(args.save_path, processor.NAME, 'pruned')
+    # The name of the base model is kept, so lowercasing is still inferred from it
+    model_name = os.path.basename(os.path.normpath(args.model))
+    results = [dict(evaluate(model, processor, args), head_sparsity=0.0, ffn_sparsity=0.0, path=args.model)]
+    for head_sparsity, ffn_sparsity in zip(args.head_sparsity, args.ffn_sparsity):
+        pruned = copy.deepcopy(model)
+        pruned.bert.prune(select_units(head_importance, head_sparsity), select_units(neuron_importance, ffn_sparsity))
+        path = os.path.join(pruned_dir, '{}-h{:g}-f{:g}'.format(model_name, 100 * head_sparsity, 100 * ffn_sparsity))
+        save_pretrained(pruned, tokenizer, path)
+        results.append(dict(evaluate(pruned, processor, args), head_sparsity=head_sparsity,
+                            ffn_sparsity=ffn_sparsity, path=path))
+        del pruned
+
+    print('\n' + LOG_HEADER)
+    for result in results:
+        print(LOG_TEMPLATE.format(result['heads'], result['neurons'], result['gflops'], result['parameters'] / 1e6,
+                                  result['accuracy'], result['f1'], result['loss'], result['time']))
+    with open(os.path.join(pruned_dir, 'report.json'), 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Saved pruned models and report to', pruned_dir)
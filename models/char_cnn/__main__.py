@@ -6,7 +6,7 @@ from copy import deepcopy
 import numpy as np
 import torch
 
-from common.evaluate import EvaluatorFactory
+from common.evaluate import EvaluatorFactory, set_ranking_args, set_shape_buckets
 from common.train import TrainerFactory
 from datasets.aapd import AAPDCharQuantized as AAPD
 from datasets.imdb import IMDBCharQuantized as IMDB
@@ -15,6 +15,8 @@ from datasets.yelp2014 import Yelp2014CharQuantized as Yelp2014
 from datasets.lyrics import LyricsCharQuantized as Lyrics
 from models.char_cnn.args import get_args
 from models.char_cnn.model import CharCNN
+from utils.compilation import compile_model, shape_buckets
+from utils.optimization import get_adam
 
 
 class UnknownWordVecCache(object):
@@ -45,10 +47,11 @@ def get_logger():
     return logger
 
 
-def evaluate_dataset(split_name, dataset_cls, model, embedding, loader, batch_size, device, is_multilabel):
+def evaluate_dataset(split_name, dataset_cls, model, embedding, loader, batch_size, device, is_multilabel, args):
     saved_model_evaluator = EvaluatorFactory.get_evaluator(dataset_cls, model, embedding, loader, batch_size, device)
     if hasattr(saved_model_evaluator, 'is_multilabel'):
         saved_model_evaluator.is_multilabel = is_multilabel
+    set_ranking_args(saved_model_evaluator, args)
     if hasattr(saved_model_evaluator, 'ignore_lengths'):
         saved_model_evaluator.ignore_lengths = True
 
@@ -130,8 +133,8 @@ if __name__ == '__main__':
         save_path = os.path.join(args.save_path, dataset_map[args.dataset].NAME)
         os.makedirs(save_path, exist_ok=True)
 
-    parameter = filter(lambda p: p.requires_grad, model.parameters())
-    optimizer = torch.optim.Adam(parameter, lr=args.lr, weight_decay=args.weight_decay)
+    model = compile_model(model, args)
+    optimizer = get_adam(model, lr=args.lr, weight_decay=args.weight_decay)
 
     train_evaluator = EvaluatorFactory.get_evaluator(dataset_class, model, None, train_iter, args.batch_size, args.gpu)
     test_evaluator = EvaluatorFactory.get_evaluator(dataset_class, model, None, test_iter, args.batch_size, args.gpu)
@@ -147,9 +150,14 @@ if __name__ == '__main__':
         test_evaluator.is_multilabel = dataset_class.IS_MULTILABEL
     if hasattr(test_evaluator, 'ignore_lengths'):
         test_evaluator.ignore_lengths = True
+    for evaluator in (train_evaluator, test_evaluator, dev_evaluator):
+        set_ranking_args(evaluator, args)
+        set_shape_buckets(evaluator, args)
 
     trainer_config = {
         'optimizer': optimizer,
+        'shape_buckets': shape_buckets(args, args.batch_size),
+        'compile_warmup': args.compile_warmup,
         'batch_size': args.batch_size,
         'log_interval': args.log_every,
         'patience': args.patience,
@@ -175,7 +183,7 @@ if __name__ == '__main__':
 
     evaluate_dataset('dev', dataset_map[args.dataset], model, None, dev_iter, args.batch_size,
                      is_multilabel=dataset_class.IS_MULTILABEL,
-                     device=args.gpu)
+                     device=args.gpu, args=args)
     evaluate_dataset('test', dataset_map[args.dataset], model, None, test_iter, args.batch_size,
                      is_multilabel=dataset_class.IS_MULTILABEL,
-                     device=args.gpu)
+                     device=args.gpu, args=args)
@@ -29,10 +29,8 @@ class CharCNN(nn.Module):
         self.fc3 = nn.Linear(num_affine_neurons, target_class)
 
     def forward(self, x, **kwargs):
-        if torch.cuda.is_available() and self.is_cuda_enabled:
-            x = x.transpose(1, 2).type(torch.cuda.FloatTensor)
-        else:
-            x = x.transpose(1, 2).type(torch.FloatTensor)
+        # The input is already on the device of the model
+        x = x.transpose(1, 2).float()
 
         x = F.max_pool1d(F.relu(self.conv1(x)), 3)
         x = F.max_pool1d(F.relu(self.conv2(x)), 3)
@@ -0,0 +1,102 @@
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class MultiWidthConv1d(nn.Module):
+    """
+    Several convolutions of different widths over the same input, run as a single Conv1d. The kernels of every
+    width are right-aligned in a kernel as wide as the widest one, and a fixed mask keeps the positions left of each
+    kernel at zero. With a padding of one less than the widest kernel, output position t of every width covers the
+    same inputs as output t of a separate convolution padded by one less than its own width, so the outputs of
+    narrower kernels are those of the separate convolutions followed by positions that only see padding.
+    """
+
+    def __init__(self, in_channels, out_channels, widths):
+        """
+        :param in_channels: number of input channels, e.g. the embedding size times the number of embeddings
+        :param out_channels: number of output channels per width
+        :param widths: kernel width of each group of output channels
+        """
+        super().__init__()
+        self.in_channels = in_channels
+        self.out_channels = out_channels
+        self.widths = tuple(widths)
+        self.max_width = max(self.widths)
+        self.weight = nn.Parameter(torch.Tensor(out_channels * len(self.widths), in_channels, self.max_width))
+        self.bias = nn.Parameter(torch.Tensor(out_channels * len(self.widths)))
+
+        kernel_mask = torch.zeros(out_channels * len(self.widths), 1, self.max_width)
+        for i, width in enumerate(self.widths):
+            kernel_mask[i * out_channels:(i + 1) * out_channels, :, self.max_width - width:] = 1
+        self.register_buffer('kernel_mask', kernel_mask)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # Each width is initialized like a separate convolution of that width
+        for i, width in enumerate(self.widths):
+            stdv = 1. / math.sqrt(self.in_channels * width)
+            self.weight.data[i * self.out_channels:(i + 1) * self.out_channels].uniform_(-stdv, stdv)
+            self.bias.data[i * self.out_channels:(i + 1) * self.out_channels].uniform_(-stdv, stdv)
+        self.weight.data.mul_(self.kernel_mask)
+
+    @classmethod
+    def from_conv2d(cls, convs):
+        """
+        Builds a fused convolution from Conv2d layers whose kernels span the full embedding, as in KimCNN and XmlCNN
+        snapshots saved before the convolutions were fused
+        :param convs: Conv2d layers with kernels of shape (width, words_dim) and a padding of (width - 1, 0)
+        :return: MultiWidthConv1d computing the same outputs from inputs of shape (batch, channels * words_dim, length)
+        """
+        out_channels, input_channels, _, words_dim = convs[0].weight.size()
+        fused = cls(input_channels * words_dim, out_channels, [conv.weight.size(2) for conv in convs])
+        fused.weight.data.zero_()
+        for i, conv in enumerate(convs):
+            width = conv.weight.size(2)
+            # (out, channels, width, words_dim) to (out, channels * words_dim, width)
+            weight = conv.weight.data.permute(0, 1, 3, 2).contiguous().view(out_channels, -1, width)
+            fused.weight.data[i * out_channels:(i + 1) * out_channels, :, fused.max_width - width:] = weight
+            fused.bias.data[i * out_channels:(i + 1) * out_channels] = conv.bias.data
+        return fused.to(convs[0].weight.device)
+
+    def forward(self, x):
+        """
+        :param x: input of shape (batch, in_channels, length)
+        :return: output of shape (batch, out_channels * len(widths), length + max_width - 1)
+        """
+        return F.conv1d(x, self.weight * self.kernel_mask, self.bias, padding=self.max_width - 1)
+
+    def valid_mask(self, length):
+        """
+        Returns a mask of the output positions whose window overlaps the input, for each output channel
+        :param length: length of the input
+        :return: tensor of shape (out_channels * len(widths), length + max_width - 1)
+        """
+        positions = torch.arange(length + self.max_width - 1, device=self.weight.device, dtype=torch.long)
+        widths = torch.tensor(self.widths, device=self.weight.device, dtype=torch.long)
+        valid = positions.unsqueeze(0) < (length + widths - 1).unsqueeze(1)
+        valid = valid.unsqueeze(1).expand(len(self.widths), self.out_channels, positions.size(0))
+        return valid.contiguous().view(-1, positions.size(0)).to(self.weight.dtype)
+
+    def split(self, output, length):
+        """
+        Splits the output into the outputs of the separate convolutions of each width
+        :param output: output of forward
+        :param length: length of the input
+        :return: list of tensors of shape (batch, out_channels, length + width - 1)
+        """
+        return [output[:, i * self.out_channels:(i + 1) * self.out_channels, :length + width - 1]
+                for i, width in enumerate(self.widths)]
+
+
+def fuse_legacy_convs(module, names=('conv1', 'conv2', 'conv3')):
+    """
+    Replaces the separate Conv2d layers of a KimCNN or XmlCNN snapshot saved before the convolutions were fused
+    with the equivalent MultiWidthConv1d in module.conv
+    :param module: model restored from a snapshot
+    :param names: attribute names of the Conv2d layers, in the order of their outputs
+    """
+    if all(name in module._modules for name in names):
+        module.conv = MultiWidthConv1d.from_conv2d([module._modules.pop(name) for name in names])
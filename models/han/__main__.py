@@ -7,7 +7,7 @@ import numpy as np
 import torch
 import torch.onnx
 
-from common.evaluate import EvaluatorFactory
+from common.evaluate import EvaluatorFactory, set_ranking_args, set_shape_buckets
 from common.train import TrainerFactory
 from datasets.aapd import AAPDHierarchical as AAPD
 from datasets.imdb import IMDBHierarchical as IMDB
@@ -17,6 +17,8 @@ from datasets.lyricsGenre import LyricsGenreHierarchical as LyricsGenre
 from datasets.lyricsArtist import LyricsArtistHierarchical as LyricsArtist
 from models.han.args import get_args
 from models.han.model import HAN
+from utils.compilation import compile_model, shape_buckets
+from utils.optimization import get_adam
 
 
 class UnknownWordVecCache(object):
@@ -47,10 +49,11 @@ def get_logger():
     return logger
 
 
-def evaluate_dataset(split_name, dataset_cls, model, embedding, loader, batch_size, device, is_multilabel):
+def evaluate_dataset(split_name, dataset_cls, model, embedding, loader, batch_size, device, is_multilabel, args):
     saved_model_evaluator = EvaluatorFactory.get_evaluator(dataset_cls, model, embedding, loader, batch_size, device)
     if hasattr(saved_model_evaluator, 'is_multilabel'):
         saved_model_evaluator.is_multilabel = is_multilabel
+    set_ranking_args(saved_model_evaluator, args)
     if hasattr(saved_model_evaluator, 'ignore_lengths'):
         saved_model_evaluator.ignore_lengths = True
 
@@ -137,8 +140,8 @@ if __name__ == '__main__':
         save_path = os.path.join(args.save_path, dataset_map[args.dataset].NAME)
         os.makedirs(save_path, exist_ok=True)
 
-    parameter = filter(lambda p: p.requires_grad, model.parameters())
-    optimizer = torch.optim.Adam(parameter, lr=args.lr, weight_decay=args.weight_decay)
+    model = compile_model(model, args)
+    optimizer = get_adam(model, lr=args.lr, weight_decay=args.weight_decay)
     
     train_evaluator = EvaluatorFactory.get_evaluator(dataset_class, model, None, train_iter, args.batch_size, args.gpu)
     test_evaluator = EvaluatorFactory.get_evaluator(dataset_class, model, None, test_iter, args.batch_size, args.gpu)
@@ -154,9 +157,14 @@ if __name__ == '__main__':
         test_evaluator.is_multilabel = config.dataset.IS_MULTILABEL
     if hasattr(test_evaluator, 'ignore_lengths'):
         test_evaluator.ignore_lengths = True
+    for evaluator in (train_evaluator, test_evaluator, dev_evaluator):
+        set_ranking_args(evaluator, args)
+        set_shape_buckets(evaluator, args)
 
     trainer_config = {
         'optimizer': optimizer,
+        'shape_buckets': shape_buckets(args, args.batch_size),
+        'compile_warmup': args.compile_warmup,
         'batch_size': args.batch_size,
         'log_interval': args.log_every,
         'patience': args.patience,
@@ -182,7 +190,7 @@ if __name__ == '__main__':
 
     evaluate_dataset('dev', dataset_class, model, None, dev_iter, args.batch_size,
                      is_multilabel=config.dataset.IS_MULTILABEL,
-                     device=args.gpu)
+                     device=args.gpu, args=args)
     evaluate_dataset('test', dataset_class, model, None, test_iter, args.batch_size,
                      is_multilabel=config.dataset.IS_MULTILABEL,
-                     device=args.gpu)
+                     device=args.gpu, args=args)
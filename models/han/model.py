@@ -14,14 +14,10 @@ class HAN(nn.Module):
         self.sentence_attention_rnn = SentLevelRNN(config)
 
     def forward(self, x,  **kwargs):
-        x = x.permute(1, 2, 0) # Expected : # sentences, # words, batch size
-        num_sentences = x.size(0)
-        word_attentions = None
-        for i in range(num_sentences):
-            word_attn = self.word_attention_rnn(x[i, :, :])
-            if word_attentions is None:
-                word_attentions = word_attn
-            else:
-                word_attentions = torch.cat((word_attentions, word_attn), 0)
+        batch_size, num_sentences, num_words = x.size()
+        # The sentences of every document are encoded as one batch of num_sentences * batch_size sentences
+        x = x.permute(2, 1, 0).contiguous().view(num_words, num_sentences * batch_size) # (# words, # sentences * batch size)
+        word_attentions = self.word_attention_rnn(x) # (1, # sentences * batch size, hidden)
+        word_attentions = word_attentions.view(num_sentences, batch_size, -1) # (# sentences, batch size, hidden)
         return self.sentence_attention_rnn(word_attentions)
 
@@ -11,13 +11,15 @@ class WordLevelRNN(nn.Module):
         words_num = config.words_num
         words_dim = config.words_dim
         self.mode = config.mode
+        # Trainable embeddings with sparse gradients only update the rows of the words in the batch
+        sparse = getattr(config, 'sparse_embeddings', False)
         if self.mode == 'rand':
             rand_embed_init = torch.Tensor(words_num, words_dim).uniform(-0.25, 0.25)
-            self.embed = nn.Embedding.from_pretrained(rand_embed_init, freeze=False)
+            self.embed = nn.Embedding.from_pretrained(rand_embed_init, freeze=False, sparse=sparse)
         elif self.mode == 'static':
             self.static_embed = nn.Embedding.from_pretrained(dataset.TEXT_FIELD.vocab.vectors, freeze=True)
         elif self.mode == 'non-static':
-            self.non_static_embed = nn.Embedding.from_pretrained(dataset.TEXT_FIELD.vocab.vectors, freeze=False)
+            self.non_static_embed = nn.Embedding.from_pretrained(dataset.TEXT_FIELD.vocab.vectors, freeze=False, sparse=sparse)
         else:
             print("Unsupported order")
             exit()
@@ -35,9 +37,8 @@ class WordLevelRNN(nn.Module):
             x = self.static_embed(x)
         elif self.mode == 'non-static':
             x = self.non_static_embed(x)
-        else :
-            print("Unsupported mode")
-            exit()
+        else:
+            raise ValueError('Unsupported mode: {}'.format(self.mode))
         h, _ = self.GRU(x)
         x = torch.tanh(self.linear(h))
         x = torch.matmul(x, self.word_context_weights)
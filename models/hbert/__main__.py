@@ -17,6 +17,7 @@ from datasets.bert_processors.yelp2014_processor import Yelp2014Processor
 from models.hbert.args import get_args
 from models.hbert.model import HierarchicalBert
 from utils.io import PYTORCH_PRETRAINED_BERT_CACHE
+from utils.compilation import compile_model
 from utils.optimization import BertAdam
 from utils.tokenization import BertTokenizer
 
@@ -103,10 +104,13 @@ if __name__ == '__main__':
 
     cache_dir = args.cache_dir if args.cache_dir else os.path.join(str(PYTORCH_PRETRAINED_BERT_CACHE), 'distributed_{}'.format(args.local_rank))
     model = HierarchicalBert(args, cache_dir=cache_dir)
+    if args.freeze_sentence_encoder:
+        model.freeze_sentence_encoder()
 
     if args.fp16:
         model.half()
     model.to(device)
+    model = compile_model(model, args)
 
     if args.local_rank != -1:
         try:
@@ -118,7 +122,7 @@ if __name__ == '__main__':
         model = torch.nn.DataParallel(model)
 
     # Prepare optimizer
-    param_optimizer = list(model.named_parameters())
+    param_optimizer = [(n, p) for n, p in model.named_parameters() if p.requires_grad]
     no_decay = ['bias', 'LayerNorm.bias', 'LayerNorm.weight']
     optimizer_grouped_parameters = [
         {'params': [p for n, p in param_optimizer if not any(nd in n for nd in no_decay)], 'weight_decay': 0.01},
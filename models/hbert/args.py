@@ -11,10 +11,20 @@ def get_args():
     parser.add_argument('--save-path', type=str, default=os.path.join('model_checkpoints', 'bert'))
     parser.add_argument('--cache-dir', default='cache', type=str)
     parser.add_argument('--trained-model', default=None, type=str)
+    parser.add_argument('--save-predictions', nargs='*', default=[], choices=['dev', 'test'],
+                        help='splits whose predictions are written to --predictions-dir')
+    parser.add_argument('--predictions-format', default='logits', choices=['logits', 'labels', 'topk'],
+                        help='store raw logits, predicted label ids or the --top-k labels and their scores')
+    parser.add_argument('--predictions-dir', default=os.path.join('predictions', 'bert'))
     parser.add_argument('--local-rank', type=int, default=-1, help='local rank for distributed training')
     parser.add_argument('--fp16', action='store_true', help='enable 16-bit floating point precision')
     parser.add_argument('--loss-scale', type=float, default=0, help='loss scaling to improve fp16 numeric stability')
 
+    parser.add_argument('--freeze-sentence-encoder', action='store_true',
+                        help='train only the document head, from cached sentence vectors')
+    parser.add_argument('--sentence-cache-dir', default=os.path.join('cache', 'sentences'),
+                        help='where the sentence vectors of the frozen encoder are stored')
+
     parser.add_argument('--dropout', type=float, default=0.5)
     parser.add_argument('--dropblock', type=float, default=0.0)
     parser.add_argument('--dropblock-size', type=int, default=7)
@@ -34,23 +34,30 @@ class HierarchicalBert(nn.Module):
         self.dropout = nn.Dropout(args.dropout)
         self.fc1 = nn.Linear(ks * args.output_channel, args.num_labels)
 
-    def forward(self, input_ids, segment_ids=None, input_mask=None):
+    def freeze_sentence_encoder(self):
+        """
+        Stops the gradient updates of the sentence encoder, so its sentence vectors can be cached
+        """
+        for param in self.sentence_encoder.parameters():
+            param.requires_grad = False
+
+    def forward(self, input_ids=None, segment_ids=None, input_mask=None, sentence_vectors=None):
         """
         a batch is a tensor of shape [batch_size, #file_in_commit, #line_in_file]
         and each element is a line, i.e., a bert_batch,
-        which consists of input_ids, input_mask, segment_ids, label_ids
+        which consists of input_ids, input_mask, segment_ids, label_ids.
+        Alternatively, sentence_vectors of shape [batch_size, #line_in_file, hidden_size] holds the output of the
+        sentence encoder, e.g. read from a SentenceEmbeddingStore
         """
-        input_ids = input_ids.permute(1, 0, 2)  # (sentences, batch_size, words)
-        segment_ids = segment_ids.permute(1, 0, 2)
-        input_mask = input_mask.permute(1, 0, 2)
-
-        x_encoded = []
-        for i0 in range(len(input_ids)):
-            x_encoded.append(self.sentence_encoder(input_ids[i0], input_mask[i0], segment_ids[i0]))
+        if sentence_vectors is None:
+            # The sentences of every document are encoded as one batch of batch_size * sentences sentences
+            batch_size, num_sentences, num_words = input_ids.size()
+            x = self.sentence_encoder(input_ids.contiguous().view(-1, num_words),
+                                      segment_ids.contiguous().view(-1, num_words),
+                                      input_mask.contiguous().view(-1, num_words))
+            sentence_vectors = x.view(batch_size, num_sentences, -1)  # (batch_size, sentences, hidden_size)
 
-        x = torch.stack(x_encoded)  # (sentences, batch_size, hidden_size)
-        x = x.permute(1, 0, 2)  # (batch_size, sentences, hidden_size)
-        x = x.unsqueeze(1)  # (batch_size, input_channels, sentences, hidden_size)
+        x = sentence_vectors.unsqueeze(1)  # (batch_size, input_channels, sentences, hidden_size)
 
         if self.args.batchnorm:
             x = [F.relu(self.batchnorm1(self.conv1(x))).squeeze(3),
@@ -66,7 +73,7 @@ class HierarchicalBert(nn.Module):
             x = torch.cat(x, 1)  # (batch_size, output_channels * ks)
             x = x.view(-1, self.filter_widths * self.output_channel * self.dynamic_pool_length)
         else:
-            x = [F.max_pool1d(i, i.size(2)).squeeze(2) for i in x]  # (batch_size, output_channels, num_sentences) * ks
+            x = [i.max(dim=2)[0] for i in x]  # (batch_size, output_channels) * ks
             x = torch.cat(x, 1)  # (batch_size, channel_output * ks)
 
         x = self.dropout(x)
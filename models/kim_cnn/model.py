@@ -3,6 +3,8 @@ import torch.nn as nn
 
 import torch.nn.functional as F
 
+from models.fused_conv import MultiWidthConv1d, fuse_legacy_convs
+
 
 class KimCNN(nn.Module):
 
@@ -14,53 +16,57 @@ class KimCNN(nn.Module):
         words_num = config.words_num
         words_dim = config.words_dim
         self.mode = config.mode
+        # Trainable embeddings with sparse gradients only update the rows of the words in the batch
+        sparse = getattr(config, 'sparse_embeddings', False)
         ks = 3 # There are three conv nets here
 
         input_channel = 1
         if config.mode == 'rand':
             rand_embed_init = torch.Tensor(words_num, words_dim).uniform_(-0.25, 0.25)
-            self.embed = nn.Embedding.from_pretrained(rand_embed_init, freeze=False)
+            self.embed = nn.Embedding.from_pretrained(rand_embed_init, freeze=False, sparse=sparse)
         elif config.mode == 'static':
             self.static_embed = nn.Embedding.from_pretrained(dataset.TEXT_FIELD.vocab.vectors, freeze=True)
         elif config.mode == 'non-static':
-            self.non_static_embed = nn.Embedding.from_pretrained(dataset.TEXT_FIELD.vocab.vectors, freeze=False)
+            self.non_static_embed = nn.Embedding.from_pretrained(dataset.TEXT_FIELD.vocab.vectors, freeze=False, sparse=sparse)
         elif config.mode == 'multichannel':
             self.static_embed = nn.Embedding.from_pretrained(dataset.TEXT_FIELD.vocab.vectors, freeze=True)
-            self.non_static_embed = nn.Embedding.from_pretrained(dataset.TEXT_FIELD.vocab.vectors, freeze=False)
+            self.non_static_embed = nn.Embedding.from_pretrained(dataset.TEXT_FIELD.vocab.vectors, freeze=False, sparse=sparse)
             input_channel = 2
         else:
             print("Unsupported Mode")
             exit()
 
-        self.conv1 = nn.Conv2d(input_channel, output_channel, (3, words_dim), padding=(2,0))
-        self.conv2 = nn.Conv2d(input_channel, output_channel, (4, words_dim), padding=(3,0))
-        self.conv3 = nn.Conv2d(input_channel, output_channel, (5, words_dim), padding=(4,0))
+        # The three convolutions run as one, each treats the embedding dimensions as input channels
+        self.conv = MultiWidthConv1d(input_channel * words_dim, output_channel, (3, 4, 5))
 
         self.dropout = nn.Dropout(config.dropout)
         self.fc1 = nn.Linear(ks * output_channel, target_class)
 
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        fuse_legacy_convs(self)
+
     def forward(self, x, **kwargs):
         if self.mode == 'rand':
             word_input = self.embed(x) # (batch, sent_len, embed_dim)
-            x = word_input.unsqueeze(1) # (batch, channel_input, sent_len, embed_dim)
+            x = word_input.transpose(1, 2) # (batch, embed_dim, sent_len)
         elif self.mode == 'static':
             static_input = self.static_embed(x)
-            x = static_input.unsqueeze(1) # (batch, channel_input, sent_len, embed_dim)
+            x = static_input.transpose(1, 2) # (batch, embed_dim, sent_len)
         elif self.mode == 'non-static':
             non_static_input = self.non_static_embed(x)
-            x = non_static_input.unsqueeze(1) # (batch, channel_input, sent_len, embed_dim)
+            x = non_static_input.transpose(1, 2) # (batch, embed_dim, sent_len)
         elif self.mode == 'multichannel':
             non_static_input = self.non_static_embed(x)
             static_input = self.static_embed(x)
-            x = torch.stack([non_static_input, static_input], dim=1) # (batch, channel_input=2, sent_len, embed_dim)
+            x = torch.cat([non_static_input.transpose(1, 2), static_input.transpose(1, 2)], dim=1) # (batch, 2 * embed_dim, sent_len)
         else:
-            print("Unsupported Mode")
-            exit()
-        x = [F.relu(self.conv1(x)).squeeze(3), F.relu(self.conv2(x)).squeeze(3), F.relu(self.conv3(x)).squeeze(3)]
-        # (batch, channel_output, ~=sent_len) * ks
-        x = [F.max_pool1d(i, i.size(2)).squeeze(2) for i in x] # max-over-time pooling
-        # (batch, channel_output) * ks
-        x = torch.cat(x, 1) # (batch, channel_output * ks)
+            raise ValueError('Unsupported mode: {}'.format(self.mode))
+        length = x.size(2)
+        # Positions past the output of the narrower convolutions only see padding, they are zeroed after the ReLU
+        # so they never exceed the maximum
+        x = F.relu(self.conv(x)) * self.conv.valid_mask(length) # (batch, channel_output * ks, ~=sent_len)
+        x = x.max(dim=2)[0] # max-over-time pooling, (batch, channel_output * ks)
         x = self.dropout(x)
         logit = self.fc1(x) # (batch, target_size)
         return logit
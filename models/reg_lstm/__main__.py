@@ -6,7 +6,7 @@ from copy import deepcopy
 import numpy as np
 import torch
 
-from common.evaluate import EvaluatorFactory
+from common.evaluate import EvaluatorFactory, set_ranking_args, set_shape_buckets
 from common.train import TrainerFactory
 from datasets.aapd import AAPD
 from datasets.imdb import IMDB
@@ -16,6 +16,8 @@ from datasets.lyricsGenre import LyricsGenre
 from datasets.lyricsArtist import LyricsArtist
 from models.reg_lstm.args import get_args
 from models.reg_lstm.model import RegLSTM
+from utils.compilation import compile_model, shape_buckets
+from utils.optimization import get_adam
 
 
 class UnknownWordVecCache(object):
@@ -46,10 +48,11 @@ def get_logger():
     return logger
 
 
-def evaluate_dataset(split_name, dataset_cls, model, embedding, loader, batch_size, device, is_multilabel):
+def evaluate_dataset(split_name, dataset_cls, model, embedding, loader, batch_size, device, is_multilabel, args):
     saved_model_evaluator = EvaluatorFactory.get_evaluator(dataset_cls, model, embedding, loader, batch_size, device)
     if hasattr(saved_model_evaluator, 'is_multilabel'):
         saved_model_evaluator.is_multilabel = is_multilabel
+    set_ranking_args(saved_model_evaluator, args)
 
     scores, metric_names = saved_model_evaluator.get_scores()
     print('Evaluation metrics for', split_name)
@@ -133,8 +136,8 @@ if __name__ == '__main__':
         save_path = os.path.join(args.save_path, dataset_map[args.dataset].NAME)
         os.makedirs(save_path, exist_ok=True)
 
-    parameter = filter(lambda p: p.requires_grad, model.parameters())
-    optimizer = torch.optim.Adam(parameter, lr=args.lr, weight_decay=args.weight_decay)
+    model = compile_model(model, args)
+    optimizer = get_adam(model, lr=args.lr, weight_decay=args.weight_decay)
 
     train_evaluator = EvaluatorFactory.get_evaluator(dataset_class, model, None, train_iter, args.batch_size, args.gpu)
     test_evaluator = EvaluatorFactory.get_evaluator(dataset_class, model, None, test_iter, args.batch_size, args.gpu)
@@ -146,9 +149,14 @@ if __name__ == '__main__':
         test_evaluator.is_multilabel = config.dataset.IS_MULTILABEL
     if hasattr(dev_evaluator, 'is_multilabel'):
         dev_evaluator.is_multilabel = config.dataset.IS_MULTILABEL
+    for evaluator in (train_evaluator, test_evaluator, dev_evaluator):
+        set_ranking_args(evaluator, args)
+        set_shape_buckets(evaluator, args)
 
     trainer_config = {
         'optimizer': optimizer,
+        'shape_buckets': shape_buckets(args, args.batch_size),
+        'compile_warmup': args.compile_warmup,
         'batch_size': args.batch_size,
         'log_interval': args.log_every,
         'patience': args.patience,
@@ -176,10 +184,10 @@ if __name__ == '__main__':
     # Calculate dev and test metrics
     evaluate_dataset('dev', dataset_class, model, None, dev_iter, args.batch_size,
                      is_multilabel=config.dataset.IS_MULTILABEL,
-                     device=args.gpu)
+                     device=args.gpu, args=args)
     evaluate_dataset('test', dataset_class, model, None, test_iter, args.batch_size,
                      is_multilabel=config.dataset.IS_MULTILABEL,
-                     device=args.gpu)
+                     device=args.gpu, args=args)
 
     if model.beta_ema > 0:
         model.load_params(old_params)
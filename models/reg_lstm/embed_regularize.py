@@ -34,20 +34,23 @@ import numpy as np
 import torch
 
 def embedded_dropout(embed, words, dropout=0.1, scale=None):
-  if dropout:
-    mask = embed.weight.data.new().resize_((embed.weight.size(0), 1)).bernoulli_(1 - dropout).expand_as(embed.weight) / (1 - dropout)
-    masked_embed_weight = mask * embed.weight
-  else:
-    masked_embed_weight = embed.weight
-  if scale:
-    masked_embed_weight = scale.expand_as(masked_embed_weight) * masked_embed_weight
-
+  """
+  Embedding dropout: drops whole words from the vocabulary, so every occurrence of a dropped word in the batch is
+  zeroed. The mask is drawn only for the distinct words of the batch and applied to the looked up rows, which is
+  equivalent to masking the rows of the embedding matrix without building a masked copy of it.
+  """
   padding_idx = embed.padding_idx
   if padding_idx is None:
       padding_idx = -1
 
-  X = torch.nn.functional.embedding(words, masked_embed_weight,
+  X = torch.nn.functional.embedding(words, embed.weight,
     padding_idx, embed.max_norm, embed.norm_type,
     embed.scale_grad_by_freq, embed.sparse
   )
+  if dropout:
+    unique_words, inverse = torch.unique(words, sorted=False, return_inverse=True)
+    mask = X.new_empty(unique_words.size(0)).bernoulli_(1 - dropout) / (1 - dropout)
+    X = X * mask[inverse].unsqueeze(-1)
+  if scale:
+    X = scale.expand_as(embed.weight)[words] * X
   return X
@@ -17,6 +17,8 @@ class RegLSTM(nn.Module):
         self.is_bidirectional = config.bidirectional
         self.has_bottleneck_layer = config.bottleneck_layer
         self.mode = config.mode
+        # Trainable embeddings with sparse gradients only update the rows of the words in the batch
+        sparse = getattr(config, 'sparse_embeddings', False)
         self.tar = config.tar
         self.ar = config.ar
         self.beta_ema = config.beta_ema  # Temporal averaging
@@ -25,11 +27,11 @@ class RegLSTM(nn.Module):
 
         if config.mode == 'rand':
             rand_embed_init = torch.Tensor(config.words_num, config.words_dim).uniform_(-0.25, 0.25)
-            self.embed = nn.Embedding.from_pretrained(rand_embed_init, freeze=False)
+            self.embed = nn.Embedding.from_pretrained(rand_embed_init, freeze=False, sparse=sparse)
         elif config.mode == 'static':
             self.static_embed = nn.Embedding.from_pretrained(dataset.TEXT_FIELD.vocab.vectors, freeze=True)
         elif config.mode == 'non-static':
-            self.non_static_embed = nn.Embedding.from_pretrained(dataset.TEXT_FIELD.vocab.vectors, freeze=False)
+            self.non_static_embed = nn.Embedding.from_pretrained(dataset.TEXT_FIELD.vocab.vectors, freeze=False, sparse=sparse)
         else:
             print("Unsupported Mode")
             exit()
@@ -68,19 +70,22 @@ class RegLSTM(nn.Module):
         elif self.mode == 'non-static':
             x = embedded_dropout(self.non_static_embed, x, dropout=self.embed_droprate if self.training else 0) if self.embed_droprate else self.non_static_embed(x)
         else:
-            print("Unsupported Mode")
-            exit()
+            raise ValueError('Unsupported mode: {}'.format(self.mode))
+        # Outputs are padded back to the input length, so padded batches keep their shape
+        total_length = x.size(1)
         if lengths is not None:
             x = torch.nn.utils.rnn.pack_padded_sequence(x, lengths, batch_first=True)
         rnn_outs, _ = self.lstm(x)
         rnn_outs_temp = rnn_outs
 
         if lengths is not None:
-            rnn_outs,_ = torch.nn.utils.rnn.pad_packed_sequence(rnn_outs, batch_first=True)
-            rnn_outs_temp, _ = torch.nn.utils.rnn.pad_packed_sequence(rnn_outs_temp, batch_first=True)
+            rnn_outs,_ = torch.nn.utils.rnn.pad_packed_sequence(rnn_outs, batch_first=True, total_length=total_length)
+            rnn_outs_temp, _ = torch.nn.utils.rnn.pad_packed_sequence(rnn_outs_temp, batch_first=True,
+                                                                      total_length=total_length)
 
         x = F.relu(torch.transpose(rnn_outs_temp, 1, 2))
-        x = F.max_pool1d(x, x.size(2)).squeeze(2)
+        # Max over time, taken with max rather than a kernel as long as the input so traced models keep it dynamic
+        x = x.max(dim=2)[0]
         x = self.dropout(x)
         if self.has_bottleneck_layer:
             x = F.relu(self.fc1(x))
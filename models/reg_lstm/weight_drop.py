@@ -30,48 +30,130 @@ OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 import torch
-from torch.nn import Parameter
-from functools import wraps
+import torch.nn.functional as F
+from torch.nn.utils.rnn import PackedSequence
+
+
+def _invert_permutation(permutation):
+    inverse = torch.empty_like(permutation)
+    inverse.scatter_(0, permutation, torch.arange(permutation.numel(), device=permutation.device))
+    return inverse
+
+
+def _run_rnn(module, input, hx, weights, flat_weight):
+    """
+    Runs an RNN module functionally with the given weights instead of its parameters
+    :param module: RNNBase module whose configuration is used
+    :param input: padded input or PackedSequence
+    :param hx: initial hidden state or None for zeros
+    :param weights: weights in the order of module._all_weights, views of flat_weight
+    :param flat_weight: single contiguous buffer holding the weights in the layout cuDNN expects
+    :return: output and final hidden state, as returned by the module
+    """
+    is_packed = isinstance(input, PackedSequence)
+    sorted_indices = getattr(input, 'sorted_indices', None) if is_packed else None
+    if is_packed:
+        input, batch_sizes = input[0], input[1]
+        max_batch_size = int(batch_sizes[0])
+    else:
+        batch_sizes = None
+        max_batch_size = input.size(0) if module.batch_first else input.size(1)
+
+    if hx is None:
+        num_directions = 2 if module.bidirectional else 1
+        hx = input.new_zeros(module.num_layers * num_directions, max_batch_size, module.hidden_size)
+        if module.mode == 'LSTM':
+            hx = (hx, hx)
+    elif sorted_indices is not None:
+        hx = module.permute_hidden(hx, sorted_indices)
+
+    if hasattr(module, '_backend'):
+        # PyTorch 0.4: the weights are grouped per layer and direction
+        num_weights = len(module._all_weights[0])
+        all_weights = [weights[i:i + num_weights] for i in range(0, len(weights), num_weights)]
+        func = module._backend.RNN(module.mode, module.input_size, module.hidden_size,
+                                   num_layers=module.num_layers, batch_first=module.batch_first,
+                                   dropout=module.dropout, train=module.training, bidirectional=module.bidirectional,
+                                   dropout_state=module.dropout_state, variable_length=is_packed,
+                                   flat_weight=flat_weight)
+        output, hidden = func(input, all_weights, hx, batch_sizes)
+    else:
+        func = getattr(torch._VF, module.mode.lower())
+        if is_packed:
+            result = func(input, batch_sizes, hx, weights, module.bias, module.num_layers, module.dropout,
+                          module.training, module.bidirectional)
+        else:
+            result = func(input, hx, weights, module.bias, module.num_layers, module.dropout, module.training,
+                          module.bidirectional, module.batch_first)
+        output, hidden = result[0], tuple(result[1:]) if module.mode == 'LSTM' else result[1]
+
+    if is_packed:
+        if sorted_indices is not None:
+            output = PackedSequence(output, batch_sizes, sorted_indices, _invert_permutation(sorted_indices))
+            hidden = module.permute_hidden(hidden, output.unsorted_indices)
+        else:
+            output = PackedSequence(output, batch_sizes)
+    return output, hidden
 
 
 class WeightDrop(torch.nn.Module):
+    """
+    DropConnect on the weights of an RNN module. The module keeps its parameters, flattened into the single
+    buffer cuDNN works on. In training, each forward pass copies the weights into a new contiguous buffer with the
+    dropped weights masked, and runs the RNN functionally on views of that buffer, so the module is never modified
+    and cuDNN neither warns about nor compacts non-contiguous weights. In evaluation the module is run as is.
+    """
 
     def __init__(self, module, weights, dropout=0, variational=False):
+        """
+        :param module: RNN module, e.g. nn.LSTM
+        :param weights: names of the weights to drop, e.g. ['weight_hh_l0']
+        :param dropout: probability of dropping each weight, or each row of the weights if variational
+        :param variational: drop whole rows of the weights
+        """
         super().__init__()
         self.module = module
         self.weights = weights
         self.dropout = dropout
         self.variational = variational
-        self._setup()
+        for name_w in self.weights:
+            print('Applying weight drop of {} to {}'.format(self.dropout, name_w))
 
     def null_function(*args, **kwargs):
-        # We need to replace flatten_parameters with a nothing function
+        # Snapshots of the previous implementation replaced flatten_parameters of the module with this method, so
+        # it has to exist for them to unpickle. __setstate__ removes it from the module again
         return
 
-    def _setup(self):
-        # Terrible temporary solution to an issue regarding compacting weights re: CUDNN RNN
-        if issubclass(type(self.module), torch.nn.RNNBase):
-            self.module.flatten_parameters = self.null_function
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        # Snapshots of the previous implementation kept the weights under a _raw suffix and disabled flattening
+        parameters = self.module._parameters
+        if any(name_w + '_raw' in parameters for name_w in self.weights):
+            for name_w in self.weights:
+                parameters[name_w] = parameters.pop(name_w + '_raw')
+            order = [name for names in self.module._all_weights for name in names]
+            self.module._parameters = type(parameters)((name, parameters[name]) for name in order)
+            self.module.__dict__.pop('flatten_parameters', None)
+            if hasattr(self.module, '_init_flat_weights'):
+                self.module._init_flat_weights()
+            self.module.flatten_parameters()
 
-        for name_w in self.weights:
-            print('Applying weight drop of {} to {}'.format(self.dropout, name_w))
-            w = getattr(self.module, name_w)
-            del self.module._parameters[name_w]
-            self.module.register_parameter(name_w + '_raw', Parameter(w.data))
+    def _drop(self, weight):
+        if self.variational:
+            mask = F.dropout(weight.new_ones(weight.size(0), 1), p=self.dropout, training=True)
+            return mask * weight
+        return F.dropout(weight, p=self.dropout, training=True)
 
-    def _setweights(self):
-        for name_w in self.weights:
-            raw_w = getattr(self.module, name_w + '_raw')
-            w = None
-            if self.variational:
-                mask = torch.autograd.Variable(torch.ones(raw_w.size(0), 1))
-                if raw_w.is_cuda: mask = mask.cuda()
-                mask = torch.nn.functional.dropout(mask, p=self.dropout, training=True)
-                w = torch.nn.Parameter(mask.expand_as(raw_w) * raw_w)
-            else:
-                w = torch.nn.Parameter(torch.nn.functional.dropout(raw_w, p=self.dropout, training=self.training))
-            setattr(self.module, name_w, w)
-
-    def forward(self, *args):
-        self._setweights()
-        return self.module.forward(*args)
+    def forward(self, input, hx=None):
+        if not self.training:
+            return self.module(input, hx)
+
+        names = [name for names in self.module._all_weights for name in names]
+        weights = [getattr(self.module, name) for name in names]
+        weights = [self._drop(weight) if name in self.weights else weight for name, weight in zip(names, weights)]
+        flat_weight = torch.cat([weight.contiguous().view(-1) for weight in weights])
+        views, offset = list(), 0
+        for weight in weights:
+            views.append(flat_weight[offset:offset + weight.numel()].view_as(weight))
+            offset += weight.numel()
+        return _run_rnn(self.module, input, hx, views, flat_weight)
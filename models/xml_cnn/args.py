@@ -18,6 +18,12 @@ def get_args():
 
     parser.add_argument('--num-bottleneck-hidden', type=int, default=512)
     parser.add_argument('--dynamic-pool-length', type=int, default=32)
+    parser.add_argument('--sampled-labels', type=int, default=0,
+                        help='negative labels sampled per batch instead of scoring every label, 0 to score all')
+    parser.add_argument('--shortlist-beam', type=int, default=0,
+                        help='label tree leaves scored per document at evaluation, 0 to score every label')
+    parser.add_argument('--shortlist-leaf-size', type=int, default=0,
+                        help='labels per label tree leaf, defaults to the square root of the number of labels')
 
     parser.add_argument('--word-vectors-dir', default=os.path.join(os.pardir, 'hedwig-data', 'embeddings', 'word2vec'))
     parser.add_argument('--word-vectors-file', default='GoogleNews-vectors-negative300.txt')
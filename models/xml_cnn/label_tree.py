@@ -0,0 +1,119 @@
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class LabelTreeHead(nn.Linear):
+    """
+    Output layer for extreme multi-label classification. The forward pass scores every label like nn.Linear, but
+    training can score only the labels of the batch and a sample of negatives, and inference can score only the
+    labels in a shortlist of leaves of a balanced label tree.
+
+    The tree is built by recursively splitting the label weight vectors in two equal halves (balanced spherical
+    2-means) until each leaf holds at most leaf_size labels. A document is scored against the mean weight vector of
+    every leaf, and only the labels of its highest scoring leaves are scored exactly.
+    """
+
+    def __init__(self, in_features, num_labels, num_sampled=0):
+        """
+        :param in_features: size of the document representation
+        :param num_labels: number of labels
+        :param num_sampled: number of negative labels sampled per batch for sampled_loss, 0 to score every label
+        """
+        super().__init__(in_features, num_labels)
+        self.num_sampled = num_sampled
+        self.leaf_labels = None
+        self.leaf_centroids = None
+
+    def sampled_loss(self, hidden, targets):
+        """
+        Estimates the binary cross-entropy over all labels from the labels positive for some document of the batch,
+        which are scored exactly, and num_sampled labels drawn uniformly from the others, whose losses are scaled
+        by the number of other labels over the number of labels drawn
+        :param hidden: document representations of shape (batch_size, in_features)
+        :param targets: target label indicators of shape (batch_size, num_labels)
+        :return: estimated sum of the losses over all labels of each document, the scores of the scored labels of
+        shape (batch_size, num_scored) and the indices of the scored labels
+        """
+        num_labels = self.weight.size(0)
+        in_batch = targets.sum(dim=0) > 0
+        positives = in_batch.nonzero().view(-1)
+        sampled = torch.randint(num_labels, (self.num_sampled,), device=hidden.device, dtype=torch.long)
+        negatives = sampled[in_batch[sampled] == 0]
+
+        candidates = torch.cat([positives, negatives])
+        scores = F.linear(hidden, self.weight[candidates], self.bias[candidates])
+        losses = F.binary_cross_entropy_with_logits(scores, targets[:, candidates].float(), reduce=False)
+
+        # Positive labels of the batch count once, each sampled negative stands for its share of the other labels
+        scale = float(num_labels - positives.numel()) / max(negatives.numel(), 1)
+        column_weights = torch.cat([torch.ones(positives.numel(), device=hidden.device),
+                                    torch.full((negatives.numel(),), scale, device=hidden.device)])
+        return (losses * column_weights).sum(dim=1), scores, candidates
+
+    @staticmethod
+    def _split(vectors, iterations):
+        # Balanced spherical 2-means: members are ranked by their similarity to one centroid over the other and the
+        # ranking is cut in half, so both children get the same number of labels
+        centroids = vectors[torch.randperm(vectors.size(0), device=vectors.device)[:2]]
+        for _ in range(iterations):
+            order = torch.sort(torch.mv(vectors, centroids[0] - centroids[1]), descending=True)[1]
+            halves = order[:vectors.size(0) // 2], order[vectors.size(0) // 2:]
+            centroids = F.normalize(torch.stack([vectors[half].mean(dim=0) for half in halves]), dim=1)
+        return halves
+
+    def build_shortlist(self, leaf_size=None, iterations=5):
+        """
+        Builds the label tree from the current weights. Weights change during training, so the tree is rebuilt
+        before every evaluation.
+        :param leaf_size: maximum number of labels per leaf, defaults to the square root of the number of labels
+        :param iterations: number of 2-means iterations per split
+        """
+        num_labels = self.weight.size(0)
+        leaf_size = leaf_size or int(math.ceil(math.sqrt(num_labels)))
+        with torch.no_grad():
+            # The bias is appended to the weights, so inner products with [hidden, 1] are the label scores
+            augmented = torch.cat([self.weight, self.bias.unsqueeze(1)], dim=1)
+            vectors = F.normalize(augmented, dim=1)
+            leaves, pending = list(), [torch.arange(num_labels, device=self.weight.device)]
+            while pending:
+                labels = pending.pop()
+                if labels.numel() <= leaf_size:
+                    leaves.append(labels)
+                    continue
+                pending.extend(labels[half] for half in self._split(vectors[labels], iterations))
+
+            self.leaf_labels = torch.full((len(leaves), leaf_size), -1, dtype=torch.long, device=self.weight.device)
+            for i, labels in enumerate(leaves):
+                self.leaf_labels[i, :labels.numel()] = labels
+            self.leaf_centroids = torch.stack([augmented[labels].mean(dim=0) for labels in leaves])
+
+    def topk(self, hidden, k, beam=0):
+        """
+        Returns the highest scoring labels of each document
+        :param hidden: document representations of shape (batch_size, in_features)
+        :param k: number of labels per document
+        :param beam: number of leaves whose labels are scored, 0 or no tree to score every label
+        :return: scores and indices of the labels of shape (batch_size, k), in decreasing order of score
+        """
+        if not beam or self.leaf_labels is None or beam * self.leaf_labels.size(1) >= self.weight.size(0):
+            return F.linear(hidden, self.weight, self.bias).topk(k, dim=1)
+
+        leaf_size = self.leaf_labels.size(1)
+        beam = min(max(beam, int(math.ceil(k / leaf_size))), self.leaf_labels.size(0))
+        leaf_scores = F.linear(hidden, self.leaf_centroids[:, :-1], self.leaf_centroids[:, -1])
+        leaves = leaf_scores.topk(beam, dim=1)[1]
+
+        # Leaves selected by several documents are scored once, with a single matrix product over their labels
+        unique_leaves, inverse = torch.unique(leaves, sorted=True, return_inverse=True)
+        labels = self.leaf_labels[unique_leaves]
+        flat = labels.view(-1).clamp(min=0)
+        scores = F.linear(hidden, self.weight[flat], self.bias[flat]).view(hidden.size(0), -1, leaf_size)
+        scores = scores.gather(1, inverse.unsqueeze(2).expand(-1, -1, leaf_size)).view(hidden.size(0), -1)
+        candidates = labels[inverse].view(hidden.size(0), -1)
+        scores = scores.masked_fill(candidates < 0, -float('inf'))
+
+        top_scores, positions = scores.topk(k, dim=1)
+        return top_scores, candidates.gather(1, positions).clamp(min=0)
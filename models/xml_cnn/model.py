@@ -2,6 +2,9 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from models.fused_conv import MultiWidthConv1d, fuse_legacy_convs
+from models.xml_cnn.label_tree import LabelTreeHead
+
 
 class XmlCNN(nn.Module):
 
@@ -13,6 +16,8 @@ class XmlCNN(nn.Module):
         words_num = config.words_num
         words_dim = config.words_dim
         self.mode = config.mode
+        # Trainable embeddings with sparse gradients only update the rows of the words in the batch
+        sparse = getattr(config, 'sparse_embeddings', False)
         self.num_bottleneck_hidden = config.num_bottleneck_hidden
         self.dynamic_pool_length = config.dynamic_pool_length
         self.ks = 3 # There are three conv nets here
@@ -20,53 +25,65 @@ class XmlCNN(nn.Module):
         input_channel = 1
         if config.mode == 'rand':
             rand_embed_init = torch.Tensor(words_num, words_dim).uniform_(-0.25, 0.25)
-            self.embed = nn.Embedding.from_pretrained(rand_embed_init, freeze=False)
+            self.embed = nn.Embedding.from_pretrained(rand_embed_init, freeze=False, sparse=sparse)
         elif config.mode == 'static':
             self.static_embed = nn.Embedding.from_pretrained(dataset.TEXT_FIELD.vocab.vectors, freeze=True)
         elif config.mode == 'non-static':
-            self.non_static_embed = nn.Embedding.from_pretrained(dataset.TEXT_FIELD.vocab.vectors, freeze=False)
+            self.non_static_embed = nn.Embedding.from_pretrained(dataset.TEXT_FIELD.vocab.vectors, freeze=False, sparse=sparse)
         elif config.mode == 'multichannel':
             self.static_embed = nn.Embedding.from_pretrained(dataset.TEXT_FIELD.vocab.vectors, freeze=True)
-            self.non_static_embed = nn.Embedding.from_pretrained(dataset.TEXT_FIELD.vocab.vectors, freeze=False)
+            self.non_static_embed = nn.Embedding.from_pretrained(dataset.TEXT_FIELD.vocab.vectors, freeze=False, sparse=sparse)
             input_channel = 2
         else:
             print("Unsupported Mode")
             exit()
 
         ## Different filter sizes in xml_cnn than kim_cnn
-        self.conv1 = nn.Conv2d(input_channel, self.output_channel, (2, words_dim), padding=(1,0))
-        self.conv2 = nn.Conv2d(input_channel, self.output_channel, (4, words_dim), padding=(3,0))
-        self.conv3 = nn.Conv2d(input_channel, self.output_channel, (8, words_dim), padding=(7,0))
+        # The three convolutions run as one, each treats the embedding dimensions as input channels
+        self.conv = MultiWidthConv1d(input_channel * words_dim, self.output_channel, (2, 4, 8))
 
         self.dropout = nn.Dropout(config.dropout)
         self.bottleneck = nn.Linear(self.ks * self.output_channel * self.dynamic_pool_length, self.num_bottleneck_hidden)
-        self.fc1 = nn.Linear(self.num_bottleneck_hidden, target_class)
+        # Scores every label like nn.Linear, with sampled training and shortlist inference for large label sets
+        self.fc1 = LabelTreeHead(self.num_bottleneck_hidden, target_class,
+                                 num_sampled=getattr(config, 'sampled_labels', 0))
 
         self.pool = nn.AdaptiveMaxPool1d(self.dynamic_pool_length) #Adaptive pooling
 
-    def forward(self, x, **kwargs):
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        fuse_legacy_convs(self)
+
+    def encode(self, x):
+        """
+        Computes the document representations scored by the output layer
+        :param x: token ids of shape (batch, sent_len)
+        :return: tensor of shape (batch, num_bottleneck_hidden)
+        """
         if self.mode == 'rand':
             word_input = self.embed(x) # (batch, sent_len, embed_dim)
-            x = word_input.unsqueeze(1) # (batch, channel_input, sent_len, embed_dim)
+            x = word_input.transpose(1, 2) # (batch, embed_dim, sent_len)
         elif self.mode == 'static':
             static_input = self.static_embed(x)
-            x = static_input.unsqueeze(1) # (batch, channel_input, sent_len, embed_dim)
+            x = static_input.transpose(1, 2) # (batch, embed_dim, sent_len)
         elif self.mode == 'non-static':
             non_static_input = self.non_static_embed(x)
-            x = non_static_input.unsqueeze(1) # (batch, channel_input, sent_len, embed_dim)
+            x = non_static_input.transpose(1, 2) # (batch, embed_dim, sent_len)
         elif self.mode == 'multichannel':
             non_static_input = self.non_static_embed(x)
             static_input = self.static_embed(x)
-            x = torch.stack([non_static_input, static_input], dim=1) # (batch, channel_input=2, sent_len, embed_dim)
+            x = torch.cat([non_static_input.transpose(1, 2), static_input.transpose(1, 2)], dim=1) # (batch, 2 * embed_dim, sent_len)
         else:
-            print("Unsupported Mode")
-            exit()
-        x = [F.relu(self.conv1(x)).squeeze(3), F.relu(self.conv2(x)).squeeze(3), F.relu(self.conv3(x)).squeeze(3)]
-        x = [self.pool(i).squeeze(2) for i in x]
+            raise ValueError('Unsupported mode: {}'.format(self.mode))
+        length = x.size(2)
+        # Each width is pooled over its own output length, as the pooling windows depend on it
+        x = [self.pool(i).squeeze(2) for i in self.conv.split(F.relu(self.conv(x)), length)]
 
         # (batch, channel_output) * ks
         x = torch.cat(x, 1) # (batch, channel_output * ks)
         x = F.relu(self.bottleneck(x.view(-1, self.ks * self.output_channel * self.dynamic_pool_length)))
-        x = self.dropout(x)
-        logit = self.fc1(x) # (batch, target_size)
+        return self.dropout(x)
+
+    def forward(self, x, **kwargs):
+        logit = self.fc1(self.encode(x)) # (batch, target_size)
         return logit
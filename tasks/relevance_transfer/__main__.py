@@ -23,7 +23,7 @@ from models.reg_lstm.model import RegLSTM
 from models.xml_cnn.model import XmlCNN
 from tasks.relevance_transfer.args import get_args
 from tasks.relevance_transfer.rerank import rerank
-from utils.optimization import BertAdam
+from utils.optimization import BertAdam, get_adam
 
 # String templates for logging results
 LOG_HEADER = 'Topic  Dev/Acc.  Dev/Pr.  Dev/AP.   Dev/F1   Dev/Loss'
@@ -236,6 +236,7 @@ if __name__ == '__main__':
                     'model_outfile': args.save_path,
                     'n_gpu': n_gpu,
                     'device': args.device,
+                    'deduplicate': args.deduplicate,
                     'is_hierarchical': True if args.model in {'HBERT-Base', 'HBERT-Large'} else False
                 }
 
@@ -320,8 +321,7 @@ if __name__ == '__main__':
                     model.cuda()
                     print('Shifting model to GPU...')
 
-                parameter = filter(lambda p: p.requires_grad, model.parameters())
-                optimizer = torch.optim.Adam(parameter, lr=args.lr, weight_decay=args.weight_decay)
+                optimizer = get_adam(model, lr=args.lr, weight_decay=args.weight_decay)
 
                 trainer_config = {
                     'model': args.model,
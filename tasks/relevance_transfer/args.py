@@ -30,6 +30,10 @@ def get_args():
     parser.add_argument("--output-path", type=str, default="run.core17.lstm.topics.robust00.txt")
     parser.add_argument('--resume-snapshot', action='store_true')
     parser.add_argument('--resample', action='store_true')
+    parser.add_argument('--sparse-embeddings', action='store_true',
+                        help='train the embeddings of the rand and non-static modes with sparse gradients and SparseAdam')
+    parser.add_argument('--deduplicate', action='store_true',
+                        help='train BERT models on one copy of duplicate examples, weighted by their number of copies')
 
     # RegLSTM parameters
     parser.add_argument('--num-layers', type=int, default=2)
@@ -0,0 +1,187 @@
+import pickle
+import unittest
+from argparse import Namespace
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from models.fused_conv import MultiWidthConv1d
+from models.kim_cnn import model as kim_cnn_model
+from models.xml_cnn import model as xml_cnn_model
+
+WORDS_NUM = 20
+WORDS_DIM = 6
+
+
+class LegacyCNN(nn.Module):
+    """
+    Embeddings and separate convolutions of KimCNN and XmlCNN as they were before the convolutions were fused
+    """
+
+    def __init__(self, config, widths):
+        super().__init__()
+        self.mode = config.mode
+        self.output_channel = config.output_channel
+        self.ks = len(widths)
+        input_channel = 1
+        if config.mode == 'rand':
+            self.embed = nn.Embedding.from_pretrained(torch.Tensor(WORDS_NUM, WORDS_DIM).uniform_(-0.25, 0.25),
+                                                      freeze=False)
+        else:
+            self.static_embed = nn.Embedding.from_pretrained(config.dataset.TEXT_FIELD.vocab.vectors, freeze=True)
+            self.non_static_embed = nn.Embedding.from_pretrained(config.dataset.TEXT_FIELD.vocab.vectors.clone(),
+                                                                 freeze=False)
+            input_channel = 2
+        for i, width in enumerate(widths):
+            setattr(self, 'conv%d' % (i + 1), nn.Conv2d(input_channel, config.output_channel, (width, WORDS_DIM),
+                                                         padding=(width - 1, 0)))
+        self.dropout = nn.Dropout(config.dropout)
+
+    def conv_outputs(self, x):
+        if self.mode == 'rand':
+            x = self.embed(x).unsqueeze(1)
+        else:
+            x = torch.stack([self.non_static_embed(x), self.static_embed(x)], dim=1)
+        return [F.relu(self.conv1(x)).squeeze(3), F.relu(self.conv2(x)).squeeze(3), F.relu(self.conv3(x)).squeeze(3)]
+
+
+class LegacyKimCNN(LegacyCNN):
+
+    def __init__(self, config):
+        super().__init__(config, (3, 4, 5))
+        self.fc1 = nn.Linear(self.ks * config.output_channel, config.target_class)
+
+    def forward(self, x, **kwargs):
+        x = [F.max_pool1d(i, i.size(2)).squeeze(2) for i in self.conv_outputs(x)]
+        return self.fc1(self.dropout(torch.cat(x, 1)))
+
+
+class LegacyXmlCNN(LegacyCNN):
+
+    def __init__(self, config):
+        super().__init__(config, (2, 4, 8))
+        self.num_bottleneck_hidden = config.num_bottleneck_hidden
+        self.dynamic_pool_length = config.dynamic_pool_length
+        self.bottleneck = nn.Linear(self.ks * self.output_channel * self.dynamic_pool_length,
+                                    self.num_bottleneck_hidden)
+        self.fc1 = nn.Linear(self.num_bottleneck_hidden, config.target_class)
+        self.pool = nn.AdaptiveMaxPool1d(self.dynamic_pool_length)
+
+    def forward(self, x, **kwargs):
+        x = torch.cat([self.pool(i).squeeze(2) for i in self.conv_outputs(x)], 1)
+        x = F.relu(self.bottleneck(x.view(-1, self.ks * self.output_channel * self.dynamic_pool_length)))
+        return self.fc1(self.dropout(x))
+
+
+def make_config(mode):
+    vectors = torch.randn(WORDS_NUM, WORDS_DIM)
+    dataset = Namespace(TEXT_FIELD=Namespace(vocab=Namespace(vectors=vectors)))
+    return Namespace(dataset=dataset, mode=mode, output_channel=5, target_class=4, words_num=WORDS_NUM,
+                     words_dim=WORDS_DIM, dropout=0.5, num_bottleneck_hidden=7, dynamic_pool_length=3)
+
+
+def load_as(legacy, module, name):
+    """
+    Pickles a legacy model under the name of the current model class, as its snapshots were, and loads it back
+    """
+    cls, saved = type(legacy), (type(legacy).__module__, type(legacy).__qualname__)
+    current = getattr(module, name)
+    cls.__module__, cls.__qualname__ = module.__name__, name
+    setattr(module, name, cls)
+    try:
+        snapshot = pickle.dumps(legacy)
+    finally:
+        setattr(module, name, current)
+        cls.__module__, cls.__qualname__ = saved
+    return pickle.loads(snapshot)
+
+
+class MultiWidthConv1dTest(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def test_matches_separate_convolutions(self):
+        for input_channel in (1, 2):
+            convs = [nn.Conv2d(input_channel, 5, (width, WORDS_DIM), padding=(width - 1, 0)) for width in (2, 4, 8)]
+            fused = MultiWidthConv1d.from_conv2d(convs)
+            # Inputs shorter than, as long as and longer than the widest kernel
+            for length in (1, 3, 8, 13):
+                with self.subTest(input_channel=input_channel, length=length):
+                    x = torch.randn(3, input_channel, length, WORDS_DIM)
+                    expected = [conv(x).squeeze(3) for conv in convs]
+                    output = fused(x.permute(0, 1, 3, 2).contiguous().view(3, -1, length))
+                    for a, e in zip(fused.split(output, length), expected):
+                        self.assertEqual(a.shape, e.shape)
+                        self.assertTrue(torch.allclose(a, e, atol=1e-5))
+
+                    # Max over time of the masked output is the max over time of every separate output
+                    pooled = (F.relu(output) * fused.valid_mask(length)).max(dim=2)[0]
+                    expected = torch.cat([F.max_pool1d(F.relu(e), e.size(2)).squeeze(2) for e in expected], 1)
+                    self.assertTrue(torch.allclose(pooled, expected, atol=1e-5))
+
+    def test_masked_kernel_positions_stay_zero(self):
+        conv = MultiWidthConv1d(WORDS_DIM, 5, (2, 4, 8))
+        conv(torch.randn(2, WORDS_DIM, 3)).sum().backward()
+        with torch.no_grad():
+            conv.weight -= conv.weight.grad
+        self.assertTrue(torch.equal(conv.weight * (1 - conv.kernel_mask), torch.zeros_like(conv.weight)))
+        # Weights under the mask never reach the output, even if they are not zero
+        x = torch.randn(2, WORDS_DIM, 3)
+        expected = conv(x)
+        with torch.no_grad():
+            conv.weight.add_(1 - conv.kernel_mask)
+        self.assertTrue(torch.allclose(conv(x), expected))
+
+
+class LegacySnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def assert_same_logits(self, legacy, module, name):
+        legacy.eval()
+        loaded = load_as(legacy, module, name).eval()
+        self.assertIsInstance(loaded, getattr(module, name))
+        self.assertIsInstance(loaded.conv, MultiWidthConv1d)
+        self.assertFalse(any(hasattr(loaded, 'conv%d' % i) for i in (1, 2, 3)))
+        for length in (1, 3, 8, 13):
+            with self.subTest(length=length):
+                x = torch.randint(WORDS_NUM, (4, length), dtype=torch.long)
+                with torch.no_grad():
+                    self.assertTrue(torch.allclose(loaded(x), legacy(x), atol=1e-5))
+
+    def test_kim_cnn(self):
+        for mode in ('rand', 'multichannel'):
+            with self.subTest(mode=mode):
+                self.assert_same_logits(LegacyKimCNN(make_config(mode)), kim_cnn_model, 'KimCNN')
+
+    def test_xml_cnn(self):
+        for mode in ('rand', 'multichannel'):
+            with self.subTest(mode=mode):
+                self.assert_same_logits(LegacyXmlCNN(make_config(mode)), xml_cnn_model, 'XmlCNN')
+
+    def test_new_models_pool_like_separate_convolutions(self):
+        config = make_config('multichannel')
+        for module, name, legacy_cls in ((kim_cnn_model, 'KimCNN', LegacyKimCNN),
+                                         (xml_cnn_model, 'XmlCNN', LegacyXmlCNN)):
+            with self.subTest(model=name):
+                model = getattr(module, name)(config).eval()
+                legacy = legacy_cls(config).eval()
+                # Copy the fused weights into the separate convolutions
+                for i, width in enumerate(model.conv.widths):
+                    conv = getattr(legacy, 'conv%d' % (i + 1))
+                    weight = model.conv.weight.data[i * 5:(i + 1) * 5, :, model.conv.max_width - width:]
+                    conv.weight.data.copy_(weight.contiguous().view(5, 2, WORDS_DIM, width).permute(0, 1, 3, 2))
+                    conv.bias.data.copy_(model.conv.bias.data[i * 5:(i + 1) * 5])
+                legacy.load_state_dict({key: value for key, value in model.state_dict().items()
+                                        if key in legacy.state_dict()}, strict=False)
+                for length in (1, 5, 13):
+                    x = torch.randint(WORDS_NUM, (4, length), dtype=torch.long)
+                    with torch.no_grad():
+                        self.assertTrue(torch.allclose(model(x), legacy(x), atol=1e-5))
+
+
+if __name__ == '__main__':
+    unittest.main()
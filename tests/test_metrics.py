@@ -0,0 +1,130 @@
+import unittest
+import warnings
+
+import numpy as np
+import torch
+from sklearn import metrics
+
+from common.metrics import ConfusionCounts
+
+
+class ConfusionCountsTest(unittest.TestCase):
+    """
+    Checks the metrics derived from the confusion counts against sklearn on the same predictions
+    """
+
+    def setUp(self):
+        self.random = np.random.RandomState(0)
+
+    def sklearn_metrics(self, targets, predictions, average, pos_label=1, weights=None):
+        with warnings.catch_warnings():
+            # Ill-defined precision and recall are zero, sklearn warns about them
+            warnings.simplefilter('ignore')
+            precision, recall, f1, _ = metrics.precision_recall_fscore_support(
+                targets, predictions, average=average, pos_label=pos_label, sample_weight=weights)
+        accuracy = metrics.accuracy_score(targets, predictions, sample_weight=weights)
+        return accuracy, precision, recall, f1
+
+    def assert_metrics_equal(self, actual, expected):
+        for name, a, e in zip(('accuracy', 'precision', 'recall', 'f1'), actual, expected):
+            self.assertAlmostEqual(a, e, places=10, msg=name)
+
+    def batches(self, *arrays, batch_size=7):
+        for start in range(0, len(arrays[0]), batch_size):
+            yield [torch.from_numpy(array[start:start + batch_size]) for array in arrays]
+
+    def single_label_counts(self, targets, predictions, num_classes, weights=None):
+        counts = ConfusionCounts()
+        if weights is None:
+            for p, t in self.batches(predictions, targets):
+                counts.update_indices(p, t, num_classes)
+        else:
+            for p, t, w in self.batches(predictions, targets, weights):
+                counts.update_indices(p, t, num_classes, weights=w)
+        return counts
+
+    def multilabel_counts(self, targets, predictions, weights=None):
+        counts = ConfusionCounts()
+        if weights is None:
+            for p, t in self.batches(predictions, targets):
+                counts.update(p, t)
+        else:
+            for p, t, w in self.batches(predictions, targets, weights):
+                counts.update(p, t, weights=w)
+        return counts
+
+    def test_binary(self):
+        for pos_label in (0, 1):
+            for targets, predictions in (
+                    (self.random.randint(2, size=50), self.random.randint(2, size=50)),
+                    # The positive class is never predicted
+                    (self.random.randint(2, size=20), np.full(20, 1 - pos_label)),
+                    # The positive class is never a target
+                    (np.full(20, 1 - pos_label), self.random.randint(2, size=20)),
+                    # The positive class appears nowhere
+                    (np.full(20, 1 - pos_label), np.full(20, 1 - pos_label))):
+                with self.subTest(pos_label=pos_label, targets=targets, predictions=predictions):
+                    counts = self.single_label_counts(targets, predictions, 2)
+                    self.assert_metrics_equal(counts.compute('binary', pos_label=pos_label),
+                                              self.sklearn_metrics(targets, predictions, 'binary', pos_label))
+
+    def test_multiclass(self):
+        num_classes = 6
+        targets = self.random.randint(4, size=60)
+        # Class 4 is only predicted and class 5 appears nowhere
+        predictions = self.random.randint(5, size=60)
+        weights = self.random.randint(1, 4, size=60)
+        for average in ('micro', 'macro', 'weighted'):
+            for w in (None, weights):
+                with self.subTest(average=average, weights=w is not None):
+                    counts = self.single_label_counts(targets, predictions, num_classes, w)
+                    self.assert_metrics_equal(counts.compute(average),
+                                              self.sklearn_metrics(targets, predictions, average, weights=w))
+
+    def test_multiclass_never_predicted(self):
+        targets = self.random.randint(5, size=40)
+        predictions = self.random.randint(2, size=40)
+        for average in ('micro', 'macro', 'weighted'):
+            with self.subTest(average=average):
+                counts = self.single_label_counts(targets, predictions, 5)
+                self.assert_metrics_equal(counts.compute(average), self.sklearn_metrics(targets, predictions, average))
+
+    def test_multilabel(self):
+        targets = (self.random.rand(60, 8) < 0.3).astype(np.uint8)
+        predictions = (self.random.rand(60, 8) < 0.3).astype(np.uint8)
+        # Label 5 is never predicted, label 6 is never a target and label 7 appears nowhere
+        predictions[:, 5] = 0
+        targets[:, 6] = 0
+        targets[:, 7] = predictions[:, 7] = 0
+        # Some examples have no target or no predicted label
+        targets[:5] = 0
+        predictions[3:8] = 0
+        weights = self.random.randint(1, 4, size=60)
+        for average in ('micro', 'macro', 'weighted'):
+            for w in (None, weights):
+                with self.subTest(average=average, weights=w is not None):
+                    counts = self.multilabel_counts(targets, predictions, w)
+                    self.assert_metrics_equal(counts.compute(average),
+                                              self.sklearn_metrics(targets, predictions, average, weights=w))
+
+    def test_multilabel_without_targets(self):
+        targets = np.zeros((10, 4), dtype=np.uint8)
+        predictions = (self.random.rand(10, 4) < 0.5).astype(np.uint8)
+        for average in ('micro', 'macro', 'weighted'):
+            with self.subTest(average=average):
+                counts = self.multilabel_counts(targets, predictions)
+                self.assert_metrics_equal(counts.compute(average), self.sklearn_metrics(targets, predictions, average))
+
+    def test_per_class(self):
+        targets = self.random.randint(4, size=50)
+        predictions = self.random.randint(3, size=50)
+        precision, recall, f1, support = self.single_label_counts(targets, predictions, 4).per_class()
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            expected = metrics.precision_recall_fscore_support(targets, predictions, labels=range(4))
+        for name, a, e in zip(('precision', 'recall', 'f1', 'support'), (precision, recall, f1, support), expected):
+            np.testing.assert_allclose(a, e, err_msg=name)
+
+
+if __name__ == '__main__':
+    unittest.main()
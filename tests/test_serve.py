@@ -0,0 +1,96 @@
+import asyncio
+import unittest
+from argparse import Namespace
+
+import torch
+
+from common.predict import FieldEncoder, Predictor
+from common.serve import DynamicBatcher
+from models.reg_lstm.model import RegLSTM
+
+
+class WhitespaceField(object):
+
+    def preprocess(self, text):
+        return text.split()
+
+
+class WhitespaceDataset(object):
+    TEXT_FIELD = WhitespaceField()
+
+
+class Vocab(object):
+    stoi = {'<unk>': 0, '<pad>': 1, 'oil': 2, 'prices': 3, 'rose': 4}
+
+
+class FailingPredictor(object):
+    """
+    Predictor that fails every batch holding one of the given documents
+    """
+
+    def __init__(self, failing_texts):
+        self.failing_texts = set(failing_texts)
+        self.batches = list()
+
+    def predict(self, texts):
+        self.batches.append(list(texts))
+        if self.failing_texts.intersection(texts):
+            raise ValueError('cannot predict')
+        return [([len(text)], [1.0]) for text in texts]
+
+
+def reg_lstm_predictor():
+    torch.manual_seed(0)
+    config = Namespace(dataset=None, target_class=3, bidirectional=True, bottleneck_layer=False, mode='rand',
+                       tar=0, ar=0, beta_ema=0, wdrop=0, embed_droprate=0, words_num=len(Vocab.stoi), words_dim=8,
+                       hidden_dim=4, dropout=0, num_layers=1)
+    encoder = FieldEncoder(WhitespaceDataset, Vocab())
+    return Predictor(RegLSTM(config).eval(), encoder, torch.device('cpu'), top_k=2)
+
+
+class DynamicBatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def predict_together(self, predictor, texts):
+        # The batch waits long enough for every document to be queued, so they are all scored together
+        batcher = DynamicBatcher(predictor, max_batch_size=len(texts), max_wait_ms=1000, loop=self.loop)
+        task = self.loop.create_task(batcher.run())
+        try:
+            results = self.loop.run_until_complete(
+                asyncio.gather(*[batcher.predict(text) for text in texts], return_exceptions=True))
+        finally:
+            task.cancel()
+            self.loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+            batcher.executor.shutdown()
+        return results, batcher.stats.batch_sizes
+
+    def test_documents_without_tokens_are_batched_with_others(self):
+        texts = ['oil prices rose', '', ' \t ', '—', 'prices']
+        predictor = reg_lstm_predictor()
+        results, batch_sizes = self.predict_together(predictor, texts)
+        self.assertEqual(batch_sizes, {len(texts): 1})
+        for text, (labels, scores) in zip(texts, results):
+            expected_labels, expected_scores = predictor.predict([text])[0]
+            self.assertEqual(labels, expected_labels)
+            for score, expected_score in zip(scores, expected_scores):
+                self.assertAlmostEqual(score, expected_score, places=5)
+
+    def test_failing_document_only_fails_its_request(self):
+        predictor = FailingPredictor(['bad'])
+        results, batch_sizes = self.predict_together(predictor, ['a', 'bad', 'ccc'])
+        self.assertEqual(batch_sizes, {3: 1, 1: 3})
+        self.assertEqual(results[0], ([1], [1.0]))
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(results[2], ([3], [1.0]))
+        self.assertEqual(predictor.batches, [['a', 'bad', 'ccc'], ['a'], ['bad'], ['ccc']])
+
+
+if __name__ == '__main__':
+    unittest.main()
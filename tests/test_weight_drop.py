@@ -0,0 +1,160 @@
+import copy
+import inspect
+import pickle
+import unittest
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.rnn import PackedSequence, pack_padded_sequence
+
+from models.reg_lstm import weight_drop
+from models.reg_lstm.weight_drop import WeightDrop
+
+HAS_ENFORCE_SORTED = 'enforce_sorted' in inspect.signature(pack_padded_sequence).parameters
+
+
+class LegacyWeightDrop(torch.nn.Module):
+    """
+    WeightDrop as it was before it ran the RNN functionally, for building snapshots of that version
+    """
+
+    def __init__(self, module, weights, dropout=0, variational=False):
+        super().__init__()
+        self.module = module
+        self.weights = weights
+        self.dropout = dropout
+        self.variational = variational
+        self._setup()
+
+    def null_function(*args, **kwargs):
+        return
+
+    def _setup(self):
+        if issubclass(type(self.module), torch.nn.RNNBase):
+            self.module.flatten_parameters = self.null_function
+
+        for name_w in self.weights:
+            w = getattr(self.module, name_w)
+            del self.module._parameters[name_w]
+            self.module.register_parameter(name_w + '_raw', nn.Parameter(w.data))
+
+    def _setweights(self):
+        for name_w in self.weights:
+            raw_w = getattr(self.module, name_w + '_raw')
+            w = nn.Parameter(torch.nn.functional.dropout(raw_w, p=self.dropout, training=self.training))
+            setattr(self.module, name_w, w)
+
+    def forward(self, *args):
+        self._setweights()
+        return self.module.forward(*args)
+
+
+def flatten(value):
+    if isinstance(value, PackedSequence):
+        return [value.data]
+    if isinstance(value, (tuple, list)):
+        return [tensor for item in value for tensor in flatten(item)]
+    return [value]
+
+
+class WeightDropTest(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.lengths = torch.tensor([5, 3, 4, 1])
+        self.padded = torch.randn(4, 5, 6)
+
+    def rnn(self, mode, batch_first=True):
+        cls = nn.LSTM if mode == 'LSTM' else nn.GRU
+        return cls(6, 3, num_layers=2, bidirectional=True, batch_first=batch_first)
+
+    def hidden(self, mode):
+        hx = torch.randn(4, 4, 3)
+        return (hx, torch.randn(4, 4, 3)) if mode == 'LSTM' else hx
+
+    def assert_matches(self, module, make_input, hx=None):
+        """
+        Checks that WeightDrop without dropout returns the outputs and gradients of the module it wraps, in training
+        """
+        expected_module = copy.deepcopy(module).train()
+        wrapped = WeightDrop(module, ['weight_hh_l0', 'weight_hh_l1_reverse'], dropout=0).train()
+
+        expected = flatten(expected_module(make_input(), hx))
+        actual = flatten(wrapped(make_input(), hx))
+        self.assertEqual(len(actual), len(expected))
+        for a, e in zip(actual, expected):
+            self.assertEqual(a.shape, e.shape)
+            self.assertTrue(torch.allclose(a, e, atol=1e-6))
+
+        sum(x.sum() for x in expected).backward()
+        sum(x.sum() for x in actual).backward()
+        for (name, a), e in zip(wrapped.module.named_parameters(), expected_module.parameters()):
+            self.assertTrue(torch.allclose(a.grad, e.grad, atol=1e-5), name)
+
+        with torch.no_grad():
+            for a, e in zip(flatten(wrapped(make_input(), hx)), flatten(expected_module(make_input(), hx))):
+                self.assertFalse(a.requires_grad)
+                self.assertTrue(torch.allclose(a, e, atol=1e-6))
+
+    def test_padded_input(self):
+        for mode in ('LSTM', 'GRU'):
+            for batch_first in (True, False):
+                with self.subTest(mode=mode, batch_first=batch_first):
+                    padded = self.padded if batch_first else self.padded.transpose(0, 1)
+                    self.assert_matches(self.rnn(mode, batch_first), lambda: padded.clone())
+
+    def test_padded_input_with_hidden_state(self):
+        for mode in ('LSTM', 'GRU'):
+            with self.subTest(mode=mode):
+                self.assert_matches(self.rnn(mode), lambda: self.padded.clone(), self.hidden(mode))
+
+    def test_sorted_packed_input(self):
+        order = torch.sort(self.lengths, descending=True)[1]
+        padded, lengths = self.padded[order], self.lengths[order]
+        for mode in ('LSTM', 'GRU'):
+            for hx in (None, self.hidden(mode)):
+                with self.subTest(mode=mode, hidden_state=hx is not None):
+                    self.assert_matches(self.rnn(mode), lambda: pack_padded_sequence(padded, lengths, batch_first=True),
+                                        hx)
+
+    @unittest.skipUnless(HAS_ENFORCE_SORTED, 'pack_padded_sequence cannot sort its input')
+    def test_unsorted_packed_input(self):
+        for mode in ('LSTM', 'GRU'):
+            for hx in (None, self.hidden(mode)):
+                with self.subTest(mode=mode, hidden_state=hx is not None):
+                    self.assert_matches(self.rnn(mode), lambda: pack_padded_sequence(
+                        self.padded, self.lengths, batch_first=True, enforce_sorted=False), hx)
+
+    def test_legacy_snapshot(self):
+        legacy = LegacyWeightDrop(self.rnn('LSTM'), ['weight_hh_l0'], dropout=0.5).train()
+        legacy(self.padded)
+        legacy.eval()
+        with torch.no_grad():
+            expected = flatten(legacy(self.padded))
+
+        # Pickle the legacy module under the name of WeightDrop, as snapshots of the previous version were
+        name = LegacyWeightDrop.__module__, LegacyWeightDrop.__qualname__
+        LegacyWeightDrop.__module__, LegacyWeightDrop.__qualname__ = weight_drop.__name__, 'WeightDrop'
+        weight_drop.WeightDrop = LegacyWeightDrop
+        try:
+            snapshot = pickle.dumps(legacy)
+        finally:
+            weight_drop.WeightDrop = WeightDrop
+            LegacyWeightDrop.__module__, LegacyWeightDrop.__qualname__ = name
+        loaded = pickle.loads(snapshot)
+
+        self.assertIsInstance(loaded, WeightDrop)
+        self.assertNotIn('weight_hh_l0_raw', loaded.module._parameters)
+        self.assertEqual(list(loaded.module._parameters), [name for names in loaded.module._all_weights
+                                                           for name in names])
+        self.assertTrue(torch.equal(loaded.module.weight_hh_l0, legacy.module.weight_hh_l0_raw))
+        with torch.no_grad():
+            for a, e in zip(flatten(loaded.eval()(self.padded)), expected):
+                self.assertTrue(torch.allclose(a, e, atol=1e-6))
+
+        loaded.dropout = 0
+        self.assert_matches(loaded.module, lambda: self.padded.clone())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,307 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import TensorDataset
+
+from utils.preprocessing import length_mask, offsets_from_lengths, pad_documents
+
+META_NAME = 'meta.json'
+HIDDEN_NAME = 'hidden.npy'
+OFFSETS_NAME = 'offsets.npy'
+VECTORS_NAME = 'vectors.bin'
+DIGESTS_NAME = 'digests.bin'
+DIGEST_SIZE = hashlib.sha1().digest_size
+PADDING_ROW = 0
+
+
+def features_digest(features):
+    """
+    Returns a digest of the token ids, lengths and segment starts of a FeatureStore
+    :param features: FeatureStore
+    :return: hex digest
+    """
+    digest = hashlib.sha1()
+    for array in (features.input_ids, features.lengths, features.segment_starts):
+        digest.update(np.ascontiguousarray(array).data)
+    return digest.hexdigest()
+
+
+def module_digest(module):
+    """
+    Returns a digest of the names, types and values of the parameters and buffers of a module
+    :param module: nn.Module
+    :return: hex digest
+    """
+    digest = hashlib.sha1()
+    for name, tensor in module.state_dict().items():
+        digest.update('{}:{}'.format(name, tensor.dtype).encode('utf-8'))
+        digest.update(np.ascontiguousarray(tensor.detach().cpu().numpy()).data)
+    return digest.hexdigest()
+
+
+def is_fresh(directory, key):
+    """
+    Checks that a cache exists and was built for the given key
+    :param directory: cache directory
+    :param key: dict identifying the model and the data the cache was built from
+    :return: True if the cache can be used
+    """
+    meta_path = os.path.join(directory, META_NAME)
+    if not os.path.isfile(meta_path):
+        return False
+    with open(meta_path, 'r') as f:
+        return json.load(f) == key
+
+
+class ActivationCache(object):
+    """
+    Hidden states of the frozen prefix of a BERT model over a data set, stored as fp16 in a memory-mapped .npy
+    file. Only the positions within the length of each sequence are stored, as consecutive rows of a flat
+    (num_tokens, hidden_size) array with int64 offsets, so padding takes no space in the cache.
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: directory the cache was written to with ActivationCache.build
+        """
+        self.directory = directory
+        self.hidden = np.load(os.path.join(directory, HIDDEN_NAME), mmap_mode='r')
+        self.offsets = np.load(os.path.join(directory, OFFSETS_NAME))
+        self.lengths = np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @classmethod
+    def build(cls, directory, model, features, key, batch_size, device):
+        """
+        Runs the frozen prefix of a model once over a FeatureStore and writes its hidden states
+        :param directory: output directory
+        :param model: BertForSequenceClassification with frozen layers
+        :param features: flat FeatureStore
+        :param key: dict identifying the model, its frozen layers and the features, checked by is_fresh
+        :param batch_size: number of sequences per forward pass
+        :param device: device to run the model on
+        :return: ActivationCache
+        """
+        os.makedirs(directory, exist_ok=True)
+        meta_path = os.path.join(directory, META_NAME)
+        if os.path.isfile(meta_path):
+            os.remove(meta_path)
+
+        lengths = features.lengths.astype(np.int64)
+        offsets = offsets_from_lengths(lengths)
+        hidden = np.lib.format.open_memmap(os.path.join(directory, HIDDEN_NAME), mode='w+', dtype=np.float16,
+                                           shape=(int(offsets[-1]), model.config.hidden_size))
+        input_ids, input_mask, segment_ids = features.tensors()
+
+        was_training = model.training
+        model.eval()
+        with torch.no_grad():
+            for start in range(0, len(features), batch_size):
+                end = min(start + batch_size, len(features))
+                # Padding is masked out of the attention, so each batch only needs its longest sequence
+                width = int(lengths[start:end].max())
+                batch = [t[start:end, :width].to(device).long() for t in (input_ids, segment_ids, input_mask)]
+                output = model.encode_frozen(*batch).half().cpu().numpy()
+                mask = input_mask[start:end, :width].numpy().astype(bool)
+                hidden[offsets[start]:offsets[end]] = output[mask]
+        model.train(was_training)
+
+        hidden.flush()
+        del hidden
+        np.save(os.path.join(directory, OFFSETS_NAME), offsets)
+        # The metadata is written last, so an interrupted build is never mistaken for a complete cache
+        with open(meta_path, 'w') as f:
+            json.dump(key, f)
+        return cls(directory)
+
+    def batch(self, indices):
+        """
+        Gathers the hidden states of a batch of sequences, zero-padded to the longest one
+        :param indices: indices of the sequences
+        :return: fp16 hidden states of shape (batch_size, width, hidden_size) and the input mask
+        """
+        indices = np.asarray(indices)
+        lengths = self.lengths[indices]
+        width = int(lengths.max())
+        mask = np.arange(width) < lengths[:, None]
+        positions = self.offsets[indices][:, None] + np.arange(width)
+        hidden = np.zeros((len(indices), width, self.hidden.shape[1]), dtype=np.float16)
+        hidden[mask] = self.hidden[positions[mask]]
+        return torch.from_numpy(hidden), torch.from_numpy(mask.astype(np.int8))
+
+    def collate(self, batch):
+        """
+        Collates (index, label ids, ...) tuples into the inputs of BertForSequenceClassification
+        :param batch: list of (index, label ids) tuples, optionally followed by the example weight
+        :return: dict of model inputs, the label ids and any further columns
+        """
+        columns = list(zip(*batch))
+        hidden_states, input_mask = self.batch([int(i) for i in columns[0]])
+        inputs = {'frozen_hidden_states': hidden_states, 'attention_mask': input_mask}
+        return (inputs,) + tuple(torch.stack(column) for column in columns[1:])
+
+
+class SentenceEmbeddingStore(object):
+    """
+    Pooled vectors of a frozen sentence encoder, stored once per distinct sentence. Sentences are identified by a
+    hash of their token ids and segment start, and their fp16 vectors are appended to a memory-mapped file, so
+    every split encoded with the same encoder shares the store and repeated sentences are encoded only once.
+    Row 0 holds the vector of the empty sentences documents are padded with.
+    """
+
+    def __init__(self, directory, key, hidden_size):
+        """
+        :param directory: directory of the store, created if needed
+        :param key: dict identifying the sentence encoder, the store is emptied if it was built for another key
+        :param hidden_size: size of the sentence vectors
+        """
+        self.directory = directory
+        self.hidden_size = hidden_size
+        self.vectors_path = os.path.join(directory, VECTORS_NAME)
+        self.digests_path = os.path.join(directory, DIGESTS_NAME)
+        os.makedirs(directory, exist_ok=True)
+
+        if not is_fresh(directory, key):
+            for path in (self.vectors_path, self.digests_path):
+                if os.path.isfile(path):
+                    os.remove(path)
+            with open(os.path.join(directory, META_NAME), 'w') as f:
+                json.dump(key, f)
+
+        digests = b''
+        if os.path.isfile(self.digests_path):
+            with open(self.digests_path, 'rb') as f:
+                digests = f.read()
+        # Digests are written after their vectors, drop the vectors of an interrupted write
+        vector_size = hidden_size * np.dtype(np.float16).itemsize
+        num_vectors = os.path.getsize(self.vectors_path) // vector_size if os.path.isfile(self.vectors_path) else 0
+        num_vectors = min(num_vectors, len(digests) // DIGEST_SIZE)
+        if os.path.isfile(self.vectors_path):
+            os.truncate(self.vectors_path, num_vectors * vector_size)
+            os.truncate(self.digests_path, num_vectors * DIGEST_SIZE)
+        self.index = {digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE]: i for i in range(num_vectors)}
+        self.vectors = None
+        self._map()
+
+    def __len__(self):
+        return len(self.index)
+
+    def _map(self):
+        if self.index:
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float16, mode='r',
+                                     shape=(len(self.index), self.hidden_size))
+
+    @staticmethod
+    def _digest(input_ids, segment_start):
+        return hashlib.sha1(input_ids.tobytes() + np.int32(segment_start).tobytes()).digest()
+
+    @staticmethod
+    def _encode(encoder, input_ids, lengths, segment_starts, device):
+        width = input_ids.shape[1]
+        input_ids = torch.from_numpy(input_ids).to(device).long()
+        input_mask = torch.from_numpy(length_mask(lengths, width)).to(device).long()
+        segment_ids = torch.from_numpy(length_mask(lengths, width, start=segment_starts)).to(device).long()
+        return encoder(input_ids, segment_ids, input_mask).half().cpu().numpy()
+
+    def encode(self, encoder, features, batch_size, device):
+        """
+        Encodes the sentences of a hierarchical FeatureStore that are not in the store yet
+        :param encoder: BertSentenceEncoder
+        :param features: hierarchical FeatureStore
+        :param batch_size: number of sentences per forward pass
+        :param device: device to run the encoder on
+        :return: store row of each sentence of the features
+        """
+        digests = [self._digest(features.input_ids[i, :features.lengths[i]], features.segment_starts[i])
+                   for i in range(len(features.input_ids))]
+        missing = dict()
+        if not self.index:
+            # Padding sentences are all zeros and fully masked, like the padding rows of FeatureStore.tensors
+            missing[self._digest(features.input_ids[0, :0], 0)] = -1
+        for i, digest in enumerate(digests):
+            if digest not in self.index and digest not in missing:
+                missing[digest] = i
+
+        if missing:
+            rows = np.array(list(missing.values()), dtype=np.int64)
+            # Sentences are encoded in order of length, so each batch is only as wide as its longest sentence.
+            # The padding sentence comes first, so it is stored in PADDING_ROW.
+            order = np.argsort(np.where(rows < 0, -1, features.lengths[np.maximum(rows, 0)]), kind='stable')
+            was_training = encoder.training
+            encoder.eval()
+            with open(self.vectors_path, 'ab') as f, torch.no_grad():
+                for start in range(0, len(order), batch_size):
+                    batch = rows[order[start:start + batch_size]]
+                    padding = batch < 0
+                    lengths = np.where(padding, 0, features.lengths[batch])
+                    input_ids = np.where(padding[:, None], 0, features.input_ids[np.maximum(batch, 0)])
+                    segment_starts = np.where(padding, 0, features.segment_starts[np.maximum(batch, 0)])
+                    # The padding sentence spans the full width, as it does when the whole model is run
+                    width = features.input_ids.shape[1] if padding.any() else int(lengths.max())
+                    vectors = self._encode(encoder, input_ids[:, :width], lengths, segment_starts, device)
+                    f.write(vectors.tobytes())
+            encoder.train(was_training)
+
+            digests_in_order = list(missing.keys())
+            with open(self.digests_path, 'ab') as f:
+                for position in order:
+                    digest = digests_in_order[position]
+                    self.index[digest] = len(self.index)
+                    f.write(digest)
+            self._map()
+
+        return np.fromiter((self.index[digest] for digest in digests), dtype=np.int64, count=len(digests))
+
+    def dataset(self, encoder, features, max_doc_length, batch_size, device):
+        """
+        Returns a TensorDataset of the store rows of the sentences of each document and the label ids, followed by
+        the weights of deduplicated features
+        :param encoder: BertSentenceEncoder used for sentences that are not in the store yet
+        :param features: hierarchical FeatureStore
+        :param max_doc_length: maximum number of sentences per document
+        :param batch_size: number of sentences per forward pass
+        :param device: device to run the encoder on
+        :return: TensorDataset
+        """
+        rows = self.encode(encoder, features, batch_size, device)
+        rows = pad_documents(rows, features.doc_offsets, max_doc_length, pad_value=PADDING_ROW)
+        tensors = (torch.from_numpy(rows), torch.from_numpy(features.label_ids))
+        if features.weights is not None:
+            tensors += (torch.from_numpy(features.weights),)
+        return TensorDataset(*tensors)
+
+    def collate(self, batch):
+        """
+        Collates (store rows, label ids, ...) tuples into the inputs of HierarchicalBert
+        :param batch: list of (store rows, label ids) tuples, optionally followed by the example weight
+        :return: dict of model inputs, the label ids and any further columns
+        """
+        columns = list(zip(*batch))
+        vectors = self.vectors[torch.stack(columns[0]).numpy()]
+        return ({'sentence_vectors': torch.from_numpy(vectors)},) + tuple(torch.stack(c) for c in columns[1:])
+
+
+def sentence_store(args, model):
+    """
+    Returns the SentenceEmbeddingStore of a HierarchicalBert model if its sentence encoder is frozen
+    :param args: command line arguments
+    :param model: HierarchicalBert, possibly wrapped in DataParallel
+    :return: SentenceEmbeddingStore or None
+    """
+    if not getattr(args, 'freeze_sentence_encoder', False):
+        return None
+    model = getattr(model, 'module', model)
+    directory = os.path.join(args.sentence_cache_dir, '{}_{}'.format(
+        os.path.basename(os.path.normpath(args.model)), args.max_seq_length))
+    if args.local_rank != -1:
+        directory = os.path.join(directory, 'rank%d' % args.local_rank)
+    # The encoder may have been fine-tuned or loaded from a snapshot, so its weights identify it rather than its name
+    encoder = model.sentence_encoder
+    key = {'model': args.model, 'max_seq_length': args.max_seq_length, 'encoder': module_digest(encoder),
+           'dtype': str(next(encoder.parameters()).dtype)}
+    return SentenceEmbeddingStore(directory, key, encoder.config.hidden_size)
@@ -0,0 +1,218 @@
+import os
+
+import torch
+import torch.nn as nn
+
+# Shortest sequence bucket, shorter batches are padded to it
+MIN_BUCKET = 8
+
+
+def is_compile_enabled(args):
+    """
+    Checks that --compile is set and that the installed PyTorch can compile modules in place
+    :param args: command line arguments
+    :return: True if models are compiled
+    """
+    return getattr(args, 'compile', False) and hasattr(nn.Module, 'compile')
+
+
+def bucket_size(size, minimum=MIN_BUCKET, maximum=None):
+    """
+    Rounds a dimension up to the next power of two
+    :param size: size of the dimension
+    :param minimum: smallest bucket
+    :param maximum: largest bucket, e.g. the maximum sequence length, None for no limit
+    :return: bucket size
+    """
+    bucket = minimum
+    while bucket < size:
+        bucket *= 2
+    return min(bucket, maximum) if maximum is not None else bucket
+
+
+def resize(tensor, dim, size, value=0):
+    """
+    Trims or pads a tensor along a dimension
+    :param tensor: tensor to resize
+    :param dim: dimension to resize
+    :param size: new size of the dimension
+    :param value: value of the padding
+    :return: tensor whose size along dim is size
+    """
+    if tensor.size(dim) >= size:
+        return tensor.narrow(dim, 0, size)
+    shape = list(tensor.size())
+    shape[dim] = size - tensor.size(dim)
+    return torch.cat([tensor, tensor.new_full(shape, value)], dim)
+
+
+class ShapeBuckets(object):
+    """
+    Rounds the batch and sequence dimensions of model inputs up to a few sizes, so a model compiled for static
+    shapes is compiled once per bucket rather than once per batch shape. Batches are padded to the batch size, or
+    to the next power of two for larger batches, and sequences to the next power of two. Padding is masked out:
+    BERT attends to the positions of its input mask only, RegLSTM packs its inputs by length, padding rows are
+    dropped from the outputs or weighted zero in the losses and metrics.
+    """
+
+    def __init__(self, batch_size, max_length=None):
+        """
+        :param batch_size: number of examples per batch
+        :param max_length: largest sequence bucket, e.g. the maximum sequence length of BERT
+        """
+        self.batch_size = batch_size
+        self.max_length = max_length
+
+    def rows(self, num_rows):
+        return self.batch_size if num_rows <= self.batch_size else bucket_size(num_rows, self.batch_size)
+
+    def length(self, length):
+        return bucket_size(length, maximum=self.max_length)
+
+    def lengths(self, longest=None):
+        """
+        :param longest: length of the longest sequence, defaults to max_length
+        :return: every sequence bucket up to that of the longest sequence, in increasing order
+        """
+        largest = self.length(longest or self.max_length)
+        sizes = [self.length(1)]
+        while sizes[-1] < largest:
+            sizes.append(self.length(sizes[-1] + 1))
+        return sizes
+
+    def pad(self, tensors, mask=None):
+        """
+        Pads BERT inputs, whose sequence positions are given by an input mask
+        :param tensors: tensors of shape (batch_size, ...), whose sequence dimension is the last dimension of mask
+        :param mask: input mask with ones at the positions within each sequence, None to only pad the rows
+        :return: list of padded tensors and the number of rows of the batch, to slice the outputs with
+        """
+        num_rows = tensors[0].size(0)
+        if mask is not None:
+            # Positions past the longest sequence of the batch are trimmed, as they are masked out of the attention
+            dim = mask.dim() - 1
+            width = self.length(int(mask.sum(dim=dim).max()))
+            tensors = [resize(tensor, dim, width) for tensor in tensors]
+        return [resize(tensor, 0, self.rows(num_rows)) for tensor in tensors], num_rows
+
+    def pad_batch(self, batch, pad_index):
+        """
+        Pads a torchtext batch in place. Padding rows hold one padding token, keeping the decreasing lengths that
+        packed sequences need, and have a zero label and weight. The size of the batch before padding is kept in
+        unpadded_size to slice the RNN outputs of models trained with activation regularization.
+        :param batch: batch of a torchtext iterator or a ShardedDataset
+        :param pad_index: index of the padding token
+        """
+        text, lengths = batch.text if isinstance(batch.text, tuple) else (batch.text, None)
+        num_rows = text.size(0)
+        batch.unpadded_size = tuple(text.size())
+        if not text.is_floating_point():
+            # Token ids have one sequence dimension, or two for the sentences and words of hierarchical datasets.
+            # Character quantized documents are fixed size arrays.
+            for dim in range(1, text.dim()):
+                text = resize(text, dim, self.length(text.size(dim)), pad_index)
+        rows = self.rows(num_rows)
+        text = resize(text, 0, rows, pad_index)
+        batch.text = (text, resize(lengths, 0, rows, 1)) if lengths is not None else text
+
+        weights = getattr(batch, 'weight', None)
+        if weights is None:
+            weights = torch.ones(num_rows, dtype=torch.long, device=text.device)
+        batch.weight = resize(weights, 0, rows)
+        batch.label = resize(batch.label, 0, rows)
+
+
+def pad_index(dataset):
+    """
+    Returns the index of the padding token of the TEXT_FIELD of a dataset
+    :param dataset: torchtext dataset or ShardedDataset
+    :return: index of the padding token, 0 for fields without a vocabulary
+    """
+    field = dataset.TEXT_FIELD
+    vocab = getattr(field, 'vocab', None)
+    return vocab.stoi[field.pad_token] if vocab is not None else 0
+
+
+def shape_buckets(args, batch_size, max_length=None):
+    """
+    Returns the ShapeBuckets of a compiled model, or None when models run eagerly
+    :param args: command line arguments
+    :param batch_size: number of examples per batch
+    :param max_length: largest sequence bucket
+    :return: ShapeBuckets or None
+    """
+    return ShapeBuckets(batch_size, max_length) if is_compile_enabled(args) else None
+
+
+def pad_inputs(buckets, tensors, mask=None):
+    """
+    Pads BERT inputs with ShapeBuckets.pad, or leaves them as they are when models run eagerly
+    :param buckets: ShapeBuckets or None
+    :param tensors: tensors of shape (batch_size, ...)
+    :param mask: input mask, None to only pad the rows
+    :return: list of tensors and the number of rows of the batch, None if they were not padded
+    """
+    if buckets is None:
+        return list(tensors), None
+    return buckets.pad(tensors, mask)
+
+
+def compile_model(model, args):
+    """
+    Compiles a model in place with torch.compile when --compile is set. BERT and HBERT models compile their
+    BertModel, other models are compiled whole. The module keeps its class and attributes, so trainers use and save it as
+    before, and snapshots hold the eager module. Compiled graphs are cached in --compile-cache-dir across runs.
+    :param model: model, possibly wrapped in DataParallel or DistributedDataParallel
+    :param args: command line arguments
+    :return: the model
+    """
+    if not getattr(args, 'compile', False):
+        return model
+    if not hasattr(nn.Module, 'compile'):
+        print('Warning: --compile requires PyTorch 2.2 or later, the model runs eagerly')
+        return model
+
+    cache_dir = getattr(args, 'compile_cache_dir', None)
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.abspath(cache_dir))
+        os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+        os.environ.setdefault('TORCHINDUCTOR_AUTOGRAD_CACHE', '1')
+
+    import torch._dynamo
+    # Each sequence bucket is compiled for training and for evaluation
+    for name in ('recompile_limit', 'cache_size_limit'):
+        if hasattr(torch._dynamo.config, name):
+            setattr(torch._dynamo.config, name, max(getattr(torch._dynamo.config, name), 64))
+
+    module = getattr(model, 'module', model)
+    module = getattr(module, 'sentence_encoder', module)
+    module = getattr(module, 'bert', module)
+    module.compile(dynamic=False)
+    return model
+
+
+def warm_up(model, buckets, make_inputs, longest=None):
+    """
+    Compiles every sequence bucket of a model before training, running a forward and backward pass in training
+    mode and a forward pass in evaluation mode over inputs of each bucket. Gradients are cleared afterwards.
+    :param model: compiled model
+    :param buckets: ShapeBuckets
+    :param make_inputs: function of the number of rows and the sequence length returning the positional and
+    keyword inputs of the model
+    :param longest: length of the longest sequence of the data, defaults to the max_length of the buckets
+    """
+    was_training = model.training
+    for length in buckets.lengths(longest):
+        args, kwargs = make_inputs(buckets.batch_size, length)
+        model.train()
+        outputs = model(*args, **kwargs)
+        # Models trained with activation regularization also return their RNN outputs, and long document
+        # models the scores of their windows
+        logits = outputs[0] if isinstance(outputs, tuple) else outputs
+        logits.float().sum().backward()
+        model.eval()
+        with torch.no_grad():
+            model(*args, **kwargs)
+    model.zero_grad()
+    model.train(was_training)
@@ -0,0 +1,42 @@
+import hashlib
+import unicodedata
+
+import numpy as np
+
+
+def normalize_text(text):
+    """
+    Normalizes the unicode form and whitespace of a text, so copies that only differ in these hash the same
+    :param text: text, or None
+    :return: normalized text
+    """
+    if not text:
+        return ''
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+
+def text_digest(*parts):
+    """
+    Returns a digest of a sequence of strings
+    :param parts: strings, e.g. the normalized texts and the label of an example
+    :return: digest bytes
+    """
+    return hashlib.sha1('\x1f'.join(parts).encode('utf-8')).digest()
+
+
+def deduplicate(keys):
+    """
+    Finds the first occurrence of every distinct key
+    :param keys: iterable of hashable keys
+    :return: index of the first occurrence of each distinct key in order of appearance, index of the distinct key
+    of every item, and the number of occurrences of each distinct key
+    """
+    first, inverse, positions = list(), list(), dict()
+    for i, key in enumerate(keys):
+        position = positions.get(key)
+        if position is None:
+            position = positions[key] = len(first)
+            first.append(i)
+        inverse.append(position)
+    inverse = np.array(inverse, dtype=np.int64)
+    return np.array(first, dtype=np.int64), inverse, np.bincount(inverse, minlength=len(first))
@@ -15,6 +15,9 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import csv
+import gzip
+import io
 import json
 import logging
 import os
@@ -22,6 +25,7 @@ import shutil
 import sys
 import tempfile
 from functools import wraps
+from multiprocessing import Pool
 from hashlib import sha256
 from io import open
 
@@ -254,4 +258,106 @@ def read_set_from_file(filename):
 def get_file_extension(path, dot=True, lower=True):
     ext = os.path.splitext(path)[1]
     ext = ext if dot else ext[1:]
-    return ext.lower() if lower else ext
\ No newline at end of file
+    return ext.lower() if lower else ext
+
+
+def find_compressed(path):
+    """
+    Returns a path if the file exists, or else its gzip (.gz) or zstandard (.zst) compressed copy if that exists
+    """
+    if not os.path.exists(path):
+        for extension in ('.gz', '.zst'):
+            if os.path.exists(path + extension):
+                return path + extension
+    return path
+
+
+def open_text(path):
+    """
+    Opens a text file for reading, decompressing gzip (.gz) and zstandard (.zst) files transparently
+    """
+    extension = get_file_extension(path)
+    if extension == '.gz':
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if extension == '.zst':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("Install zstandard to read .zst files")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')), encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+
+def _parse_tsv(text, quotechar=None):
+    # Fields can hold entire news articles
+    csv.field_size_limit(sys.maxsize)
+    return list(csv.reader(io.StringIO(text), delimiter='\t', quotechar=quotechar))
+
+
+def _parse_tsv_range(args):
+    path, start, end, quotechar = args
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return _parse_tsv(f.read(end - start).decode('utf-8'), quotechar)
+
+
+def _parse_tsv_lines(args):
+    lines, quotechar = args
+    return _parse_tsv(''.join(lines), quotechar)
+
+
+def _line_aligned_ranges(path, chunk_size):
+    """
+    Splits a file into byte ranges of roughly chunk_size bytes, each ending at a line boundary
+    """
+    size = os.path.getsize(path)
+    ranges = list()
+    with open(path, 'rb') as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            f.readline()
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def read_tsv_chunks(path, quotechar=None, num_workers=None, chunk_size=32 * 1024 * 1024):
+    """
+    Lazily reads a Tab Separated Values (TSV) file as lists of rows, in file order. Large files are split at
+    line boundaries and the chunks are parsed in parallel worker processes. Files with a quote character are
+    read sequentially, since quoted fields may span lines.
+    :param path: path to a plain, gzip (.gz) or zstandard (.zst) compressed TSV file
+    :param quotechar: quote character passed to csv.reader
+    :param num_workers: number of worker processes, defaults to the number of CPUs
+    :param chunk_size: approximate number of bytes per chunk
+    :return: generator of lists of rows
+    """
+    num_workers = num_workers or os.cpu_count() or 1
+    is_compressed = get_file_extension(path) in ('.gz', '.zst')
+
+    if quotechar is not None or num_workers == 1 or (not is_compressed and os.path.getsize(path) <= chunk_size):
+        with open_text(path) as f:
+            csv.field_size_limit(sys.maxsize)
+            reader = csv.reader(f, delimiter='\t', quotechar=quotechar)
+            rows = list()
+            for row in reader:
+                rows.append(row)
+                if len(rows) == 10000:
+                    yield rows
+                    rows = list()
+            if rows:
+                yield rows
+        return
+
+    with Pool(num_workers) as pool:
+        if is_compressed:
+            with open_text(path) as f:
+                blocks = iter(lambda: f.readlines(chunk_size), [])
+                for rows in pool.imap(_parse_tsv_lines, ((lines, quotechar) for lines in blocks)):
+                    yield rows
+        else:
+            ranges = _line_aligned_ranges(path, chunk_size)
+            for rows in pool.imap(_parse_tsv_range, ((path, start, end, quotechar) for start, end in ranges)):
+                yield rows
@@ -177,3 +177,60 @@ class BertAdam(Optimizer):
                 # bias_correction2 = 1 - beta2 ** state['step']
 
         return loss
+
+
+class MixedAdam(object):
+    """Adam for dense parameters and SparseAdam for the weights of embeddings with sparse gradients.
+    SparseAdam only updates the moments and values of the rows a batch looked up (lazy Adam), so the cost of a
+    step on the embeddings grows with the number of distinct words in the batch rather than with the vocabulary.
+    SparseAdam has no weight decay, which only applies to the dense parameters.
+    Params:
+        dense_params: parameters with dense gradients
+        sparse_params: embedding weights with sparse gradients
+        lr: learning rate
+        weight_decay: weight decay of the dense parameters. Default: 0
+    """
+    def __init__(self, dense_params, sparse_params, lr=1e-3, weight_decay=0):
+        self.optimizers = [torch.optim.SparseAdam(sparse_params, lr=lr)]
+        dense_params = list(dense_params)
+        if dense_params:
+            self.optimizers.append(torch.optim.Adam(dense_params, lr=lr, weight_decay=weight_decay))
+
+    @property
+    def param_groups(self):
+        return [group for optimizer in self.optimizers for group in optimizer.param_groups]
+
+    def zero_grad(self):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad()
+
+    def step(self, closure=None):
+        loss = closure() if closure is not None else None
+        for optimizer in self.optimizers:
+            optimizer.step()
+        return loss
+
+    def state_dict(self):
+        return [optimizer.state_dict() for optimizer in self.optimizers]
+
+    def load_state_dict(self, state_dict):
+        for optimizer, state in zip(self.optimizers, state_dict):
+            optimizer.load_state_dict(state)
+
+
+def get_adam(model, lr, weight_decay=0):
+    """
+    Returns Adam over the trainable parameters of a model, or MixedAdam if some of its embeddings have sparse
+    gradients
+    :param model: model to optimize
+    :param lr: learning rate
+    :param weight_decay: weight decay
+    :return: optimizer
+    """
+    sparse_params = [module.weight for module in model.modules()
+                     if isinstance(module, torch.nn.Embedding) and module.sparse and module.weight.requires_grad]
+    sparse_ids = set(id(p) for p in sparse_params)
+    dense_params = [p for p in model.parameters() if p.requires_grad and id(p) not in sparse_ids]
+    if not sparse_params:
+        return torch.optim.Adam(dense_params, lr=lr, weight_decay=weight_decay)
+    return MixedAdam(dense_params, sparse_params, lr=lr, weight_decay=weight_decay)
@@ -0,0 +1,185 @@
+import argparse
+import os
+import queue
+import threading
+
+import numpy as np
+import torch
+
+from common.metrics import RankingMetrics, to_csr
+
+PREDICTIONS_SUFFIX = '.predictions.npy'
+SCORES_SUFFIX = '.scores.npy'
+TARGETS_SUFFIX = '.targets.npy'
+TARGETS_INDPTR_SUFFIX = '.targets.indptr.npy'
+TARGETS_INDICES_SUFFIX = '.targets.indices.npy'
+
+
+class PredictionSink(object):
+    """
+    Writes the predictions of an evaluation run to memory-mapped .npy files on a background thread. Row i of
+    each file belongs to the i-th example of the split, so batches must be added in the order of the examples.
+    Batches are handed over as tensors, and the copy to the host happens on the writer thread.
+
+    The 'topk' format keeps only the k highest scoring labels of each example, selected on the device, with their
+    scores in a separate file, and stores the targets as a CSR matrix, so the files grow with the number of
+    examples times k rather than times the number of labels.
+    """
+
+    def __init__(self, prefix, num_examples, output_format='logits', top_k=5):
+        """
+        :param prefix: path prefix of the output files
+        :param num_examples: number of examples in the split
+        :param output_format: 'logits' to store raw scores, 'labels' to store predicted label ids, 'topk' to store
+        the top_k labels and their scores
+        :param top_k: number of labels stored per example in the 'topk' format
+        """
+        if output_format not in ('logits', 'labels', 'topk'):
+            raise ValueError('Unrecognized prediction format: {}'.format(output_format))
+        self.prefix = prefix
+        self.num_examples = num_examples
+        self.output_format = output_format
+        self.top_k = top_k
+        self.offset = 0
+        self.predictions = None
+        self.scores = None
+        self.targets = None
+        self.target_lengths = list()
+        self.target_indices = list()
+        self.error = None
+        self.queue = queue.Queue(maxsize=64)
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def add(self, logits, targets):
+        """
+        Queues a batch of predictions for writing
+        :param logits: scores of shape (batch_size, num_labels)
+        :param targets: target labels of the batch
+        """
+        if self.error is not None:
+            raise self.error
+        batch_size = logits.size(0)
+        logits, targets = logits.detach(), targets.detach()
+        if self.output_format == 'topk':
+            # Only the top-k labels and the target labels leave the device
+            logits = logits.topk(min(self.top_k, logits.size(1)), dim=1)
+            targets = to_csr(targets)
+        self.queue.put((self.offset, logits, targets))
+        self.offset += batch_size
+
+    def close(self):
+        """
+        Waits until all batches have been written
+        :return: path prefix of the output files
+        """
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.prefix
+
+    def _open(self, path, array):
+        return np.lib.format.open_memmap(path, mode='w+', dtype=array.dtype,
+                                         shape=(self.num_examples,) + array.shape[1:])
+
+    def _write(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                offset, logits, targets = item
+                if self.output_format == 'topk':
+                    self._write_topk(offset, logits, targets)
+                    continue
+                if self.output_format == 'labels':
+                    logits = logits.argmax(dim=1)
+                predictions, targets = logits.cpu().numpy(), targets.cpu().numpy()
+                if self.predictions is None:
+                    self.predictions = self._open(self.prefix + PREDICTIONS_SUFFIX, predictions)
+                    self.targets = self._open(self.prefix + TARGETS_SUFFIX, targets)
+                self.predictions[offset:offset + len(predictions)] = predictions
+                self.targets[offset:offset + len(targets)] = targets
+        except Exception as e:
+            self.error = e
+            # Keep draining so add() and close() never block on a full queue
+            while self.queue.get() is not None:
+                pass
+        finally:
+            if self.output_format == 'topk':
+                self._close_topk()
+            elif self.predictions is not None:
+                self.predictions.flush()
+                self.targets.flush()
+
+    def _write_topk(self, offset, top, targets):
+        scores, labels = top[0].cpu().numpy(), top[1].cpu().numpy()
+        indptr, indices = targets[0].cpu().numpy(), targets[1].cpu().numpy()
+        if self.predictions is None:
+            self.predictions = self._open(self.prefix + PREDICTIONS_SUFFIX, labels)
+            self.scores = self._open(self.prefix + SCORES_SUFFIX, scores)
+        self.predictions[offset:offset + len(labels)] = labels
+        self.scores[offset:offset + len(scores)] = scores
+        # Batches arrive in order, so the rows of the target matrix are appended
+        self.target_lengths.append(np.diff(indptr))
+        self.target_indices.append(indices)
+
+    def _close_topk(self):
+        if self.predictions is None:
+            return
+        self.predictions.flush()
+        self.scores.flush()
+        lengths = np.concatenate(self.target_lengths)
+        indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        np.save(self.prefix + TARGETS_INDPTR_SUFFIX, indptr)
+        np.save(self.prefix + TARGETS_INDICES_SUFFIX, np.concatenate(self.target_indices).astype(np.int32))
+
+
+def prediction_sink(args, split, num_examples):
+    """
+    Returns a PredictionSink for a split if its predictions were requested with --save-predictions
+    :param args: command line arguments
+    :param split: name of the split, e.g. dev or test
+    :param num_examples: number of examples in the split
+    :return: PredictionSink or None
+    """
+    if split not in (getattr(args, 'save_predictions', None) or []):
+        return None
+    os.makedirs(args.predictions_dir, exist_ok=True)
+    prefix = os.path.join(args.predictions_dir, '{}_{}'.format(args.dataset, split))
+    return PredictionSink(prefix, num_examples, output_format=args.predictions_format,
+                          top_k=getattr(args, 'top_k', 5))
+
+
+def score_predictions(prefix, k=5, threshold=0.5, batch_size=4096):
+    """
+    Computes ranking metrics from predictions saved in the 'topk' format, reading a batch of rows at a time
+    :param prefix: path prefix the predictions were written to
+    :param k: number of labels ranked per example, at most the number of labels stored
+    :param threshold: probability above which a label among the top k is predicted
+    :param batch_size: number of examples read at a time
+    :return: dict of metrics, as returned by RankingMetrics.compute
+    """
+    labels = np.load(prefix + PREDICTIONS_SUFFIX, mmap_mode='r')
+    scores = np.load(prefix + SCORES_SUFFIX, mmap_mode='r')
+    indptr = np.load(prefix + TARGETS_INDPTR_SUFFIX)
+    indices = np.load(prefix + TARGETS_INDICES_SUFFIX, mmap_mode='r')
+    metrics = RankingMetrics(min(k, labels.shape[1]), threshold)
+    for start in range(0, len(labels), batch_size):
+        end = min(start + batch_size, len(labels))
+        batch_indptr = torch.from_numpy(indptr[start:end + 1] - indptr[start])
+        batch_indices = torch.from_numpy(np.array(indices[indptr[start]:indptr[end]], dtype=np.int64))
+        metrics.update(torch.from_numpy(np.array(labels[start:end], dtype=np.int64)), (batch_indptr, batch_indices),
+                       top_scores=torch.from_numpy(np.array(scores[start:end])))
+    return metrics.compute()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compute ranking metrics from predictions saved in the topk format")
+    parser.add_argument('prefix', help='path prefix of the prediction files, e.g. predictions/Reuters_test')
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--threshold', type=float, default=0.5)
+    args = parser.parse_args()
+    print(RankingMetrics.format(score_predictions(args.prefix, args.top_k, args.threshold)))
@@ -1,17 +1,95 @@
+import itertools
+
 import numpy as np
 
 
+def offsets_from_lengths(lengths):
+    """
+    Returns the start offsets of consecutive runs with the given lengths, followed by their total length
+    :param lengths: array of run lengths
+    :return: int64 array of size len(lengths) + 1
+    """
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def length_mask(lengths, width, start=None, dtype=np.int8):
+    """
+    Returns a mask with ones at the positions in [start, lengths) of each row
+    :param lengths: array of row lengths, of any shape
+    :param width: size of the last dimension of the mask
+    :param start: array of the same shape as lengths with the first masked position, defaults to zero
+    :param dtype: data type of the mask
+    :return: array of shape lengths.shape + (width,)
+    """
+    positions = np.arange(width)
+    mask = positions < np.asarray(lengths)[..., None]
+    if start is not None:
+        mask &= positions >= np.asarray(start)[..., None]
+    return mask.astype(dtype)
+
+
+def pack_sequences(sequences, width, dtype=np.int32, pad_value=0):
+    """
+    Copies a list of variable length sequences into the rows of a padded matrix
+    :param sequences: list of sequences, none longer than width
+    :param width: number of columns of the matrix
+    :param dtype: data type of the matrix
+    :param pad_value: value of the padding positions
+    :return: the padded matrix and the length of each row
+    """
+    lengths = np.fromiter((len(x) for x in sequences), dtype=np.int64, count=len(sequences))
+    total = int(lengths.sum())
+    matrix = np.full((len(sequences), width), pad_value, dtype=dtype)
+    if total:
+        flat = np.fromiter(itertools.chain.from_iterable(sequences), dtype=dtype, count=total)
+        rows = np.repeat(np.arange(len(sequences)), lengths)
+        cols = np.arange(total) - np.repeat(offsets_from_lengths(lengths)[:-1], lengths)
+        matrix[rows, cols] = flat
+    return matrix, lengths
+
+
+def document_positions(doc_offsets):
+    """
+    Returns the document of each row and the position of the row within its document
+    :param doc_offsets: index of the first row of each document, followed by the number of rows
+    :return: document index and position of each row
+    """
+    num_rows = np.diff(doc_offsets)
+    doc_index = np.repeat(np.arange(len(num_rows)), num_rows)
+    position = np.arange(doc_offsets[-1]) - np.repeat(doc_offsets[:-1], num_rows)
+    return doc_index, position
+
+
+def pad_documents(rows, doc_offsets, max_doc_length, pad_value=0):
+    """
+    Scatters the sentence rows of each document into a padded (documents, sentences, ...) array. Documents are
+    truncated or padded to the smaller of max_doc_length and the number of sentences in the longest document.
+    :param rows: array with one row per sentence
+    :param doc_offsets: index of the first sentence of each document, followed by the number of sentences
+    :param max_doc_length: maximum number of sentences per document
+    :param pad_value: value of the padding sentences
+    :return: padded array of shape (len(doc_offsets) - 1, doc_length) + rows.shape[1:]
+    """
+    num_docs = len(doc_offsets) - 1
+    num_sentences = np.diff(doc_offsets)
+    doc_length = min(max_doc_length, int(num_sentences.max())) if num_docs else 0
+    padded = np.full((num_docs, doc_length) + rows.shape[1:], pad_value, dtype=rows.dtype)
+
+    doc_index, position = document_positions(doc_offsets)
+    keep = position < doc_length
+    padded[doc_index[keep], position[keep]] = rows[keep]
+    return padded
+
+
 def pad_input_matrix(unpadded_matrix, max_doc_length):
     """
     Returns a zero-padded matrix for a given jagged list
     :param unpadded_matrix: jagged list to be padded
+    :param max_doc_length: maximum number of sentences per document
     :return: zero-padded matrix
     """
-    max_doc_length = min(max_doc_length, max(len(x) for x in unpadded_matrix))
-    zero_padding_array = [0 for i0 in range(len(unpadded_matrix[0][0]))]
-
-    for i0 in range(len(unpadded_matrix)):
-        if len(unpadded_matrix[i0]) < max_doc_length:
-            unpadded_matrix[i0] += [zero_padding_array for i1 in range(max_doc_length - len(unpadded_matrix[i0]))]
-        elif len(unpadded_matrix[i0]) > max_doc_length:
-            unpadded_matrix[i0] = unpadded_matrix[i0][:max_doc_length]
+    doc_offsets = offsets_from_lengths([len(x) for x in unpadded_matrix])
+    rows = np.array([row for doc in unpadded_matrix for row in doc])
+    return pad_documents(rows, doc_offsets, max_doc_length)
@@ -0,0 +1,193 @@
+import os
+from argparse import ArgumentParser
+from hashlib import blake2b
+
+import numpy as np
+import torch
+from torchtext.vocab import Vectors
+from tqdm import tqdm
+
+VECTORS_SUFFIX = '.mmap.npy'
+HASHES_SUFFIX = '.hashes.npy'
+ROWS_SUFFIX = '.rows.npy'
+
+# Stores opened in this process, keyed by the path of the source vectors file
+_store_cache = {}
+
+
+def hash_token(token):
+    """
+    Returns a stable 64-bit hash for a token
+    :param token: string
+    :return: unsigned 64-bit integer
+    """
+    return int.from_bytes(blake2b(token.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def store_prefix(vectors_name, vectors_cache):
+    return os.path.join(vectors_cache, os.path.splitext(vectors_name)[0])
+
+
+def vectors_files(vectors_name, vectors_cache):
+    """
+    Returns the files word vectors are loaded from by load_vectors: the memory-mapped store if there is one, or
+    else the text file and the tensor cache torchtext saves next to it
+    :param vectors_name: name of word vectors file
+    :param vectors_cache: path to directory containing word vectors file
+    :return: list of paths of existing files
+    """
+    prefix = store_prefix(vectors_name, vectors_cache)
+    if MemoryMappedVectors.exists(prefix):
+        return [prefix + suffix for suffix in (VECTORS_SUFFIX, HASHES_SUFFIX, ROWS_SUFFIX)]
+    path = os.path.join(vectors_cache, vectors_name)
+    return [p for p in (path, path + '.pt') if os.path.isfile(p)]
+
+
+def convert_vectors(vectors_path, output_prefix=None):
+    """
+    Converts a word2vec/GloVe style text file into a memory-mapped embedding store. The store consists
+    of a float32 matrix, the sorted 64-bit hashes of the words and the matrix row for each hash.
+    :param vectors_path: path to the text file containing the word vectors
+    :param output_prefix: path prefix for the store files, defaults to the vectors path without its extension
+    :return: path prefix of the store
+    """
+    if output_prefix is None:
+        output_prefix = os.path.splitext(vectors_path)[0]
+
+    with open(vectors_path, 'rb') as f:
+        first_line = f.readline().rstrip().split(b' ')
+        has_header = len(first_line) == 2
+        dim = int(first_line[1]) if has_header else len(first_line) - 1
+        num_words = sum(1 for _ in f) + (0 if has_header else 1)
+
+    vectors = np.lib.format.open_memmap(output_prefix + VECTORS_SUFFIX, mode='w+', dtype=np.float32,
+                                        shape=(num_words, dim))
+    hashes = np.zeros(num_words, dtype=np.uint64)
+    num_rows = 0
+
+    with open(vectors_path, 'rb') as f:
+        if has_header:
+            f.readline()
+        for line in tqdm(f, total=num_words, desc='Converting'):
+            entries = line.rstrip().split(b' ')
+            if len(entries) != dim + 1:
+                # Skip malformed lines and words containing whitespace, as torchtext does
+                continue
+            try:
+                word = entries[0].decode('utf-8')
+            except UnicodeDecodeError:
+                continue
+            vectors[num_rows] = np.array(entries[1:], dtype=np.float32)
+            hashes[num_rows] = hash_token(word)
+            num_rows += 1
+
+    vectors.flush()
+    hashes = hashes[:num_rows]
+    order = np.argsort(hashes, kind='mergesort')
+    sorted_hashes = hashes[order]
+    if np.any(sorted_hashes[1:] == sorted_hashes[:-1]):
+        # Keep the last occurrence of duplicate words, like the stoi of torchtext does. The sort is stable, so the
+        # last row of every run of equal hashes is the last occurrence in the file
+        keep = np.concatenate((sorted_hashes[1:] != sorted_hashes[:-1], [True]))
+        order, sorted_hashes = order[keep], sorted_hashes[keep]
+
+    np.save(output_prefix + HASHES_SUFFIX, sorted_hashes)
+    np.save(output_prefix + ROWS_SUFFIX, order.astype(np.int64))
+    return output_prefix
+
+
+class MemoryMappedVectors(Vectors):
+    """
+    Drop-in replacement for torchtext Vectors backed by a store created with convert_vectors. Nothing is read
+    into memory up front: looking up a token touches only its row of the memory-mapped matrix, so building a
+    vocabulary copies just the rows it needs and processes reading the same store share the page cache.
+    """
+
+    def __init__(self, prefix, unk_init=torch.Tensor.zero_):
+        self.prefix = prefix
+        self.unk_init = unk_init
+        self.vectors = np.load(prefix + VECTORS_SUFFIX, mmap_mode='r')
+        self.hashes = np.load(prefix + HASHES_SUFFIX, mmap_mode='r')
+        self.rows = np.load(prefix + ROWS_SUFFIX, mmap_mode='r')
+        self.dim = self.vectors.shape[1]
+        self.stoi = None
+
+    @staticmethod
+    def exists(prefix):
+        return all(os.path.isfile(prefix + suffix) for suffix in (VECTORS_SUFFIX, HASHES_SUFFIX, ROWS_SUFFIX))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, token):
+        return self.find(token) is not None
+
+    def __getitem__(self, token):
+        row = self.find(token)
+        if row is None:
+            return self.unk_init(torch.Tensor(1, self.dim))
+        return torch.from_numpy(np.array(self.vectors[row]))
+
+    def find(self, token):
+        """
+        Returns the matrix row of a token, or None if the token is not in the store
+        :param token: string
+        :return: row index or None
+        """
+        token_hash = np.uint64(hash_token(token))
+        index = np.searchsorted(self.hashes, token_hash)
+        if index < len(self.hashes) and self.hashes[index] == token_hash:
+            return int(self.rows[index])
+        return None
+
+    def lookup(self, tokens):
+        """
+        Gathers the vectors for a list of tokens into a new tensor, using unk_init for missing tokens
+        :param tokens: list of strings
+        :return: tensor of shape (len(tokens), dim)
+        """
+        token_hashes = np.fromiter((hash_token(token) for token in tokens), dtype=np.uint64, count=len(tokens))
+        indices = np.minimum(np.searchsorted(self.hashes, token_hashes), len(self.hashes) - 1)
+        found = self.hashes[indices] == token_hashes
+
+        # Read the rows in ascending order so the page cache is walked sequentially
+        found_rows = np.asarray(self.rows[indices[found]])
+        order = np.argsort(found_rows)
+        gathered = np.empty((len(found_rows), self.dim), dtype=np.float32)
+        gathered[order] = self.vectors[found_rows[order]]
+
+        result = torch.Tensor(len(tokens), self.dim)
+        result[torch.from_numpy(np.flatnonzero(found))] = torch.from_numpy(gathered)
+        for i in np.flatnonzero(~found):
+            result[int(i)] = self.unk_init(torch.Tensor(1, self.dim))
+        return result
+
+
+def load_vectors(vectors_name, vectors_cache, unk_init=torch.Tensor.zero_):
+    """
+    Returns the word vectors for a dataset, preferring a memory-mapped store created with convert_vectors
+    and falling back to torchtext Vectors otherwise. Stores are opened once per process.
+    :param vectors_name: name of word vectors file
+    :param vectors_cache: path to directory containing word vectors file
+    :param unk_init: function used to generate vector for OOV words
+    :return: MemoryMappedVectors or Vectors
+    """
+    prefix = store_prefix(vectors_name, vectors_cache)
+    if not MemoryMappedVectors.exists(prefix):
+        return Vectors(name=vectors_name, cache=vectors_cache, unk_init=unk_init)
+
+    key = (os.path.abspath(prefix), unk_init)
+    if key not in _store_cache:
+        _store_cache[key] = MemoryMappedVectors(prefix, unk_init=unk_init)
+    return _store_cache[key]
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Convert word vectors into a memory-mapped embedding store")
+    parser.add_argument('vectors_path', help='text file containing the word vectors')
+    parser.add_argument('--output-prefix', default=None,
+                        help='path prefix for the store files, defaults to the vectors path without its extension')
+    args = parser.parse_args()
+
+    prefix = convert_vectors(args.vectors_path, args.output_prefix)
+    print('Saved memory-mapped word vectors to', prefix + '.*.npy')
@@ -0,0 +1,206 @@
+import threading
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torchtext.vocab import Vocab
+
+from utils.vectors import hash_token
+
+PRETRAINED_EMBEDDINGS = ('static_embed', 'non_static_embed')
+
+
+class HashedStoi(dict):
+    """
+    Token to index map of a PrunedVocab. Tokens that are not in the map go to their hash bucket, or to <unk> if
+    there are no buckets, without being added to the map as torchtext's defaultdict would.
+    """
+
+    def __init__(self, itos, unk_index=0, first_bucket=0, num_buckets=0):
+        super().__init__((token, i) for i, token in enumerate(itos))
+        self.unk_index = unk_index
+        self.first_bucket = first_bucket
+        self.num_buckets = num_buckets
+
+    def __missing__(self, token):
+        if not self.num_buckets:
+            return self.unk_index
+        return self.first_bucket + hash_token(token) % self.num_buckets
+
+
+def lookup_vectors(vectors, tokens):
+    """
+    Gathers the vectors of a list of tokens, using the unk_init of the vectors for missing tokens
+    :param vectors: MemoryMappedVectors or torchtext Vectors
+    :param tokens: list of strings
+    :return: tensor of shape (len(tokens), dim)
+    """
+    if hasattr(vectors, 'lookup'):
+        return vectors.lookup(tokens)
+    return torch.stack([vectors[token].view(-1) for token in tokens]) if tokens else torch.Tensor(0, vectors.dim)
+
+
+def has_vector(vectors, token):
+    return token in vectors.stoi if getattr(vectors, 'stoi', None) is not None else token in vectors
+
+
+class PrunedVocab(Vocab):
+    """
+    Vocabulary holding only the special tokens and the most frequent words of the training split. Other words map
+    to <unk> or share num_buckets rows by hash, so the embedding matrix only grows with the words the model can
+    learn from. Words can be added later, with their pretrained vectors, by extend.
+    """
+
+    def __init__(self, vocab, num_words, num_buckets=0):
+        """
+        :param vocab: torchtext Vocab built from the training split, with its words in decreasing order of frequency
+        :param num_words: number of words kept after the special tokens
+        :param num_buckets: number of hash buckets shared by the other words, 0 to map them to <unk>
+        """
+        self.__dict__.update(vocab.__dict__)
+        num_specials = num_leading_specials(vocab)
+        first_bucket = num_specials + num_words
+        self.itos = vocab.itos[:first_bucket] + ['<bucket%d>' % i for i in range(num_buckets)]
+        self.freqs = type(vocab.freqs)({token: vocab.freqs[token] for token in vocab.itos[num_specials:first_bucket]})
+        self.stoi = HashedStoi(self.itos, unk_index=vocab.stoi['<unk>'], first_bucket=first_bucket,
+                               num_buckets=num_buckets)
+        self.num_buckets = num_buckets
+        self.vectors = None
+
+    def __getstate__(self):
+        # torchtext turns stoi back into a defaultdict when unpickling, which would lose the hash buckets
+        return dict(self.__dict__)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def extend(self, tokens, vectors):
+        """
+        Adds the tokens that are not in the vocabulary but have a pretrained vector
+        :param tokens: list of strings
+        :param vectors: MemoryMappedVectors or torchtext Vectors
+        :return: vectors of the added tokens, of shape (num_added, dim)
+        """
+        added = [token for token in dict.fromkeys(tokens) if token not in self.stoi and has_vector(vectors, token)]
+        rows = lookup_vectors(vectors, added)
+        for token in added:
+            self.stoi[token] = len(self.itos)
+            self.itos.append(token)
+        if self.vectors is not None:
+            self.vectors = torch.cat([self.vectors, rows])
+        return rows
+
+
+def num_leading_specials(vocab):
+    # torchtext puts the special tokens first, they are never counted in the word frequencies
+    for i, token in enumerate(vocab.itos):
+        if token in vocab.freqs:
+            return i
+    return len(vocab.itos)
+
+
+def prune_vocab(field, train, vectors, min_freq=1, max_size=None, coverage=None, num_buckets=0):
+    """
+    Builds a PrunedVocab for a field from the words of the training split only, keeping the most frequent words
+    that appear at least min_freq times, at most max_size of them, and no more than needed to cover the given
+    fraction of the training tokens. Its vectors hold one row per kept word and bucket.
+    :param field: TEXT_FIELD of the dataset class, or a NestedField
+    :param train: training split
+    :param vectors: MemoryMappedVectors or torchtext Vectors
+    :param min_freq: minimum number of occurrences of a kept word
+    :param max_size: maximum number of kept words
+    :param coverage: fraction of the training tokens the kept words must cover, e.g. 0.99
+    :param num_buckets: number of hash buckets shared by the other words, 0 to map them to <unk>
+    :return: PrunedVocab, also set as the vocabulary of the field
+    """
+    field.build_vocab(train, min_freq=min_freq)
+    # Nested fields count the words in their nesting field
+    vocab = field.nesting_field.vocab if hasattr(field, 'nesting_field') else field.vocab
+
+    num_specials = num_leading_specials(vocab)
+    counts = np.array([vocab.freqs[token] for token in vocab.itos[num_specials:]], dtype=np.int64)
+    num_words = len(counts)
+    if max_size is not None:
+        num_words = min(num_words, max_size)
+    if coverage is not None and num_words:
+        covered = np.cumsum(counts) / float(sum(vocab.freqs.values()))
+        num_words = min(num_words, int(np.searchsorted(covered, coverage)) + 1)
+
+    pruned = PrunedVocab(vocab, num_words, num_buckets)
+    pruned.vectors = lookup_vectors(vectors, pruned.itos)
+    field.vocab = pruned
+    if hasattr(field, 'nesting_field'):
+        field.nesting_field.vocab = pruned
+    return pruned
+
+
+def pretrained_embeddings(model):
+    """
+    Returns the embeddings of a model that were initialized with pretrained vectors
+    :param model: KimCNN, XmlCNN, RegLSTM or HAN
+    :return: list of nn.Embedding
+    """
+    return [module for name, module in model.named_modules()
+            if isinstance(module, nn.Embedding) and name.split('.')[-1] in PRETRAINED_EMBEDDINGS]
+
+
+class LazyVocabExtender(object):
+    """
+    Looks up words that are not in a PrunedVocab in the full word vectors store at inference time. Their vectors
+    are appended to the vocabulary and to the pretrained embeddings of the model the first time they are seen, so
+    the model only holds the rows of the training vocabulary and of the words it was actually asked about. The
+    embeddings keep spare rows for new words and grow by half when they run out, rather than being copied for every
+    document that brings in new words.
+    """
+
+    def __init__(self, vocab, vectors, model, spare_rows=1024):
+        """
+        :param vocab: PrunedVocab the model was trained with
+        :param vectors: MemoryMappedVectors or torchtext Vectors the vocabulary vectors were loaded from
+        :param model: model whose pretrained embeddings are extended
+        :param spare_rows: number of rows reserved for new words up front
+        """
+        self.vocab = vocab
+        self.vectors = vectors
+        self.embeddings = pretrained_embeddings(model)
+        # Words without a pretrained vector, which keep mapping to <unk> or their bucket
+        self.missing = set()
+        self.lock = threading.Lock()
+        # The model holds the vectors of the words, the vocabulary does not need a second copy growing with it
+        vocab.vectors = None
+        self.reserve(len(vocab.itos) + spare_rows)
+
+    def reserve(self, num_rows):
+        """
+        Grows the pretrained embeddings to at least num_rows rows. Rows past the end of the vocabulary are zero and
+        are never looked up.
+        :param num_rows: number of rows
+        """
+        for embedding in self.embeddings:
+            size = embedding.weight.size(0)
+            if size >= num_rows:
+                continue
+            weight = embedding.weight.data.new_zeros(num_rows, embedding.weight.size(1))
+            weight[:size] = embedding.weight.data
+            embedding.weight = nn.Parameter(weight, requires_grad=embedding.weight.requires_grad)
+            embedding.num_embeddings = num_rows
+
+    def update(self, tokens):
+        """
+        Adds the tokens that are not in the vocabulary but have a pretrained vector
+        :param tokens: list of strings
+        """
+        unknown = [token for token in tokens if token not in self.vocab.stoi and token not in self.missing]
+        if not unknown:
+            return
+        with self.lock:
+            start = len(self.vocab.itos)
+            rows = self.vocab.extend(unknown, self.vectors)
+            self.missing.update(token for token in unknown if token not in self.vocab.stoi)
+            if not len(rows):
+                return
+            end = start + len(rows)
+            if any(embedding.weight.size(0) < end for embedding in self.embeddings):
+                self.reserve(max(end, start + start // 2))
+            for embedding in self.embeddings:
+                embedding.weight.data[start:end] = rows.to(embedding.weight)